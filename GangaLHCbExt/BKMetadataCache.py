@@ -0,0 +1,186 @@
+"""
+Persistent cache of the bookkeeping metadata of files, keyed by LFN.
+
+The metadata of a file does not change, so it is stored in an SQLite database
+in the gangadir and only the files that are not (or no longer) in the cache
+are queried from the bookkeeping. Used by the splitters, the checkers and
+gutils.datasets, e.g.
+
+    successful, failed = bkMetadataCached(dataset)
+    getCache().stats()
+"""
+import os
+import time
+import atexit
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from GangaCore.Utility.Config import getConfig
+from GangaCore.Utility.files import expandfilename
+from GangaCore.Utility.logging import getLogger
+
+logger = getLogger()
+
+# Fields of the bookkeeping metadata that are kept in the cache (and returned by lookups)
+FIELDS = ['RunNumber', 'EventStat', 'FullStat', 'FileType', 'FileSize', 'ADLER32']
+
+DEFAULT_FILENAME = 'bkmetadata.sqlite'
+DEFAULT_EXPIRY = 90 * 24 * 3600  # seconds, None for no expiry
+DEFAULT_MAX_ENTRIES = 5000000  # oldest entries are evicted above that
+
+# Eviction walks the index of the creation times, it runs every EVICT_INTERVAL stores (and at exit)
+EVICT_INTERVAL = 100
+
+# Files are queried in chunks with concurrent queries (a single call times out for large inputs)
+CHUNK_SIZE = 1000
+WORKERS = 4
+
+# SQLite limits the number of variables in a statement
+_SQL_CHUNK_SIZE = 500
+
+
+def _chunks(l, n):
+    """Yield successive n-sized chunks from l."""
+    for i in range(0, len(l), n):
+        yield l[i:i + n]
+
+
+class BKMetadataCache(object):
+    """SQLite backed cache of bookkeeping metadata with expiry and hit/miss statistics."""
+
+    def __init__(self, path, expiry=DEFAULT_EXPIRY, maxEntries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.expiry = expiry
+        self.maxEntries = maxEntries
+        self.hits = 0
+        self.misses = 0
+        self._unevicted = 0  # stores since the last eviction
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS metadata (lfn TEXT PRIMARY KEY, {}, created REAL)'
+                .format(', '.join(FIELDS)))
+            self._conn.execute('CREATE INDEX IF NOT EXISTS metadata_created ON metadata (created)')
+
+    def lookup(self, lfns):
+        """Return {lfn: metadata} for the LFNs found in the cache (and not expired)."""
+        lfns = list(set(lfns))
+        oldest = time.time() - self.expiry if self.expiry else 0
+        found = {}
+        with self._lock:
+            for chunk in _chunks(lfns, _SQL_CHUNK_SIZE):
+                rows = self._conn.execute(
+                    'SELECT lfn, {} FROM metadata WHERE created >= ? AND lfn IN ({})'
+                    .format(', '.join(FIELDS), ', '.join('?' * len(chunk))),
+                    [oldest] + chunk)
+                for row in rows:
+                    found[row[0]] = dict(zip(FIELDS, row[1:]))
+            self.hits += len(found)
+            self.misses += len(lfns) - len(found)
+        return found
+
+    def store(self, metadata):
+        """Add {lfn: metadata} to the cache."""
+        now = time.time()
+        rows = [[lfn] + [md.get(k) for k in FIELDS] + [now] for lfn, md in metadata.items()]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO metadata VALUES ({})'.format(', '.join('?' * (len(FIELDS) + 2))),
+                rows)
+            self._unevicted += 1
+            due = self._unevicted >= EVICT_INTERVAL
+        if due:
+            self.evict()
+
+    def get(self, lfns, fetch):
+        """
+        Return (successful, failed) for lfns, where successful is {lfn: metadata}.
+        Only the LFNs missing from the cache are passed to fetch(lfns), which
+        must return a (successful, failed) tuple as well.
+        """
+        successful = self.lookup(lfns)
+        missing = [lfn for lfn in lfns if lfn not in successful]
+        failed = []
+        if missing:
+            logger.debug('Bookkeeping metadata cache: {} hits, {} misses'
+                         .format(len(successful), len(missing)))
+            fetched, failed = fetch(missing)
+            self.store(fetched)
+            successful.update(fetched)
+        return successful, failed
+
+    def evict(self):
+        """Remove expired entries and the oldest entries above maxEntries."""
+        with self._lock, self._conn:
+            self._unevicted = 0
+            if self.expiry:
+                self._conn.execute('DELETE FROM metadata WHERE created < ?', [time.time() - self.expiry])
+            if self.maxEntries:
+                # the oldest entries above maxEntries, by rowid as entries stored together share their creation time
+                excess = self._conn.execute('SELECT COUNT(*) FROM metadata').fetchone()[0] - self.maxEntries
+                if excess > 0:
+                    self._conn.execute('DELETE FROM metadata WHERE rowid IN '
+                                       '(SELECT rowid FROM metadata ORDER BY created, rowid LIMIT ?)', [excess])
+
+    def evictIfStored(self):
+        """Evict if entries were stored since the last eviction (called at exit)."""
+        if self._unevicted:
+            self.evict()
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM metadata')
+
+    def stats(self):
+        """Return a dictionary with the number of hits, misses and entries."""
+        with self._lock:
+            entries = self._conn.execute('SELECT COUNT(*) FROM metadata').fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries}
+
+
+_cache = None
+
+
+def getCache():
+    """Return the default cache, stored in the gangadir."""
+    global _cache
+    if _cache is None:
+        gangadir = expandfilename(getConfig('Configuration')['gangadir'])
+        _cache = BKMetadataCache(os.path.join(gangadir, DEFAULT_FILENAME))
+        atexit.register(_cache.evictIfStored)
+    return _cache
+
+
+def bkMetadataResult(metadata):
+    """Return (successful, failed) from the return value of LHCbDataset.bkMetadata()."""
+    if 'OK' in metadata:  # S_OK/S_ERROR structure
+        if not metadata['OK']:
+            raise RuntimeError('Error getting bookkeeping metadata: {}'.format(metadata.get('Message')))
+        metadata = metadata['Value']
+    return metadata['Successful'], list(metadata['Failed'])
+
+
+def bkMetadataCached(dataset, cache=None, chunkSize=CHUNK_SIZE, workers=WORKERS):
+    """
+    Return (successful, failed) bookkeeping metadata of the files in dataset,
+    where successful is {lfn: metadata}. Files not in the cache are queried in
+    chunks of chunkSize files with up to workers concurrent queries.
+    """
+    index = dict((f.lfn, f) for f in dataset.files)
+
+    def fetch(lfns):
+        def fetch_chunk(chunk):
+            ds = dataset.__class__()
+            ds.files = [index[lfn] for lfn in chunk]
+            return bkMetadataResult(ds.bkMetadata())
+
+        successful, failed = {}, []
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for s, f in pool.map(fetch_chunk, _chunks(lfns, chunkSize)):
+                successful.update(s)
+                failed += f
+        return successful, failed
+
+    return (cache or getCache()).get(list(index), fetch)
@@ -1,31 +1,153 @@
+import math
 from collections import defaultdict
 from GangaCore.Core.exceptions import SplitterError as SplittingError
 from GangaCore.Utility.logging import getLogger
-from GangaDirac.Lib.Backends.DiracUtils import result_ok
 from GangaDirac.Lib.Splitters.SplitterUtils import DiracSplitter
+from .LHCbBookkeepingChecker import bkMetadataStat
+from .BKMetadataCache import bkMetadataCached
 
 logger = getLogger()
 
 
-def DiracRunSplitter(inputs, filesPerJob, maxFiles, ignoremissing):
+def bkMetadataChunked(inputs):
     """
-    Generator that yields datasets for dirac split jobs by run
+    Return the bookkeeping metadata ({lfn: metadata}) of all files in inputs.
+    The metadata is taken from the local cache, the missing files are queried
+    in chunks with concurrent queries.
     """
-
-    metadata = inputs.bkMetadata()
-    if not result_ok(metadata):
-        logger.error('Error getting input metadata: %s' % str(metadata))
+    try:
+        successful, failed = bkMetadataCached(inputs)
+    except RuntimeError as e:
+        logger.error('Error getting input metadata: %s' % str(e))
         raise SplittingError('Error splitting files.')
-    if metadata['Value']['Failed']:
+    if failed:
         logger.error('Error getting part of metadata')
         raise SplittingError('Error splitting files.')
+    return successful
+
 
+def groupByRun(files, metadata):
+    """
+    Return {run: [files]} given the files and their metadata ({lfn: metadata}).
+    Runs in linear time, the order of files within a run follows the input.
+    """
+    index = dict((f.lfn, f) for f in files)
     runs = defaultdict(list)
-    for lfn,v in metadata['Value']['Successful'].items():
-        f = [f for f in inputs.files if f.lfn == lfn][0]
-        runs[v['RunNumber']].append(f)
+    for lfn, f in index.items():
+        runs[metadata[lfn]['RunNumber']].append(f)
+    return runs
+
+
+def _splitEvenly(files, weight, njobs, maxFiles):
+    """
+    Split files in (about) njobs consecutive chunks of equal total weight.
+    A chunk ends at each boundary k * total / njobs, a file heavier than a
+    chunk takes (the chunks of) all the boundaries it passes.
+    """
+    total = sum(weight(f) for f in files)
+    if not total:
+        weight, total = (lambda f: 1), len(files)
+    chunks, current, acc, boundaries = [], [], 0, 0
+    for f in files:
+        current.append(f)
+        acc += weight(f)
+        passed = acc * njobs // total  # boundaries passed so far
+        if len(current) >= maxFiles or passed > boundaries:
+            chunks.append(current)
+            current = []
+            boundaries = passed
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def packRuns(runs, metadata, eventsPerJob, filesPerJob):
+    """
+    Return a list of datasets (lists of files) with roughly eventsPerJob events each.
+    Runs with more events are split into subjobs with (about) equal number of events,
+    while smaller runs are packed together whole (first fit decreasing).
+    No dataset contains more than filesPerJob files.
+    """
+    def events(f):
+        return bkMetadataStat(metadata[f.lfn]) or 0
+
+    datasets = []
+    small = []
+    for run, files in sorted(runs.items()):
+        n = sum(events(f) for f in files)
+        if n > eventsPerJob or len(files) > filesPerJob:
+            njobs = max(int(math.ceil(float(n) / eventsPerJob)),
+                        int(math.ceil(float(len(files)) / filesPerJob)))
+            datasets += _splitEvenly(files, events, njobs, filesPerJob)
+        else:
+            small.append((n, files))
+
+    bins = []  # [events, files]
+    for n, files in sorted(small, key=lambda x: x[0], reverse=True):
+        for b in bins:
+            if b[0] + n <= eventsPerJob and len(b[1]) + len(files) <= filesPerJob:
+                b[0] += n
+                b[1].extend(files)
+                break
+        else:
+            bins.append([n, list(files)])
+    datasets += [files for n, files in bins]
+    return datasets
+
+
+def packingReport(datasets, metadata):
+    """
+    Return the distribution of the number of events and the size (in bytes) of
+    the given datasets, e.g. {'subjobs': 3, 'events': {'min': ..., 'median': ...,
+    'max': ..., 'total': ...}, 'size': {...}}.
+    """
+    def distribution(values):
+        values = sorted(values)
+        if not values:
+            return {'min': 0, 'median': 0, 'max': 0, 'total': 0}
+        return {'min': values[0], 'median': values[len(values) // 2],
+                'max': values[-1], 'total': sum(values)}
+
+    return {
+        'subjobs': len(datasets),
+        'events': distribution(sum(bkMetadataStat(metadata[f.lfn]) or 0 for f in ds)
+                               for ds in datasets),
+        'size': distribution(sum(metadata[f.lfn].get('FileSize') or 0 for f in ds)
+                             for ds in datasets),
+    }
+
+
+def logPackingReport(report):
+    logger.info('Event-balanced packing gives {} subjobs'.format(report['subjobs']))
+    for key in ['events', 'size']:
+        logger.info('  {:6} per subjob: min={min} median={median} max={max} total={total}'
+                    .format(key, **report[key]))
+
+
+def predictRunPacking(inputs, filesPerJob, eventsPerJob):
+    """Return the packing report for inputs without creating any subjob."""
+    metadata = bkMetadataChunked(inputs)
+    runs = groupByRun(inputs.files, metadata)
+    return packingReport(packRuns(runs, metadata, eventsPerJob, filesPerJob), metadata)
+
+
+def DiracRunSplitter(inputs, filesPerJob, maxFiles, ignoremissing, eventsPerJob=0):
+    """
+    Generator that yields datasets for dirac split jobs by run.
+    If eventsPerJob is given, runs are packed/split to balance the number of events.
+    """
+
+    metadata = bkMetadataChunked(inputs)
+    runs = groupByRun(inputs.files, metadata)
     logger.info('Found %d runs in inputdata'%len(runs))
 
+    if eventsPerJob:
+        datasets = packRuns(runs, metadata, eventsPerJob, filesPerJob)
+        logPackingReport(packingReport(datasets, metadata))
+        for ds in datasets:
+            yield ds
+        return
+
     for run,files in sorted(runs.items()):
         run_inputs = inputs.__class__()
         run_inputs.files = files
@@ -1,12 +1,103 @@
+import time
+import threading
+from collections import OrderedDict
 from GangaCore.Utility.logging import getLogger, _set_log_level
 from GangaCore.GPIDev.Adapters.IChecker import IChecker
 from GangaCore.GPIDev.Schema import Schema, Version, SimpleItem
+from .BKMetadataCache import bkMetadataCached
 
 logger = getLogger()
 
 def bkMetadataStat(md):
     return md['FullStat'] if md['FileType'] == 'RAW' else md['EventStat']
 
+
+def _bkMetadata(dataset):
+    """Return (successful, failed) metadata for dataset, quietly."""
+    from GangaLHCb.Lib.LHCbDataset.LHCbDataset import logger as ds_logger
+    old = ds_logger.level
+    _set_log_level(ds_logger, 'WARNING')
+    try:
+        return bkMetadataCached(dataset)
+    finally:
+        ds_logger.setLevel(old)
+
+
+# Statuses of subjobs that will not be checked (any more) unless resubmitted
+_FINAL_STATUSES = ('completed', 'failed', 'killed')
+
+
+class _MasterMetadata(object):
+    """
+    Bookkeeping metadata of the inputs of all subjobs of a master job, fetched
+    in bulk at the first check of one of the subjobs. Dropped (and the timing
+    reported) once every subjob is checked or final without being checked.
+    """
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, master):
+        with cls._instances_lock:
+            if master.id not in cls._instances:
+                cls._instances[master.id] = cls(master)
+            return cls._instances[master.id]
+
+    def __init__(self, master):
+        self.master = master
+        self.lock = threading.Lock()
+        self.successful = None
+        self.failed = None
+        self.pending = OrderedDict((sj.id, sj) for sj in master.subjobs)  # neither checked nor final
+        self.nchecked = 0
+        self.nunchecked = 0  # final without being checked, e.g. failed or killed
+        self.prefetchTime = 0.0
+        self.firstCheck = None
+        self.lastCheck = None
+
+    def lookup(self, dataset):
+        """Return (successful, failed) metadata for dataset (a subjob's inputdata)."""
+        with self.lock:
+            if self.successful is None:
+                from GangaLHCb.Lib.LHCbDataset.LHCbDataset import LHCbDataset
+                start = time.time()
+                union = LHCbDataset()
+                union.files = [f for sj in self.master.subjobs if sj.inputdata for f in sj.inputdata.files]
+                self.successful, failed = _bkMetadata(union)
+                self.failed = set(failed)
+                self.prefetchTime = time.time() - start
+                logger.info('Got bookkeeping metadata of {} files for the subjobs of job {} in {:.1f} s'
+                            .format(len(union.files), self.master.id, self.prefetchTime))
+        lfns = [f.lfn for f in dataset.files]
+        successful = dict((lfn, self.successful[lfn]) for lfn in lfns if lfn in self.successful)
+        failed = [lfn for lfn in lfns if lfn not in successful]
+        return successful, failed
+
+    def checked(self, job, start, end):
+        """Account for the check of a subjob (from start to end), report the totals after the last one."""
+        with self.lock:
+            self.nchecked += 1
+            self.firstCheck = start if self.firstCheck is None else min(self.firstCheck, start)
+            self.lastCheck = end if self.lastCheck is None else max(self.lastCheck, end)
+            self.pending.pop(job.id, None)
+            # drop the subjobs that ended without a check, up to the first one still to be checked
+            while self.pending:
+                sj = next(iter(self.pending.values()))
+                if sj.status not in _FINAL_STATUSES:
+                    break
+                del self.pending[sj.id]
+                self.nunchecked += 1
+            done = not self.pending
+        if done:
+            logger.info('LHCbBookkeepingChecker: checked {} subjobs of job {} ({} not checked) in {:.1f} s '
+                        '(of which {:.1f} s getting bookkeeping metadata)'
+                        .format(self.nchecked, self.master.id, self.nunchecked,
+                                self.lastCheck - self.firstCheck, self.prefetchTime))
+            with self._instances_lock:
+                if self._instances.get(self.master.id) is self:
+                    del self._instances[self.master.id]
+
+
 class LHCbBookkeepingChecker(IChecker):
     """
     Compares the number of processed events (metadata) and the number of input events.
@@ -19,16 +110,29 @@ class LHCbBookkeepingChecker(IChecker):
     _exportmethods = ['check']
 
     def check(self, job):
-        from GangaLHCb.Lib.LHCbDataset.LHCbDataset import logger as ds_logger
-        old = ds_logger.level
-        _set_log_level(ds_logger, 'WARNING')
-        bkmd = job.inputdata.bkMetadata()
-        ds_logger.setLevel(old)
+        if not job.master:
+            return self._check(job, None)
+        master = _MasterMetadata.get(job.master)
+        start = time.time()
+        try:
+            return self._check(job, master)
+        finally:
+            master.checked(job, start, time.time())
+
+    def _check(self, job, master):
+        try:
+            if master:
+                successful, failed = master.lookup(job.inputdata)
+            else:
+                successful, failed = _bkMetadata(job.inputdata)
+        except RuntimeError as e:
+            logger.warning(str(e))
+            failed = True
 
-        if bkmd['Failed']:
+        if failed:
             logger.warning('Could not get the bookeeping metadata.')
             return self.failure
-        n_expected = sum(bkMetadataStat(v) for v in bkmd['Successful'].values())
+        n_expected = sum(bkMetadataStat(v) for v in successful.values())
 
         try:
             n_processed = job.metadata['events']['input']
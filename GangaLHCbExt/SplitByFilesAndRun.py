@@ -4,6 +4,7 @@
 from GangaGaudi.Lib.Splitters.GaudiInputDataSplitter import GaudiInputDataSplitter
 #from GangaGaudi.Lib.Splitters.SplitterUtils import DatasetSplitter
 from .DiracRunSplitter import DiracRunSplitter as DiracSplitter  # change!
+from .DiracRunSplitter import predictRunPacking, logPackingReport
 #from SplitterUtils import DiracSplitter
 from GangaLHCb.Lib.Files import LogicalFile
 from GangaLHCb.Lib.LHCbDataset.LHCbDataset import LHCbDataset
@@ -37,7 +38,12 @@ class SplitByFilesAndRun(GaudiInputDataSplitter):  # change!
                                                    doc='Skip LFNs if they are not found ' \
                                                    'in the LFC. This option is only used if' \
                                                    'jobs backend is Dirac')
-
+    _schema.datadict['eventsPerJob']  = SimpleItem(defvalue=0,
+                                                   doc='Target number of events per subjob. If non-zero, '\
+                                                   'small runs are packed together and large runs are split '\
+                                                   'in subjobs with about equal number of events (using the '\
+                                                   'bookkeeping metadata). Only used if jobs backend is Dirac')
+    _exportmethods = ['report']
 
 
 
@@ -94,11 +100,23 @@ class SplitByFilesAndRun(GaudiInputDataSplitter):  # change!
             return DiracSplitter(indata,
                                  self.filesPerJob,
                                  self.maxFiles,
-                                 self.ignoremissing)
+                                 self.ignoremissing,
+                                 self.eventsPerJob)
         else:
             return super(SplitByFilesAndRun,self)._splitter(job, indata)
 
 
+    def report(self, job):
+        """Print and return the predicted subjob size distribution (requires eventsPerJob)."""
+        if not self.eventsPerJob:
+            raise SplittingError('report() is only available if eventsPerJob is set')
+        indata = stripProxy(job).inputdata
+        if not indata:
+            raise SplittingError('Cannot predict splitting if no inputdata given!')
+        report = predictRunPacking(indata, min(self.filesPerJob, 100), self.eventsPerJob)
+        logPackingReport(report)
+        return report
+
     def split(self, job):
         if self.maxFiles == -1: self.maxFiles = None
         # change!
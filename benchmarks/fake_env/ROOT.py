@@ -0,0 +1,67 @@
+"""
+Stand-in of the parts of PyROOT used by gutils.root_utils. A "ROOT file" is a
+JSON file {"tree name": entries}, see benchmarks/generators.py. Opening a file
+takes GUTILS_FAKE_LATENCY seconds.
+"""
+import os
+import json
+import time
+
+
+class _Class(object):
+    def __init__(self, name):
+        self.name = name
+
+    def GetName(self):
+        return self.name
+
+
+class TTree(object):
+    def __init__(self, name, entries):
+        self.name = name
+        self.entries = entries
+
+    def GetName(self):
+        return self.name
+
+    def IsA(self):
+        return _Class('TTree')
+
+    def GetEntries(self):
+        return self.entries
+
+
+class TKey(object):
+    def __init__(self, name):
+        self.name = name
+
+    def GetName(self):
+        return self.name
+
+
+class TFile(object):
+    def __init__(self, trees):
+        self.trees = trees
+
+    @staticmethod
+    def Open(path):
+        time.sleep(float(os.environ.get('GUTILS_FAKE_LATENCY', 0)))
+        if path.startswith('root://'):
+            path = os.path.join(os.environ['GUTILS_FAKE_STORAGE'], path.split('//', 2)[2].lstrip('/'))
+        try:
+            with open(path) as f:
+                return TFile(json.load(f))
+        except (IOError, ValueError):
+            return None
+
+    def IsZombie(self):
+        return False
+
+    def GetListOfKeys(self):
+        return [TKey(name) for name in self.trees]
+
+    def Get(self, name):
+        return TTree(name, self.trees[name])
+
+    def Close(self, option=''):
+        pass
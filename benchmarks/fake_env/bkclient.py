@@ -0,0 +1,26 @@
+"""
+Stand-ins of the DIRAC clients served by the gutils.bk_utils helper
+(--client bkclient:BookkeepingClient). Each call takes GUTILS_FAKE_LATENCY seconds.
+"""
+import os
+import time
+
+
+def _latency():
+    time.sleep(float(os.environ.get('GUTILS_FAKE_LATENCY', 0)))
+
+
+class BookkeepingClient(object):
+    def getRunsForFill(self, fill):
+        _latency()
+        return {'OK': True, 'Value': [fill * 10 + i for i in range(3)]}
+
+    def getRunInformation(self, in_dict):
+        _latency()
+        return {'OK': True, 'Value': dict((run, {'Fill': run // 10}) for run in in_dict.get('RunNumber', []))}
+
+
+class DataManager(object):
+    def removeFile(self, lfns):
+        _latency()
+        return {'OK': True, 'Value': {'Successful': dict((lfn, True) for lfn in lfns), 'Failed': {}}}
@@ -0,0 +1,409 @@
+"""
+Local stand-ins for Ganga, DIRAC and the grid storage, such that the hot paths
+of gutils and GangaLHCbExt can be benchmarked without a Ganga session or grid
+access. Call install() before importing gutils or GangaLHCbExt.
+
+The storage (EOS, DIRAC storage elements) is a local directory: LFNs and EOS
+paths are files below it. The helpers and commands started by gutils
+(lb-run, xrdcp, dirac-dms-lfn-accessURL, the ROOT and bookkeeping helpers)
+are replaced by the scripts in fake_env, which are put first on the PATH.
+Latencies (in seconds) are injected with the environment variables
+GUTILS_FAKE_LATENCY (per remote call) and GUTILS_FAKE_SE_LATENCY (JSON,
+{storage element: latency}). In this process, jobs are loaded lazily as in
+Ganga: the first access to the output files of a (sub)job costs the load
+latency (until unload, e.g. for a new session), and MassStorageFile.location()
+costs the location latency (see set_latency).
+"""
+import os
+import ast
+import sys
+import json
+import time
+import types
+import random
+import shutil
+import fnmatch
+import logging
+import datetime
+
+FAKE_ENV = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_env')
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Storage elements of the replicas returned by the fake dirac-dms-lfn-accessURL
+STORAGE_ELEMENTS = ['se1.fake', 'se2.fake']
+
+_config = {'gangadir': None, 'storage': None, 'latency': 0.0, 'load_latency': 0.0, 'location_latency': 0.0}
+
+
+def latency():
+    return _config['latency']
+
+
+def storage_path(path):
+    """Return the local path of an LFN or EOS path."""
+    return os.path.join(_config['storage'], path.lstrip('/'))
+
+
+# ----------------------------------------------------------------------------
+# Files
+
+class IGangaFile(object):
+    def _list_get__match__(self, to_match):
+        return fnmatch.fnmatch(self.namePattern, to_match)
+
+
+class DiracFile(IGangaFile):
+    def __init__(self, namePattern='', lfn=''):
+        self.namePattern = namePattern
+        self.lfn = lfn
+        self.localDir = None
+
+    def get(self):
+        time.sleep(latency())
+        shutil.copyfile(storage_path(self.lfn), os.path.join(self.localDir, self.namePattern))
+
+    def getMetadata(self):
+        time.sleep(latency())
+        return {'Successful': {self.lfn: {'Size': os.path.getsize(storage_path(self.lfn))}}}
+
+    def __repr__(self):
+        return 'DiracFile(lfn={!r})'.format(self.lfn)
+
+
+def execute(command):
+    """Stand-in of GangaDirac's execute, only for getMetadata([lfn, ...])."""
+    time.sleep(latency())
+    name, _, arguments = command.partition('(')
+    if name != 'getMetadata':
+        raise NotImplementedError(command)
+    lfns = ast.literal_eval(arguments[:-1])
+    lfns = [lfns] if isinstance(lfns, str) else lfns
+    found = [lfn for lfn in lfns if os.path.isfile(storage_path(lfn))]
+    return {'Successful': dict((lfn, {'Size': os.path.getsize(storage_path(lfn))}) for lfn in found),
+            'Failed': dict((lfn, 'No such file or directory') for lfn in lfns if lfn not in found)}
+
+
+class MassStorageFile(IGangaFile):
+    def __init__(self, namePattern='', locations=None):
+        self.namePattern = namePattern
+        self.locations = locations or []
+        self.localDir = None
+
+    def location(self):
+        if _config['location_latency']:
+            time.sleep(_config['location_latency'])
+        return self.locations
+
+    def get(self):
+        time.sleep(latency())
+        shutil.copyfile(storage_path(self.locations[0]), os.path.join(self.localDir, self.namePattern))
+
+
+class LocalFile(IGangaFile):
+    def __init__(self, namePattern='', localDir=None):
+        self.namePattern = namePattern
+        self.localDir = localDir
+
+
+class FileList(list):
+    """Like the GangaList of job.outputfiles."""
+
+    def get(self, pattern):
+        return [f for f in self if f._list_get__match__(pattern)]
+
+
+# ----------------------------------------------------------------------------
+# Jobs
+
+class SubjobList(list):
+    def select(self, status=None):
+        return [j for j in self if status is None or j.status == status]
+
+
+class JobTime(object):
+    def __init__(self, runtime, final):
+        self._runtime = runtime
+        self._final = final
+
+    def runtime(self):
+        return datetime.timedelta(seconds=self._runtime)
+
+    def final(self):
+        return self._final
+
+
+class JobInfo(object):
+    def __init__(self):
+        self.submit_counter = 1
+
+
+class Backend(object):
+    def __init__(self, actualCE=None):
+        self.actualCE = actualCE
+
+
+class Job(object):
+    def __init__(self, id, master=None, name='', status='new'):
+        self.id = id
+        self.master = master
+        self.fqid = '{}.{}'.format(master.id, id) if master else str(id)
+        self.name = name
+        self.status = status
+        self.subjobs = SubjobList()
+        self._loaded = False
+        self.outputfiles = FileList()
+        self.inputdata = None
+        self.outputdir = ''
+        self.backend = Backend()
+        self.info = JobInfo()
+        self.time = JobTime(0, None)
+
+    @property
+    def outputfiles(self):
+        if not self._loaded:
+            if _config['load_latency']:
+                time.sleep(_config['load_latency'])
+            self._loaded = True
+        return self._outputfiles
+
+    @outputfiles.setter
+    def outputfiles(self, files):
+        self._outputfiles = files
+
+    def resubmit(self):
+        time.sleep(latency())
+        self.status = 'submitted'
+        self.info.submit_counter += 1
+
+    def force_status(self, status):
+        self.status = status
+
+    def remove(self):
+        pass
+
+    def __repr__(self):
+        return 'Job({})'.format(self.fqid)
+
+
+class Registry(object):
+    """Stand-in of GangaCore.GPI.jobs."""
+
+    def __init__(self):
+        self.jobs = {}
+
+    def __call__(self, fqid):
+        ids = [int(x) for x in str(fqid).split('.')]
+        job = self.jobs[ids[0]]
+        return job.subjobs[ids[1]] if len(ids) > 1 else job
+
+    def select(self, minid=None, maxid=None, **attrs):
+        return [j for i, j in sorted(self.jobs.items())
+                if (minid is None or i >= minid) and (maxid is None or i <= maxid) and
+                all(getattr(j, k) == v for k, v in attrs.items())]
+
+    def add(self, job):
+        self.jobs[job.id] = job
+
+
+def make_registry(masters, subjobs, file_type='DiracFile', name='job.root', failed=0.1, seed=1, first_id=1000):
+    """
+    Return a Registry with masters master jobs of subjobs subjobs each. Each
+    subjob has one output file named name (of file_type) and a log file. A
+    fraction failed of the subjobs are failed (without output), the others completed.
+    """
+    rng = random.Random(seed)
+    registry = Registry()
+    now = datetime.datetime(2020, 1, 1)
+    for m in range(first_id, first_id + masters):
+        master = Job(m, name='bench-{}'.format(m), status='running')
+        for s in range(subjobs):
+            job = Job(s, master=master, name=master.name)
+            job.outputdir = os.path.join(_config['gangadir'] or '/tmp', 'workspace', str(m), str(s), 'output')
+            ok = rng.random() >= failed
+            job.status = 'completed' if ok else 'failed'
+            job.backend = Backend('CE-{}'.format(rng.randrange(10)))
+            job.time = JobTime(rng.uniform(600, 7200), now + datetime.timedelta(seconds=rng.uniform(0, 86400)))
+            if file_type == 'DiracFile':
+                f = DiracFile(name, '/lhcb/user/b/bench/{}/{}/{}'.format(m, s, name) if ok else '')
+            elif file_type == 'MassStorageFile':
+                f = MassStorageFile(name, ['/eos/lhcb/bench/{}/{}/{}'.format(m, s, name)] if ok else [])
+            else:
+                f = LocalFile(name)
+                if ok:
+                    if not os.path.isdir(job.outputdir):
+                        os.makedirs(job.outputdir)
+                    open(os.path.join(job.outputdir, name), 'w').close()
+            job.outputfiles = FileList([DiracFile('log.txt', ''), f])
+            master.subjobs.append(job)
+        registry.add(master)
+    return registry
+
+
+# ----------------------------------------------------------------------------
+# Bookkeeping
+
+class LogicalFile(object):
+    def __init__(self, lfn):
+        self.lfn = lfn
+
+
+def make_metadata(lfn, rng, runs):
+    return {'RunNumber': rng.randrange(runs), 'FileType': 'DST', 'EventStat': rng.randrange(1000, 100000),
+            'FullStat': 0, 'FileSize': rng.randrange(10 ** 8, 5 * 10 ** 9), 'ADLER32': '00000001'}
+
+
+class LHCbDataset(object):
+    """Stand-in of LHCbDataset, bkMetadata() answers from a synthetic bookkeeping with injected latency."""
+    bookkeeping = {}  # {lfn: metadata}
+    calls = 0
+
+    def __init__(self, files=None):
+        self.files = list(files or [])
+
+    def bkMetadata(self):
+        LHCbDataset.calls += 1
+        time.sleep(latency())
+        md = self.bookkeeping
+        return {'OK': True, 'Value': {'Successful': dict((f.lfn, md[f.lfn]) for f in self.files if f.lfn in md),
+                                      'Failed': [f.lfn for f in self.files if f.lfn not in md]}}
+
+
+def make_dataset(nfiles, runs=None, seed=1):
+    """Return an LHCbDataset of nfiles LFNs (in about nfiles/20 runs), registered in the fake bookkeeping."""
+    rng = random.Random(seed)
+    runs = runs or max(1, nfiles // 20)
+    files = [LogicalFile('/lhcb/data/bench/{:08d}.dst'.format(i)) for i in range(nfiles)]
+    LHCbDataset.bookkeeping.update((f.lfn, make_metadata(f.lfn, rng, runs)) for f in files)
+    return LHCbDataset(files)
+
+
+def DiracSplitter(inputs, filesPerJob, maxFiles, ignoremissing):
+    for i in range(0, len(inputs.files), filesPerJob):
+        yield inputs.files[i:i + filesPerJob]
+
+
+# ----------------------------------------------------------------------------
+# ROOT merging
+
+# Cost model of a hadd process: startup (s) and per input file (s)
+HADD_STARTUP = 0.05
+HADD_PER_FILE = 0.002
+
+
+class _RootMergerImpl(object):
+    def __init__(self, args):
+        self.args = args
+
+    def mergefiles(self, inputs, output):
+        """Merge stand-in ROOT files (see generators.make_root_files) with a hadd-like cost."""
+        time.sleep(HADD_STARTUP + HADD_PER_FILE * len(inputs))
+        entries = {}
+        for fn in inputs:
+            if fn.startswith('root://'):  # read from the storage, as the fake ROOT
+                fn = os.path.join(_config['storage'], fn.split('//', 2)[2].lstrip('/'))
+            with open(fn) as f:
+                for name, n in json.load(f).items():
+                    entries[name] = entries.get(name, 0) + n
+        with open(output, 'w') as f:
+            json.dump(entries, f)
+
+
+class RootMerger(object):
+    def __init__(self, args=''):
+        self._impl = _RootMergerImpl(args)
+
+
+# ----------------------------------------------------------------------------
+
+def _module(name, **attrs):
+    module = sys.modules.get(name)
+    if module is None:
+        module = types.ModuleType(name)
+        sys.modules[name] = module
+        if '.' in name:
+            parent, child = name.rsplit('.', 1)
+            setattr(_module(parent), child, module)
+    module.__dict__.update(attrs)
+    return module
+
+
+def _getLogger(name=None):
+    return logging.getLogger(name or 'ganga')
+
+
+def install(workdir, latency=0.0, se_latency=None):
+    """
+    Install the stand-ins in sys.modules and the environment. workdir holds
+    the gangadir and the storage, latency is the latency (in seconds) of each
+    remote call and se_latency the latencies of the storage elements.
+    """
+    _config['gangadir'] = os.path.join(workdir, 'gangadir')
+    _config['storage'] = os.path.join(workdir, 'storage')
+    for d in [_config['gangadir'], _config['storage']]:
+        if not os.path.isdir(d):
+            os.makedirs(d)
+    set_latency(latency, se_latency)
+    os.environ['GUTILS_FAKE_STORAGE'] = _config['storage']
+    if not os.environ['PATH'].startswith(os.path.join(FAKE_ENV, 'bin')):
+        os.environ['PATH'] = os.path.join(FAKE_ENV, 'bin') + os.pathsep + os.environ['PATH']
+        os.environ['PYTHONPATH'] = os.pathsep.join([FAKE_ENV, ROOT_DIR] + [p for p in [os.environ.get('PYTHONPATH')] if p])
+    if ROOT_DIR not in sys.path:
+        sys.path.insert(0, ROOT_DIR)
+
+    class SplitterError(Exception):
+        pass
+
+    class _Schema(object):
+        def __init__(self):
+            self.datadict = {}
+
+        def inherit_copy(self):
+            return _Schema()
+
+    class IChecker(object):
+        _schema = _Schema()
+
+    registry = Registry()
+    _module('GangaCore.Utility.logging', getLogger=_getLogger,
+            _set_log_level=lambda logger, level: logger.setLevel(level))
+    _module('GangaCore.Utility.Config', getConfig=lambda section: {'gangadir': _config['gangadir']})
+    _module('GangaCore.Utility.files', expandfilename=os.path.expanduser)
+    _module('GangaCore.Utility.root', getrootprefix=None)
+    _module('GangaCore.Core.exceptions', SplitterError=SplitterError)
+    _module('GangaCore.GPIDev.Base.Proxy', GPIProxyObject=type('GPIProxyObject', (object,), {}),
+            stripProxy=lambda x: x)
+    _module('GangaCore.GPIDev.Lib.Job.Job', Job=Job)
+    _module('GangaCore.GPIDev.Lib.File', MassStorageFile=MassStorageFile, LocalFile=LocalFile)
+    _module('GangaCore.GPIDev.Adapters.IGangaFile', IGangaFile=IGangaFile)
+    _module('GangaCore.GPIDev.Adapters.IChecker', IChecker=IChecker)
+    _module('GangaCore.GPIDev.Schema', Schema=object, Version=object, SimpleItem=dict)
+    _module('GangaCore.GPI', jobs=registry, RootMerger=RootMerger, config={},
+            LHCbDataset=LHCbDataset, DiracFile=DiracFile, MassStorageFile=MassStorageFile, LocalFile=LocalFile)
+    _module('GangaDirac.Lib.Files.DiracFile', DiracFile=DiracFile)
+    _module('GangaDirac.Lib.Utilities.DiracUtilities', execute=execute)
+    _module('GangaDirac.Lib.Splitters.SplitterUtils', DiracSplitter=DiracSplitter)
+    _module('GangaLHCb.Lib.LHCbDataset.LHCbDataset', LHCbDataset=LHCbDataset, logger=_getLogger('LHCbDataset'))
+
+
+def set_latency(latency=0.0, se_latency=None, load_latency=0.0, location_latency=0.0):
+    """
+    Set the latency of remote calls (in this process and in the fake commands),
+    of loading a (sub)job and of MassStorageFile.location().
+    """
+    _config['latency'] = latency
+    _config['load_latency'] = load_latency
+    _config['location_latency'] = location_latency
+    os.environ['GUTILS_FAKE_LATENCY'] = str(latency)
+    os.environ['GUTILS_FAKE_SE_LATENCY'] = json.dumps(se_latency or {})
+
+
+def unload(registry):
+    """Unload the jobs of registry, as in a new session."""
+    for master in registry.jobs.values():
+        for job in [master] + list(master.subjobs):
+            job._loaded = False
+
+
+def set_registry(registry):
+    """Make registry the job registry (GangaCore.GPI.jobs)."""
+    sys.modules['GangaCore.GPI'].jobs = registry
@@ -0,0 +1,56 @@
+"""
+Generators of synthetic input files for the benchmarks.
+"""
+import os
+import json
+import random
+import struct
+
+# Size of the generic MDF header (three size words, checksum, compression, ...)
+MDF_HEADER_SIZE = 48
+
+
+def make_mdf_file(path, nevents, event_size=50000, seed=1):
+    """Write an MDF file of nevents records of about event_size bytes, return its size."""
+    rng = random.Random(seed)
+    payload = os.urandom(max(event_size * 2, 1))
+    size = 0
+    with open(path, 'wb') as f:
+        for _ in range(nevents):
+            n = max(MDF_HEADER_SIZE, int(rng.uniform(0.5, 1.5) * event_size))
+            f.write(struct.pack('<3I', n, n, n))
+            f.write(b'\0' * (MDF_HEADER_SIZE - 12))
+            f.write(payload[:n - MDF_HEADER_SIZE])
+            size += n
+    return size
+
+
+def make_mdf_files(directory, nfiles, file_size, event_size=50000, seed=1):
+    """Write nfiles MDF files of about file_size bytes each in directory, return their paths."""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    paths = []
+    for i in range(nfiles):
+        path = os.path.join(directory, 'input-{:05d}.mdf'.format(i))
+        make_mdf_file(path, max(1, file_size // event_size), event_size, seed + i)
+        paths.append(path)
+    return paths
+
+
+def make_root_file(path, entries):
+    """Write a stand-in ROOT file (read by fake_env/ROOT.py) with trees {"name": entries}."""
+    with open(path, 'w') as f:
+        json.dump(entries, f)
+
+
+def make_root_files(directory, nfiles, trees=('DecayTree', 'Dir/Lumi'), seed=1):
+    """Write nfiles stand-in ROOT files in directory, return their paths."""
+    rng = random.Random(seed)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    paths = []
+    for i in range(nfiles):
+        path = os.path.join(directory, 'input-{:05d}.root'.format(i))
+        make_root_file(path, dict((t, rng.randrange(1000)) for t in trees))
+        paths.append(path)
+    return paths
@@ -0,0 +1,481 @@
+"""
+Offline benchmarks of the hot paths of gutils and GangaLHCbExt.
+
+Ganga, DIRAC, the bookkeeping, the storage and ROOT are replaced by the
+local stand-ins of fakes.py and fake_env, with injected latencies, so the
+numbers measure our code (and its concurrency), not the grid. Each case
+reports wall times (median of --repeat runs) and the peak of the Python heap
+(tracemalloc, in a separate run), and is compared to a stored baseline:
+
+    python benchmarks/run.py                      # quick sizes, compare to baseline.json
+    python benchmarks/run.py --full               # large sizes (slow, needs several GB of disk)
+    python benchmarks/run.py -k merge --save-baseline
+
+Baselines are machine dependent, regenerate them on the reference machine.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import tracemalloc
+import contextlib
+from collections import OrderedDict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+import fakes
+import generators
+
+DEFAULT_BASELINE = os.path.join(HERE, 'baseline.json')
+
+# Metrics compared to the baseline, and the smallest differences considered (above the run-to-run noise)
+COMPARED = OrderedDict([('seconds', 0.1), ('peak_mb', 4.0)])
+
+BENCHMARKS = OrderedDict()  # {name: (function, quick sizes, full sizes)}
+
+
+def benchmark(quick, full):
+    """Register a benchmark function(workdir, size, metrics)."""
+    def decorator(function):
+        BENCHMARKS[function.__name__[len('bench_'):]] = (function, quick, full)
+        return function
+    return decorator
+
+
+@contextlib.contextmanager
+def measure(metrics, key='seconds'):
+    """Time the enclosed block into metrics[key] (and the heap peak if tracemalloc is tracing)."""
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        if hasattr(tracemalloc, 'reset_peak'):  # python >= 3.9
+            tracemalloc.reset_peak()
+        else:
+            tracemalloc.clear_traces()
+        before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    yield
+    metrics[key] = time.perf_counter() - start
+    if tracing:
+        peak = (tracemalloc.get_traced_memory()[1] - before) / 1e6
+        metrics['peak_mb'] = max(metrics.get('peak_mb', 0.0), peak)
+
+
+def _reset_caches():
+    """Forget the caches (in memory and in the gangadir) between cases."""
+    from GangaLHCbExt import BKMetadataCache
+    from gutils import download, output_index, root_utils
+    for module, name in [(BKMetadataCache, '_cache'), (download, '_url_cache'), (output_index, '_index')]:
+        cache = getattr(module, name)
+        if cache is not None:
+            cache.clear()
+        setattr(module, name, None)
+    root_utils._entries_cache.clear()
+    download._se_probes.clear()
+
+
+def _stage(paths):
+    """Put local files in the fake storage, return their LFNs."""
+    lfns = []
+    for path in paths:
+        lfn = '/lhcb/bench/' + os.path.basename(path)
+        dest = fakes.storage_path(lfn)
+        if not os.path.isdir(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+        shutil.move(path, dest)
+        lfns.append(lfn)
+    return lfns
+
+
+# ----------------------------------------------------------------------------
+# Splitting
+
+@benchmark(quick=[1000, 10000, 100000], full=[1000, 10000, 100000, 500000])
+def bench_splitter(workdir, size, metrics):
+    from GangaLHCbExt.DiracRunSplitter import DiracRunSplitter
+    dataset = fakes.make_dataset(size)
+    fakes.set_latency(0.01)
+    with measure(metrics):
+        subjobs = list(DiracRunSplitter(dataset, 50, None, False))
+    with measure(metrics, 'warm_seconds'):  # metadata from the cache
+        list(DiracRunSplitter(dataset, 50, None, False))
+    with measure(metrics, 'events_seconds'):
+        list(DiracRunSplitter(dataset, 50, None, False, eventsPerJob=1000000))
+    metrics['us_per_lfn'] = metrics['seconds'] / size * 1e6
+    metrics['subjobs'] = len(subjobs)
+
+
+# ----------------------------------------------------------------------------
+# Job selection and output files
+
+@benchmark(quick=[10000, 100000], full=[100000])
+def bench_select(workdir, size, metrics):
+    from gutils.utils import smart_jobs_select
+    masters = max(1, size // 1000)
+    fakes.set_registry(fakes.make_registry(masters, size // masters))
+    last = 1000 + masters - 1
+    specs = ['1000:{}'.format(last), '-1001', '-1000.1', '1000.1']
+    with measure(metrics):
+        jobs = smart_jobs_select(specs)
+    with measure(metrics, 'completed_fqids_seconds'):
+        smart_jobs_select(specs, status='completed', resolve=False)
+    metrics['selected'] = len(jobs)
+
+
+# Cost of loading a subjob (its output files) and of MassStorageFile.location() (s)
+LOAD_LATENCY = 0.0001
+LOCATION_LATENCY = 0.00005
+
+
+def _bench_outputfiles(size, metrics, file_type):
+    from gutils.utils import outputfiles
+    from gutils import output_index
+    registry = fakes.make_registry(max(1, size // 1000), min(size, 1000), file_type=file_type)
+    fakes.set_registry(registry)
+    masters = list(registry.jobs.values())
+    fakes.set_latency(load_latency=LOAD_LATENCY, location_latency=LOCATION_LATENCY)
+    with measure(metrics):  # builds the index
+        files = outputfiles(masters, '*.root')
+    with measure(metrics, 'warm_seconds'):
+        outputfiles(masters, '*.root')
+    output_index._index = None  # as a new session, reading the index from disk
+    fakes.unload(registry)
+    with measure(metrics, 'reopen_seconds'):
+        outputfiles(masters, '*.root')
+    fakes.unload(registry)
+    with measure(metrics, 'no_index_seconds'):
+        outputfiles(masters, '*.root', use_index=False)
+    metrics['files'] = len(files)
+
+
+@benchmark(quick=[1000, 20000], full=[20000])
+def bench_outputfiles(workdir, size, metrics):
+    _bench_outputfiles(size, metrics, 'DiracFile')
+
+
+@benchmark(quick=[1000], full=[20000])
+def bench_outputfiles_mass_storage(workdir, size, metrics):
+    _bench_outputfiles(size, metrics, 'MassStorageFile')
+
+
+@benchmark(quick=[1000], full=[20000])
+def bench_outputfiles_local(workdir, size, metrics):
+    _bench_outputfiles(size, metrics, 'LocalFile')
+
+
+@benchmark(quick=[20000], full=[20000])
+def bench_stats(workdir, size, metrics):
+    from gutils.stats import job_stats
+    registry = fakes.make_registry(max(1, size // 1000), min(size, 1000))
+    with measure(metrics):
+        job_stats(list(registry.jobs.values()))
+
+
+# ----------------------------------------------------------------------------
+# Downloads
+
+@benchmark(quick=[20], full=[200])
+def bench_download(workdir, size, metrics):
+    from gutils.download import download_files, DEFAULT_WORKERS
+    registry = fakes.make_registry(1, size, failed=0)
+    jobs = list(registry.jobs.values())[0].subjobs
+    for job in jobs:
+        path = fakes.storage_path(job.outputfiles[1].lfn)
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(os.urandom(1024 * 1024))
+    files = [(job, job.outputfiles[1]) for job in jobs]
+    fakes.set_latency(0.05)
+    for workers, key in [(1, 'serial_seconds'), (DEFAULT_WORKERS, 'seconds')]:
+        path = tempfile.mkdtemp(dir=workdir)
+        with measure(metrics, key):
+            download_files(files, path, workers=workers)
+    with measure(metrics, 'resume_seconds'):  # everything verified by the manifest
+        download_files(files, path, workers=DEFAULT_WORKERS)
+    with measure(metrics, 'stream_seconds'):  # streamed from the replicas (fake xrdcp)
+        download_files(files, tempfile.mkdtemp(dir=workdir), workers=DEFAULT_WORKERS, stream=True)
+
+
+@benchmark(quick=[8], full=[30])
+def bench_specs(workdir, size, metrics):
+    """size is the number of specs (masters of 5 subjobs), downloaded as gdownload does."""
+    from gutils.utils import smart_jobs_select
+    from gutils.download import download
+    from gutils.specs import run_specs
+    registry = fakes.make_registry(size, 5, failed=0)
+    fakes.set_registry(registry)
+    for master in registry.jobs.values():
+        for job in master.subjobs:
+            path = fakes.storage_path(job.outputfiles[1].lfn)
+            os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(os.urandom(256 * 1024))
+    specs = [str(i) for i in registry.jobs]
+    fakes.set_latency(0.05)
+
+    def process(spec):
+        path = tempfile.mkdtemp(dir=workdir)
+        return len(download(smart_jobs_select([spec]), 'job.root', path))
+
+    for parallel, key in [(1, 'serial_seconds'), (4, 'seconds')]:
+        with measure(metrics, key):
+            results = run_specs(specs, process, parallel=parallel)
+    metrics['ok'] = sum(r.ok for r in results)
+
+
+# ----------------------------------------------------------------------------
+# Helper processes
+
+def _helper_latency(metrics, request, close, n):
+    request()  # start the helper
+    with measure(metrics, 'warm_seconds'):
+        for _ in range(n):
+            request()
+    with measure(metrics, 'cold_seconds'):  # as with a new process per request
+        for _ in range(5):
+            close()
+            request()
+    metrics['warm_ms'] = metrics.pop('warm_seconds') / n * 1e3
+    metrics['cold_ms'] = metrics.pop('cold_seconds') / 5 * 1e3
+    metrics['seconds'] = metrics['warm_ms'] / 1e3
+
+
+@benchmark(quick=[50], full=[500])
+def bench_bk_session(workdir, size, metrics):
+    from gutils.bk_utils import BKSession
+    session = BKSession(client='bkclient:BookkeepingClient')
+    try:
+        _helper_latency(metrics, lambda: session.call('getRunsForFill(7000)'), session.close, size)
+    finally:
+        session.close()
+
+
+@benchmark(quick=[50], full=[500])
+def bench_root_helper(workdir, size, metrics):
+    from gutils import root_utils
+    path = generators.make_root_files(os.path.join(workdir, 'root'), 1)[0]
+
+    def request():
+        root_utils._entries_cache.clear()
+        root_utils.get_tree_entries(path)
+    _helper_latency(metrics, request, root_utils.get_helper().close, size)
+
+
+# ----------------------------------------------------------------------------
+# Tree entries
+
+@benchmark(quick=[200], full=[2000])
+def bench_tree_entries(workdir, size, metrics):
+    from gutils import root_utils
+    paths = generators.make_root_files(os.path.join(workdir, 'root'), size)
+    root_utils.get_tree_entries(paths[:1])  # start the helper
+    fakes.set_latency(0.01)  # per file opened, read by new helper processes
+    root_utils.get_helper().close()
+    root_utils.get_tree_entries(paths[:1])
+    root_utils._entries_cache.clear()
+    with measure(metrics, 'serial_seconds'):
+        root_utils.get_tree_entries(paths, processes=1)
+    root_utils._entries_cache.clear()
+    with measure(metrics):
+        root_utils.get_tree_entries(paths)
+    with measure(metrics, 'cached_seconds'):
+        root_utils.get_tree_entries(paths)
+    root_utils.get_helper().close()
+
+
+# ----------------------------------------------------------------------------
+# ROOT merging, with the hadd cost model of fakes.RootMerger
+
+@benchmark(quick=[100, 1000], full=[100, 1000, 10000])
+def bench_merge_root(workdir, size, metrics):
+    from gutils.merge import _merge_root
+    paths = generators.make_root_files(os.path.join(workdir, 'root'), size)
+    with measure(metrics, 'flat_seconds'):
+        _merge_root(paths, os.path.join(workdir, 'flat.root'), fanin=0)
+    with measure(metrics):
+        _merge_root(paths, os.path.join(workdir, 'hierarchical.root'))
+
+
+# ----------------------------------------------------------------------------
+# MDF merging
+
+@benchmark(quick=[256], full=[4096])
+def bench_merge_mdf_local(workdir, size, metrics):
+    """size is the total size of the inputs in MB."""
+    from gutils.merge import _concatenate
+    paths = generators.make_mdf_files(os.path.join(workdir, 'mdf'), 8, size * 1024 * 1024 // 8)
+    output = os.path.join(workdir, 'merged.mdf')
+    with measure(metrics, 'copyfileobj_seconds'):  # the previous implementation
+        with open(output, 'wb') as fout:
+            for path in paths:
+                with open(path, 'rb') as fin:
+                    shutil.copyfileobj(fin, fout)
+    os.remove(output)
+    with measure(metrics):
+        nbytes = _concatenate(paths, output)
+    metrics['mb_per_s'] = nbytes / 1e6 / metrics['seconds']
+
+
+@benchmark(quick=[256], full=[4096])
+def bench_mdf_scan(workdir, size, metrics):
+    """size is the size of the file in MB."""
+    from gutils.mdf_utils import count_events
+    path = os.path.join(workdir, 'input.mdf')
+    generators.make_mdf_file(path, size * 1024 * 1024 // 50000)
+    with measure(metrics):
+        metrics['events'] = count_events(path)
+
+
+@benchmark(quick=[16], full=[64])
+def bench_merge_mdf_stream(workdir, size, metrics):
+    from gutils import merge
+    paths = generators.make_mdf_files(os.path.join(workdir, 'mdf'), size, 4 * 1024 * 1024)
+    urls = ['root://se1.fake/' + lfn for lfn in _stage(paths)]
+    fakes.set_latency(0.2)
+    with measure(metrics, 'serial_seconds'):
+        merge._stream_concatenate(urls, os.path.join(workdir, 'serial.mdf'), prefetch=1)
+    with measure(metrics):
+        merge._stream_concatenate(urls, os.path.join(workdir, 'merged.mdf'))
+
+
+# ----------------------------------------------------------------------------
+# Access URLs and replicas
+
+@benchmark(quick=[1000], full=[10000])
+def bench_access_urls(workdir, size, metrics):
+    from gutils import download
+    lfns = []
+    for i in range(size):
+        lfn = '/lhcb/bench/urls/{:06d}.mdf'.format(i)
+        path = fakes.storage_path(lfn)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').close()
+        lfns.append(lfn)
+    fakes.set_latency(0.5, {'se1.fake': 0.3, 'se2.fake': 0.05})
+    with measure(metrics):
+        urls, failed = download.resolve_access_urls(lfns)
+    with measure(metrics, 'cached_seconds'):
+        download.resolve_access_urls(lfns)
+    with measure(metrics, 'rank_seconds'):
+        ranked = download.rank_replicas(urls)
+    metrics['fastest_se2'] = sum(u[0].startswith('root://se2.fake') for u in ranked.values()) == len(lfns)
+
+
+# ----------------------------------------------------------------------------
+
+def run_case(name, size, repeat, memory, keep):
+    function = BENCHMARKS[name][0]
+    results = OrderedDict()
+    timings = OrderedDict()  # {metric: [value of each run]}
+    runs = [False] * repeat + ([True] if memory else [])
+    for traced in runs:
+        workdir = tempfile.mkdtemp(prefix='gutils-bench-')
+        fakes.install(workdir)
+        _reset_caches()
+        metrics = OrderedDict()
+        if traced:
+            tracemalloc.start()
+        try:
+            function(workdir, size, metrics)
+        finally:
+            if traced:
+                tracemalloc.stop()
+            fakes.set_latency(0.0)
+            _reset_caches()
+            if not keep:
+                shutil.rmtree(workdir, ignore_errors=True)
+        if traced:
+            peak = metrics.get('peak_mb', 0.0)
+        else:
+            for key, value in metrics.items():
+                if key != 'peak_mb':
+                    timings.setdefault(key, []).append(value)
+    # keep the median of the measurements (robust to a slow run), and the last value of counts
+    for key, values in timings.items():
+        results[key] = statistics.median(values) if isinstance(values[0], float) else values[-1]
+    if memory:
+        results['peak_mb'] = peak
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return the list of regressions of results with respect to baseline."""
+    regressions = []
+    for case, metrics in results.items():
+        for key, min_diff in COMPARED.items():
+            if key not in metrics or key not in baseline.get(case, {}):
+                continue
+            old, new = baseline[case][key], metrics[key]
+            if new > old * (1 + tolerance) and new - old > min_diff:
+                regressions.append('{} {}: {:.3f} -> {:.3f} ({:+.0%})'.format(case, key, old, new, new / old - 1))
+    return regressions
+
+
+def _format(value):
+    if isinstance(value, float):
+        return '{:.4g}'.format(value)
+    return str(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks of gutils and GangaLHCbExt')
+    parser.add_argument('-k', dest='select', action='append', help='Only run benchmarks whose name contains this (can be repeated)')
+    parser.add_argument('--full', action='store_true', help='Run the full sizes (slow, needs several GB of disk)')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs per case, the median is kept (default: %(default)s)')
+    parser.add_argument('--no-memory', action='store_true', help='Do not measure the memory peak (one run less per case)')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='Baseline file (default: %(default)s)')
+    parser.add_argument('--save-baseline', action='store_true', help='Store the results (of the cases run) in the baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='Relative slow-down/memory increase considered a regression (default: %(default)s)')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    parser.add_argument('--keep', action='store_true', help='Keep the working directories')
+    parser.add_argument('--list', action='store_true', help='List the benchmarks')
+    args = parser.parse_args()
+
+    if args.list:
+        for name, (function, quick, full) in BENCHMARKS.items():
+            print('{:20} quick {} full {}'.format(name, quick, full))
+        return 0
+
+    import logging
+    logging.basicConfig(level=logging.ERROR)
+
+    results = OrderedDict()
+    for name, (function, quick, full) in BENCHMARKS.items():
+        if args.select and not any(s in name for s in args.select):
+            continue
+        for size in (full if args.full else quick):
+            case = '{}[{}]'.format(name, size)
+            results[case] = run_case(name, size, args.repeat, not args.no_memory, args.keep)
+            print('{:28} '.format(case) + '  '.join('{}={}'.format(k, _format(v)) for k, v in results[case].items()))
+            sys.stdout.flush()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(OrderedDict(sorted(baseline.items())), f, indent=2)
+            f.write('\n')
+        print('Baseline saved to {}'.format(args.baseline))
+        return 0
+
+    regressions = compare(results, baseline, args.tolerance)
+    for r in regressions:
+        print('REGRESSION ' + r)
+    if baseline:
+        print('{} regression(s) with respect to {}'.format(len(regressions), args.baseline))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+import os
+import sys
+import json
+import atexit
+import threading
+import datetime
+
+try:
+    from .worker import WorkerSession, WorkerError, serve
+except ImportError:  # run as the helper script
+    from worker import WorkerSession, WorkerError, serve
+
+DIRAC_PREFIX = ['lb-run', 'LHCbDirac']
+DEFAULT_CLIENT = 'LHCbDIRAC.BookkeepingSystem.Client.BookkeepingClient:BookkeepingClient'
+DATA_MANAGER = 'DIRAC.DataManagementSystem.Client.DataManager:DataManager'
+
+
+class BKSessionError(WorkerError):
+    pass
+
+
+def _run(client, cmd):
+    """Run a single command (e.g. 'getRunsForFill(1234)') and return (ok, value or message)."""
+    try:
+        result = eval('client.' + cmd, {'client': client})
+    except Exception as e:
+        return False, '{}: {}'.format(type(e).__name__, e)
+    if isinstance(result, dict) and 'OK' in result:  # S_OK/S_ERROR structure
+        if not result['OK']:
+            return False, result.get('Message', '')
+        result = result['Value']
+    return True, result
+
+
+_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def _plain(obj):
+    """
+    Return obj made of JSON types: sets and tuples become lists, datetimes
+    {"__datetime__": ...}, dictionaries with other keys than strings
+    {"__items__": [[key, value], ...]} and other objects their str().
+    """
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+    if isinstance(obj, dict):
+        if all(isinstance(k, str) for k in obj):
+            return dict((k, _plain(v)) for k, v in obj.items())
+        return {'__items__': [[_plain(k), _plain(v)] for k, v in obj.items()]}
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return [_plain(x) for x in obj]
+    if isinstance(obj, datetime.datetime):
+        return {'__datetime__': obj.strftime(_DATETIME_FORMAT)}
+    return str(obj)
+
+
+def _object_hook(obj):
+    if '__datetime__' in obj:
+        return datetime.datetime.strptime(obj['__datetime__'], _DATETIME_FORMAT)
+    if '__items__' in obj:
+        return dict((tuple(k) if isinstance(k, list) else k, v) for k, v in obj['__items__'])
+    return obj
+
+
+def _dumps(obj):
+    return json.dumps(_plain(obj))
+
+
+def _loads(s):
+    return json.loads(s, object_hook=_object_hook)
+
+
+class BKSession(WorkerSession):
+    """
+    Client of a long-lived helper process that keeps a BookkeepingClient (or
+    another DIRAC client, e.g. DATA_MANAGER) alive.
+
+    Requests are pipelined: several threads can have requests in flight, and
+    each request can be a batch of commands, e.g.
+
+        session = BKSession()
+        runs, info = session.batch(['getRunsForFill(7000)',
+                                    'getRunInformation({"RunNumber": [200000]})'])
+
+    The helper is (re)started on demand, e.g. after a timeout or a crash.
+    """
+    error = BKSessionError
+
+    def __init__(self, command=None, timeout=120, client=DEFAULT_CLIENT):
+        super(BKSession, self).__init__(
+            command or DIRAC_PREFIX + ['python', os.path.abspath(__file__), '--client', client], timeout=timeout)
+
+    def dumps(self, obj):
+        return _dumps(obj)
+
+    def loads(self, s):
+        return _loads(s)
+
+    def batch(self, cmds, timeout=None, tries=3):
+        """Run a list of commands in one round trip and return the list of their results."""
+        results = self.request(list(cmds), timeout=timeout, tries=tries)
+        values = []
+        for cmd, (ok, value) in zip(cmds, results):
+            if not ok:
+                raise BKSessionError('{} failed: {}'.format(cmd, value))
+            values.append(value)
+        return values
+
+    def call(self, cmd, timeout=None, tries=3):
+        """Run a single command and return its result."""
+        return self.batch([cmd], timeout=timeout, tries=tries)[0]
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(client=DEFAULT_CLIENT):
+    """Return the default (shared) session of a client."""
+    with _sessions_lock:
+        if client not in _sessions:
+            _sessions[client] = BKSession(client=client)
+            atexit.register(_sessions[client].close)
+    return _sessions[client]
+
+
+def _load_client(spec):
+    module, name = spec.split(':')
+    if module.split('.')[0] in ['DIRAC', 'LHCbDIRAC']:
+        from DIRAC.Core.Base import Script
+        Script.parseCommandLine(ignoreErrors=True)
+    return getattr(__import__(module, fromlist=[name]), name)()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Bookkeeping helper (serves requests on stdin)')
+    parser.add_argument('--client', default=DEFAULT_CLIENT, help='module:Class of the client')
+    args = parser.parse_args()
+    sys.argv = sys.argv[:1]  # do not confuse the DIRAC command line parsing
+    client = _load_client(args.client)
+    serve(lambda cmds: [_run(client, cmd) for cmd in cmds], sys.stdin, sys.stdout,
+          _dumps, _loads)
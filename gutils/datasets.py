@@ -1,10 +1,13 @@
 import os
 import re
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import GangaCore
-from GangaCore.GPI import (
-    diracAPI, BKQuery, LHCbDataset, MassStorageFile, DiracFile)
-from GangaDirac.Lib.Utilities.DiracUtilities import GangaDiracError
+from GangaCore.GPI import BKQuery, LHCbDataset, MassStorageFile, DiracFile
+from GangaLHCbExt.BKMetadataCache import bkMetadataCached, bkMetadataResult
+from .bk_utils import get_session
+from .profiling import profiled
 
 
 # Disable the info message from LHCbDataset.bkMetadata()
@@ -20,6 +23,10 @@ STREAM_ID = {
     'EXPRESS': ['91000000', '91000001'],
 }
 
+# Number of runs per bookkeeping query and number of concurrent queries
+RUNS_PER_QUERY = 20
+WORKERS = 8
+
 
 def chunks(l, n):
     """Yield successive n-sized chunks from l."""
@@ -27,34 +34,52 @@ def chunks(l, n):
         yield l[i:i + n]
 
 
+@profiled()
 def bkAPI(cmd, timeout=120, tries=3):
-    for i in range(tries):
-        try:
-            result = diracAPI(
-                'from LHCbDIRAC.BookkeepingSystem.Client.BookkeepingClient import BookkeepingClient; '
-                'output(BookkeepingClient().{})'.format(cmd), timeout=timeout)
-            return result
-        except GangaDiracError as e:
-            if e.message != 'DIRAC command timed out':
-                raise
-    raise RuntimeError('Command timed out {} times! Increase timeout.'.format(tries))
-
-
-def bkMetadata(dataset):
-    """Return the metadata for a dataset."""
+    """Run a BookkeepingClient command, e.g. bkAPI('getRunsForFill(1234)')."""
+    return get_session().call(cmd, timeout=timeout, tries=tries)
+
+
+@profiled()
+def bkAPI_batch(cmds, timeout=120, tries=3):
+    """Run a list of BookkeepingClient commands in one round trip."""
+    return get_session().batch(cmds, timeout=timeout, tries=tries)
+
+
+@profiled()
+def bkMetadata(dataset, cached=False):
+    """
+    Return the metadata for a dataset, {lfn: metadata}, the full bookkeeping
+    records. With cached, the local metadata cache is used and only its fields
+    are returned (see GangaLHCbExt.BKMetadataCache.FIELDS).
+    """
     if not isinstance(dataset, LHCbDataset):
         raise TypeError('Expect an LHCbDataset object')
-    m = dataset.bkMetadata()
-    if m['Failed']:
-       logger.error(m)
+    if cached:
+        successful, failed = bkMetadataCached(dataset)
+    else:
+        successful, failed = bkMetadataResult(dataset.bkMetadata())
+    if failed:
+       logger.error('Failed to get metadata for {}'.format(failed))
        raise RuntimeError("bkMetadata call failed")
-    return m['Successful']
+    return successful
 
 
 def _getRunInformation(in_dict):
     return bkAPI("getRunInformation({})".format(repr(in_dict)))
 
 
+def _query_runs(runs, stream):
+    """Return (dataset, metadata) of the RAW files of a stream for a range of runs."""
+    path = '/{}-{}/Real Data/{}/RAW'.format(min(runs), max(runs), stream)
+    logger.info('BK query: {}'.format(path))
+    query = BKQuery(dqflag='All', type='Run', path=path)
+    # TODO use LHCbCompressedDataset instead
+    ds = query.getDataset(compressed=False)
+    return ds, bkMetadata(ds, cached=True)  # only the run numbers are used
+
+
+@profiled()
 def get_raw_dataset_runs(runs, streams, warn=True):
     if not runs:
         return LHCbDataset()
@@ -63,32 +88,33 @@ def get_raw_dataset_runs(runs, streams, warn=True):
 
     log = logger.warning if warn else logger.info
 
-    m = {}
+    # Query all streams concurrently, in chunks of runs
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        futures = [(stream, pool.submit(_query_runs, subruns, stream))
+                   for stream in streams for subruns in chunks(runs, RUNS_PER_QUERY)]
+        files = {stream: defaultdict(list) for stream in streams}  # {stream: {run: [files]}}
+        for stream, future in futures:
+            ds, m = future.result()
+            for f in ds.files:
+                files[stream][m[f.lfn]['RunNumber']].append(f)
+
+    # For each run, take the files from the first stream that has any
     ds = LHCbDataset()
-    for subruns in chunks(runs, 20):
-        path = '/{}-{}/Real Data/{}/RAW'.format(min(subruns), max(subruns), streams[0])
-        logger.info('BK query: {}'.format(path))
-        query = BKQuery(dqflag='All', type='Run', path=path)
-        ds.files += query.getDataset(compressed=False).files
-        # TODO use LHCbCompressedDataset instead
-        m.update(bkMetadata(ds))
-
-    # Select only the files corresponding to requested runs
-    try:
-        ds.files = [f for f in ds.files if m[f.lfn]['RunNumber'] in runs]
-    except:
-        import pdb; pdb.set_trace()
-    # Check if there are remaining runs and if so use the next stream
-    runs_out = set(x['RunNumber'] for x in m.values())
-    runs_remain = list(set(runs) - runs_out)
-    if runs_remain:
-        if len(streams) > 1:
-            logger.info('Files for run(s) {} not found in stream {}'.
-                        format(runs_remain, streams[0]))
-            ds_remain = get_raw_dataset_runs(runs_remain, streams[1:], warn=warn)
-            ds.files = ds.files + ds_remain.files
+    selected = []
+    runs_remain = []
+    for run in runs:
+        for stream in streams:
+            if files[stream][run]:
+                if stream != streams[0]:
+                    logger.info('Files for run {} not found in stream {}, using stream {}'.
+                                format(run, streams[0], stream))
+                selected += files[stream][run]
+                break
         else:
-            log('Files for run(s) {} not found in any of the streams'.format(runs_remain))
+            runs_remain.append(run)
+    ds.files = selected
+    if runs_remain:
+        log('Files for run(s) {} not found in any of the streams'.format(runs_remain))
     return ds
 
 
@@ -1,17 +1,47 @@
 import os
+import json
+import zlib
 import shutil
+import sqlite3
 import time
 import tempfile
+import threading
 import subprocess
+from urllib.parse import urlparse
+from concurrent.futures import Future
 
 import GangaDirac
 import GangaCore
 from GangaCore.GPIDev.Base.Proxy import GPIProxyObject
 from GangaCore.GPIDev.Adapters.IGangaFile import IGangaFile
+from GangaCore.Utility.Config import getConfig
+from GangaCore.Utility.files import expandfilename
 from .utils import ganga_type, outputfiles
+from .output_index import OutputEntry, make_entry
+from .profiling import profiled, span
+from .specs import ContextExecutor
 
 logger = GangaCore.Utility.logging.getLogger('gutils.download')
 
+# Default number of concurrent downloads
+DEFAULT_WORKERS = 4
+
+# Name of the manifest of verified files in a download directory
+MANIFEST_NAME = '.gdownload-manifest.jsonl'
+
+# Resolution of LFNs to access URLs: LFNs per call, concurrent calls and cache lifetime (seconds)
+URL_CHUNK_SIZE = 100
+URL_WORKERS = 4
+URL_CACHE_TTL = 24 * 3600
+# Storage elements are probed again after PROBE_TTL (seconds)
+PROBE_TTL = 3600
+
+# Bytes read to probe the speed of a storage element
+PROBE_SIZE = 1024 * 1024
+
+# Block size of streamed downloads (checksummed while written)
+DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+
 
 def get_file(file, path):
     if any(x in file.namePattern for x in ['*', '?', '[', ']']):
@@ -24,7 +54,7 @@ def get_file(file, path):
         localdir, basename = os.path.split(path)
         if not os.path.isdir(localdir):
             raise ValueError('Directory "{}" does not exist.'.format(localdir))
-        file.localDir = tempfile.mkdtemp()
+        file.localDir = tempfile.mkdtemp(dir=localdir, prefix='.tmp-')  # same fs for rename
         file.get()
         os.rename(os.path.join(file.localDir, file.namePattern), path)
         os.rmdir(file.localDir)
@@ -33,35 +63,305 @@ def get_file(file, path):
     return fn
 
 
-def download_files(files, path, parallel=True, block=True):
+def _adler32_hex(value):
+    return '{:08x}'.format(value & 0xffffffff)
+
+
+@profiled()
+def adler32(path, blocksize=DOWNLOAD_BLOCK_SIZE):
+    """Return the Adler32 checksum of a file as a hex string (as in DIRAC)."""
+    value = 1
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            value = zlib.adler32(block, value)
+    return _adler32_hex(value)
+
+
+def stream_to_file(urls, path, blocksize=DOWNLOAD_BLOCK_SIZE):
+    """
+    Copy the first readable of urls (replicas of a file) to path, computing the
+    size and Adler32 while writing, and return (size, adler32). The file is
+    written under a temporary name and renamed once complete.
+    """
+    tmp = path + '.part'
+    errors = []
+    for url in urls:
+        value, size = 1, 0
+        try:
+            with StreamReader(url) as reader, open(tmp, 'wb') as f:
+                for block in iter(lambda: reader.read(blocksize), b''):
+                    f.write(block)
+                    value = zlib.adler32(block, value)
+                    size += len(block)
+        except (IOError, OSError) as e:
+            logger.debug('Download from {} failed: {}'.format(url, e))
+            errors.append('{}: {}'.format(url, e))
+            continue
+        os.rename(tmp, path)
+        return size, _adler32_hex(value)
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    raise IOError('Could not read any replica ({})'.format('; '.join(errors)))
+
+
+def _same_checksum(a, b):
+    return int(a, 16) == int(b, 16)
+
+
+def _source(file):
+    """Return the LFN or URL a file object refers to."""
+    file_type = ganga_type(file)
+    if issubclass(file_type, GangaDirac.Lib.Files.DiracFile.DiracFile):
+        return file.lfn
+    elif issubclass(file_type, GangaCore.GPIDev.Lib.File.MassStorageFile):
+        return file.location()[0]
+    return file.namePattern
+
+
+class Manifest(object):
+    """
+    Record of the verified files in a download directory (fqid, source, size and
+    Adler32 of each file), kept as a JSON lines file which is appended to.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.join(path, MANIFEST_NAME)
+        self.entries = {}
+        self._lock = threading.Lock()
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # e.g. truncated by an interruption
+                    self.entries[entry['name']] = entry
+
+    def record(self, path, fqid, source, size, checksum):
+        entry = {'name': os.path.basename(path), 'fqid': fqid, 'source': source,
+                 'size': size, 'adler32': checksum}
+        with self._lock:
+            self.entries[entry['name']] = entry
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+    def verify(self, path):
+        """Return 'ok', 'missing' or 'corrupt' for a file in the download directory."""
+        entry = self.entries.get(os.path.basename(path))
+        if not entry or not os.path.isfile(path):
+            return 'missing'
+        if os.path.getsize(path) != entry['size'] or not _same_checksum(adler32(path), entry['adler32']):
+            return 'corrupt'
+        return 'ok'
+
+
+class DownloadResult(object):
+    """Outcome of the download of a single file (skipped if already downloaded and verified)."""
+
+    def __init__(self, source, path):
+        self.source = source
+        self.path = path
+        self.ok = False
+        self.skipped = False
+        self.bytes = 0
+        self.duration = 0.0
+        self.attempts = 0
+        self.error = None
+
+    def __repr__(self):
+        if self.ok:
+            return '<DownloadResult {} ok {} bytes in {:.1f} s>'.format(self.path, self.bytes, self.duration)
+        return '<DownloadResult {} failed after {} attempt(s): {}>'.format(self.path, self.attempts, self.error)
+
+
+class DownloadEngine(object):
+    """
+    Download files with a bounded pool of worker threads.
+
+    Each submitted file gives a future of a DownloadResult. Files submitted
+    with the URLs of their replicas are streamed (see stream_to_file), and
+    fetched with file.get() if no replica can be read. Other files are fetched
+    with file.get(). Failed downloads are retried (with exponential backoff) up
+    to retries times. If a manifest is given, downloaded files are checked
+    against the expected (size, adler32) given to submit (when known) and
+    recorded in the manifest. With resume, files already verified by the
+    manifest are skipped (verified in the worker threads).
+
+        with DownloadEngine(workers=8) as engine:
+            futures = [engine.submit(file, fn) for file, fn in ...]
+        results = [f.result() for f in futures]
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, retries=2, backoff=5.0, manifest=None, resume=False):
+        self.workers = workers
+        self.manifest = manifest
+        self.resume = resume
+        self.retries = retries
+        self.backoff = backoff
+        self.results = []
+        self._pool = ContextExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self._start = None
+        self._end = None
+
+    def _download(self, file, path, fqid, urls, expected):
+        result = DownloadResult(file, path)
+        if self.manifest and self.resume and self.manifest.verify(path) == 'ok':
+            result.ok = result.skipped = True
+            return result
+        start = time.time()
+        expected_size, expected_checksum = expected or (None, None)
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            result.attempts += 1
+            try:
+                with span('download.get_file') as s:
+                    size = checksum = None
+                    if urls:
+                        try:
+                            size, checksum = stream_to_file(urls, path)
+                        except IOError as e:
+                            logger.info('Cannot stream {!r}, getting it with DIRAC: {}'.format(file, e))
+                            urls = None  # do not try the same replicas again
+                    if size is None:
+                        get_file(file, path)
+                        if not os.path.isfile(path):
+                            raise IOError('File not found after download')
+                        size, checksum = os.path.getsize(path), None
+                    s.set(bytes=size)
+                if self.manifest:
+                    if checksum is None:  # fetched by file.get(), read it back
+                        checksum = adler32(path)
+                    if ((expected_size is not None and size != expected_size) or
+                            (expected_checksum and not _same_checksum(checksum, expected_checksum))):
+                        os.remove(path)
+                        raise IOError('Size/checksum mismatch ({}/{} instead of {}/{})'.format(
+                            size, checksum, expected_size, expected_checksum))
+                    self.manifest.record(path, fqid, _source(file), size, checksum)
+            except Exception as e:
+                result.error = e
+                logger.debug('Attempt {} to download {!r} failed: {}'.format(result.attempts, file, e))
+                continue
+            result.ok = True
+            result.error = None
+            result.bytes = os.path.getsize(path)
+            break
+        result.duration = time.time() - start
+        with self._lock:
+            self.results.append(result)
+            self._end = time.time()
+        return result
+
+    def submit(self, file, path, fqid=None, urls=None, expected=None):
+        """
+        Schedule the download of file to path (streamed from the replicas urls,
+        if given) and return a future of a DownloadResult. expected is the
+        (size, adler32) the download is checked against, if known.
+        """
+        if self._start is None:
+            self._start = time.time()
+        return self._pool.submit(self._download, file, path, fqid, urls, expected)
+
+    def wait(self):
+        """Wait for all submitted downloads to finish."""
+        self._pool.shutdown(wait=True)
+
+    def throughput(self):
+        """Return (bytes, seconds, bytes per second) of the successful downloads so far."""
+        with self._lock:
+            nbytes = sum(r.bytes for r in self.results if r.ok)
+            elapsed = (self._end - self._start) if self._end else 0.0
+        return nbytes, elapsed, (nbytes / elapsed if elapsed else 0.0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.wait()
+
+
+def _download_path(job, file, path):
+    root, ext = os.path.splitext(file.namePattern)
+    return os.path.join(path, '{}-{}{}'.format(root, job.fqid, ext))
+
+
+def _dirac_lfns(files):
+    """Return the LFNs of the DiracFiles in files ([(job, file), ...])."""
+    return [f.lfn for _, f in files
+            if issubclass(ganga_type(f), GangaDirac.Lib.Files.DiracFile.DiracFile) and f.lfn]
+
+
+def _download_replicas(lfns):
+    """
+    Return {lfn: [url, ...]} (fastest first) for lfns. LFNs which cannot be
+    resolved are left out, they are fetched with file.get().
+    """
+    if not lfns:
+        return {}
+    urls, failed = resolve_access_urls(lfns)
+    if failed:
+        logger.info('No access URL for {} files, will use DIRAC to get them'.format(len(failed)))
+    return rank_replicas(urls)
+
+
+@profiled()
+def download_files(files, path, parallel=True, workers=DEFAULT_WORKERS, retries=2, resume=True, overwrite=False,
+                   stream=False):
+    """
+    Download files ([(job, file), ...]) to the directory path.
+    With resume, a manifest of the verified files is kept in path and files
+    already verified by it are not downloaded again, unless overwrite.
+    With stream, DiracFiles are streamed from their fastest replica and
+    checksummed while written, instead of fetched with file.get().
+    """
     if not os.path.isdir(path):
         raise ValueError('Path must be existing directory.')
 
-    filenames = []
-    for job, file in files:
-        root, ext = os.path.splitext(file.namePattern)
-        fn = os.path.join(path, '{}-{}{}'.format(root, job.fqid, ext))
-        filenames.append((file, fn))
-        if parallel:
-            GangaCore.GPI.queues.add(get_file, args=(file, fn))
-        else:
-            get_file(file, fn)
-
-    if parallel and block:
-        while GangaCore.GPI.queues.totalNumUserThreads():
-            time.sleep(2)
+    lfns = _dirac_lfns(files)
+    replicas = _download_replicas(lfns) if stream else {}
+    metadata = resolve_metadata(lfns) if resume else {}
+    downloaded, skipped = [], 0
+    manifest = Manifest(path) if resume else None
+    with DownloadEngine(workers=workers if parallel else 1, retries=retries, manifest=manifest,
+                        resume=not overwrite) as engine:
+        futures = []
+        for job, file in files:
+            lfn = getattr(file, 'lfn', None)
+            futures.append(engine.submit(file, _download_path(job, file, path), job.fqid,
+                                         replicas.get(lfn), metadata.get(lfn)))
 
-    downloaded = []
-    for src, fn in filenames:
-        if os.path.isfile(fn):
-            downloaded.append(fn)
+    for future in futures:
+        result = future.result()
+        if result.ok:
+            downloaded.append(result.path)
+            skipped += result.skipped
         else:
-            logger.warning('File {!r} could not be downloaded'.format(src))
-    # if len(downloaded) < len(filenames):
+            logger.warning('File {!r} could not be downloaded: {}'.format(result.source, result.error))
+    if skipped:
+        logger.info('Skipped {} already downloaded and verified files'.format(skipped))
+    nbytes, elapsed, rate = engine.throughput()
+    logger.info('Downloaded {}/{} files ({:.1f} MB) in {:.1f} s ({:.1f} MB/s)'.format(
+        len(downloaded), len(files), nbytes / 1e6, elapsed, rate / 1e6))
+    # if len(downloaded) < len(files):
     #     raise RuntimeError('Not all files could be downloaded')
     return downloaded
 
 
+def verify_files(files, path):
+    """
+    Check the files ([(job, file), ...]) in the download directory path against
+    its manifest, without downloading anything.
+    Return a dictionary {'ok': [...], 'missing': [...], 'corrupt': [...]} of file names.
+    """
+    manifest = Manifest(path)
+    status = {'ok': [], 'missing': [], 'corrupt': []}
+    for job, file in files:
+        fn = _download_path(job, file, path)
+        status[manifest.verify(fn)].append(fn)
+    return status
+
+
 def download(jobs, name, path, ignore_missing=True, **kwargs):
     if any(x in name for x in ['*', '?', '[', ']']):
         raise ValueError('Wildcard characters in name not supported.')
@@ -69,8 +369,15 @@ def download(jobs, name, path, ignore_missing=True, **kwargs):
     return download_files(files, path, **kwargs)
 
 
+def verify(jobs, name, path, ignore_missing=True):
+    """Verify previously downloaded files (see verify_files)."""
+    files = outputfiles(jobs, name, one_per_job=True, ignore_missing=ignore_missing)
+    return verify_files(files, path)
+
+
 def download_temp(jobs, name, ignore_missing=True, keep_temp=False, **kwargs):
     tempdir = tempfile.mkdtemp(prefix='download_temp-{}-'.format(name))
+    kwargs.setdefault('resume', False)  # nothing to resume in a new directory
     filenames = download(jobs, name, tempdir, ignore_missing=ignore_missing, **kwargs)
     if not filenames:
         raise RuntimeError('No files found for given job(s). Check the name pattern.')
@@ -83,63 +390,306 @@ def download_temp(jobs, name, ignore_missing=True, keep_temp=False, **kwargs):
     return TempFileList(filenames)
 
 
-def dirac_get_access_urls(lfns):
-    if isinstance(lfns, str):
-        lfns = [lfns]
-    if not lfns:
-        return {}
+class AccessURLError(RuntimeError):
+    """Some LFNs could not be resolved, failed is {lfn: reason}."""
 
-    opts = '--Protocol xroot,root'
-    cmd = 'dirac-dms-lfn-accessURL {} {}'.format(','.join(lfns), opts)
-    # from GangaDirac.Lib.Utilities.DiracUtilities import execute
-    # output = execute(cmd, shell=True)
-    import subprocess
-    output = subprocess.check_output(['lb-run', 'LHCbDirac'] + cmd.split())
-    urls = {}
+    def __init__(self, failed):
+        super(AccessURLError, self).__init__(
+            'Cannot access {} file(s): {}'.format(len(failed), ', '.join(sorted(failed))))
+        self.failed = failed
+
+
+class AccessURLCache(object):
+    """SQLite backed cache of the access URLs (all replicas) of LFNs, with a time to live."""
+
+    def __init__(self, path, ttl=URL_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS replicas (lfn TEXT PRIMARY KEY, urls TEXT, created REAL)')
+
+    def lookup(self, lfns):
+        """Return {lfn: [url, ...]} for the LFNs found in the cache (and not expired)."""
+        found = {}
+        lfns = list(set(lfns))
+        with self._lock:
+            for i in range(0, len(lfns), 500):
+                chunk = lfns[i:i + 500]
+                rows = self._conn.execute(
+                    'SELECT lfn, urls FROM replicas WHERE created >= ? AND lfn IN ({})'.format(', '.join('?' * len(chunk))),
+                    [time.time() - self.ttl] + chunk)
+                found.update((lfn, json.loads(urls)) for lfn, urls in rows)
+        return found
+
+    def store(self, urls):
+        """Add {lfn: [url, ...]} to the cache."""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO replicas VALUES (?, ?, ?)',
+                                   [(lfn, json.dumps(u), now) for lfn, u in urls.items()])
+            self._conn.execute('DELETE FROM replicas WHERE created < ?', [now - self.ttl])
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM replicas')
+
+
+_url_cache = None
+_url_cache_lock = threading.Lock()
+
+
+def get_url_cache():
+    """Return the default access URL cache, stored in the gangadir."""
+    global _url_cache
+    with _url_cache_lock:
+        if _url_cache is None:
+            gangadir = expandfilename(getConfig('Configuration')['gangadir'])
+            _url_cache = AccessURLCache(os.path.join(gangadir, 'access_urls.sqlite'))
+    return _url_cache
+
+
+def _parse_access_urls(output, lfns):
+    """Return ({lfn: [url, ...]}, {lfn: reason}) from the output of dirac-dms-lfn-accessURL."""
+    urls, failed = {}, {}
     for line in output.splitlines():
         items = [x.strip() for x in line.split(':', 1)]
-        if len(items) < 2 or items[0][0] != '/':
+        if len(items) < 2 or not items[0] or items[0][0] != '/' or not items[1]:
             continue
         k, v = items
         if k not in lfns:
             logger.warning('Unexpected key (LFN) in output of dirac-dms-lfn-accessURL: ' + k)
         elif 'file not found' in v.lower():
-            logger.error('File not found in the bookkeeping: ' + k)
-        elif k not in urls:
-            urls[k] = v
-    return urls
+            failed[k] = 'File not found in the bookkeeping'
+        elif v not in urls.setdefault(k, []):
+            urls[k].append(v)
+    for lfn in lfns:
+        if lfn not in urls and lfn not in failed:
+            failed[lfn] = 'No available replica'
+    return urls, failed
 
 
-def get_access_urls(files):
-    urls = [None] * len(files)
+# Bounds the concurrent calls to dirac-dms-lfn-accessURL of the whole process (e.g. of concurrent specs)
+_dirac_calls = threading.BoundedSemaphore(URL_WORKERS)
+
+
+def _dirac_access_urls_chunk(lfns):
+    opts = '--Protocol xroot,root'
+    cmd = 'dirac-dms-lfn-accessURL {} {}'.format(','.join(lfns), opts)
+    # from GangaDirac.Lib.Utilities.DiracUtilities import execute
+    # output = execute(cmd, shell=True)
+    try:
+        with _dirac_calls:
+            output = subprocess.check_output(['lb-run', 'LHCbDirac'] + cmd.split(), universal_newlines=True)
+    except (subprocess.CalledProcessError, OSError) as e:
+        return {}, dict((lfn, str(e)) for lfn in lfns)
+    return _parse_access_urls(output, set(lfns))
+
+
+@profiled()
+def resolve_access_urls(lfns, cache=True):
+    """
+    Return ({lfn: [url, ...]}, {lfn: reason}) with the URLs of all replicas of
+    the given LFNs. The LFNs which are not cached are resolved in chunks of
+    URL_CHUNK_SIZE with up to URL_WORKERS concurrent calls to dirac-dms-lfn-accessURL.
+    """
+    if isinstance(lfns, str):
+        lfns = [lfns]
+    urls = get_url_cache().lookup(lfns) if cache else {}
+    todo = sorted(set(lfns) - set(urls))
+    failed = {}
+    if todo:
+        logger.info('Resolving access URLs of {} files ({} cached)'.format(len(todo), len(urls)))
+        chunks = [todo[i:i + URL_CHUNK_SIZE] for i in range(0, len(todo), URL_CHUNK_SIZE)]
+        with ContextExecutor(max_workers=URL_WORKERS) as pool:
+            for chunk_urls, chunk_failed in pool.map(_dirac_access_urls_chunk, chunks):
+                urls.update(chunk_urls)
+                failed.update(chunk_failed)
+        if cache:
+            get_url_cache().store(dict((lfn, urls[lfn]) for lfn in todo if lfn in urls))
+    return urls, failed
+
+
+def _dirac_metadata_chunk(lfns):
+    from GangaDirac.Lib.Utilities.DiracUtilities import execute
+    try:
+        with _dirac_calls:
+            md = execute('getMetadata({!r})'.format(lfns))
+    except Exception as e:
+        logger.warning('Cannot get the metadata of {} files: {}'.format(len(lfns), e))
+        return {}
+    md = md.get('Successful', md)
+    return dict((lfn, (md[lfn].get('Size'), md[lfn].get('Checksum'))) for lfn in lfns if lfn in md)
+
+
+@profiled()
+def resolve_metadata(lfns):
+    """
+    Return {lfn: (size, adler32)} from the DIRAC replica metadata of lfns, queried
+    in chunks of URL_CHUNK_SIZE with up to URL_WORKERS concurrent calls. LFNs
+    whose metadata cannot be fetched are left out.
+    """
+    lfns = sorted(set(lfns))
+    metadata = {}
+    chunks = [lfns[i:i + URL_CHUNK_SIZE] for i in range(0, len(lfns), URL_CHUNK_SIZE)]
+    with ContextExecutor(max_workers=URL_WORKERS) as pool:
+        for chunk_metadata in pool.map(_dirac_metadata_chunk, chunks):
+            metadata.update(chunk_metadata)
+    return metadata
+
+
+# Probed storage elements, {storage element: (time probed, future of the seconds to open and read
+# PROBE_SIZE bytes (None if failed))}, probes in flight included so that concurrent callers wait for them
+_se_probes = {}
+_se_probes_lock = threading.Lock()
+
+
+def _storage_element(url):
+    return urlparse(url).netloc or 'local'
+
+
+def probe(url, size=PROBE_SIZE):
+    """Return the seconds it takes to open url and read size bytes, None if it cannot be read."""
+    start = time.time()
+    try:
+        with StreamReader(url) as reader:
+            nbytes = 0
+            while nbytes < size:
+                data = reader.read(size - nbytes)
+                if not data:
+                    break
+                nbytes += len(data)
+    except (IOError, OSError) as e:
+        logger.debug('Probe of {} failed: {}'.format(url, e))
+        return None
+    return time.time() - start
+
+
+@profiled()
+def rank_replicas(replicas):
+    """
+    Return {lfn: [url, ...]} with the replicas of each LFN sorted from the fastest
+    to the slowest storage element. Each storage element is probed once (with a
+    small read of one of its files) and the result is remembered for PROBE_TTL.
+    """
+    futures, todo = {}, {}
+    now = time.time()
+    with _se_probes_lock:  # only register the probes, other callers use the probed elements meanwhile
+        for urls in replicas.values():
+            for url in urls:
+                se = _storage_element(url)
+                if se not in futures:
+                    if se not in _se_probes or _se_probes[se][0] < now - PROBE_TTL:
+                        _se_probes[se] = (now, Future())
+                        todo[se] = url
+                    futures[se] = _se_probes[se][1]
+    if todo:
+        try:
+            with ContextExecutor(max_workers=URL_WORKERS) as pool:
+                for se, seconds in zip(todo, pool.map(probe, todo.values())):
+                    futures[se].set_result(seconds)
+                    logger.info('Storage element {}: {}'.format(
+                        se, 'unavailable' if seconds is None else '{:.2f} s probe'.format(seconds)))
+        except Exception as e:
+            with _se_probes_lock:  # probe again next time, and do not leave other callers waiting
+                for se in todo:
+                    if not futures[se].done():
+                        if _se_probes.get(se, (None, None))[1] is futures[se]:
+                            del _se_probes[se]
+                        futures[se].set_exception(e)
+            raise
+    seconds = dict((se, future.result()) for se, future in futures.items())
+
+    def key(url):
+        probed = seconds[_storage_element(url)]
+        return (probed is None, probed or 0.0)
+
+    return dict((lfn, sorted(urls, key=key)) for lfn, urls in replicas.items())
+
+
+def dirac_get_access_urls(lfns):
+    """Return {lfn: url} (of the fastest replica) for the given LFNs, logging those which cannot be resolved."""
+    urls, failed = resolve_access_urls(lfns)
+    for lfn, reason in sorted(failed.items()):
+        logger.error('{}: {}'.format(reason, lfn))
+    return dict((lfn, replicas[0]) for lfn, replicas in rank_replicas(urls).items())
+
+
+def get_access_replicas(files):
+    """
+    Return, for each (job, file) or OutputEntry in files, the list of URLs of
+    the replicas of the file, from the fastest to the slowest (see rank_replicas).
+    """
+    entries = [f if isinstance(f, OutputEntry) else make_entry(f[0], f[1], exists=True) for f in files]
+    urls = [None] * len(entries)
     dirac_lfns = []
-    for i, (job, f) in enumerate(files):
-        file_type = ganga_type(f)
-        if not issubclass(file_type, IGangaFile):
-            raise ValueError('file must be a Ganga file object!')
-
-        if issubclass(file_type, GangaDirac.Lib.Files.DiracFile.DiracFile):
-            dirac_lfns.append(f.lfn)  # deal with this case separately below
-        elif issubclass(file_type, GangaCore.GPIDev.Lib.File.MassStorageFile):
+    for i, entry in enumerate(entries):
+        if entry.type == 'DiracFile':
+            dirac_lfns.append(entry.location)  # deal with this case separately below
+        elif entry.type == 'MassStorageFile':
             # TODO this is LHCb specific, but there is no generic easy way
-            urls[i] = 'root://eoslhcb.cern.ch/' + f.location()[0]
-        elif issubclass(file_type, GangaCore.GPIDev.Lib.File.LocalFile):
-            urls[i] = os.path.join(job.outputdir, f.namePattern)
+            urls[i] = ['root://eoslhcb.cern.ch/' + entry.location]
+        elif entry.type == 'LocalFile':
+            urls[i] = [entry.location]
         else:
-            raise NotImplementedError('get_access_url() does not yet implement {}'.format(repr(f)))
+            raise NotImplementedError('get_access_url() does not yet implement {}'.format(entry.type))
 
-    # Make a single call to the Dirac API for all DiracFiles (calls are slow!)
+    # Resolve all DiracFiles together (in concurrent chunks, calls are slow!)
     if(len(dirac_lfns) > 0):
-        dirac_urls_dict = dirac_get_access_urls(dirac_lfns)
-        for i, (job, f) in enumerate(files):
-            if issubclass(ganga_type(f), GangaDirac.Lib.Files.DiracFile.DiracFile):
-                try:
-                    urls[i] = dirac_urls_dict[f.lfn]
-                except KeyError:
-                    logger.error('No available replica for LFN {} from job {}'.format(job.fqid))
-                    raise RuntimeError('Cannot handle unaccessible files.')
+        dirac_urls_dict, failed = resolve_access_urls(dirac_lfns)
+        dirac_urls_dict = rank_replicas(dirac_urls_dict)
+        for i, entry in enumerate(entries):
+            if entry.type == 'DiracFile':
+                if entry.location in failed:
+                    logger.error('No available replica for LFN {} from job {}: {}'.format(
+                        entry.location, entry.fqid, failed[entry.location]))
+                else:
+                    urls[i] = dirac_urls_dict[entry.location]
+        if failed:
+            raise AccessURLError(failed)
     return urls
 
 
+def get_access_urls(files):
+    """Return, for each (job, file) or OutputEntry in files, the URL of its fastest replica."""
+    return [replicas[0] for replicas in get_access_replicas(files)]
+
+
 def xrootd_read(url):
     return subprocess.check_output(['xrdcp', '-s', url, '-'])
+
+
+class StreamReader(object):
+    """
+    Sequential reader of a local file, a file:// URL or a root:// URL
+    (streamed through "xrdcp -s url -"). Use as a context manager.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self._proc = None
+        parsed = urlparse(url)
+        if parsed.scheme in ('', 'file'):
+            self._file = open(parsed.path if parsed.scheme else url, 'rb')
+        else:
+            self._proc = subprocess.Popen(['xrdcp', '-s', url, '-'], stdout=subprocess.PIPE)
+            self._file = self._proc.stdout
+
+    def read(self, size):
+        data = self._file.read(size)
+        if not data and self._proc and self._proc.wait():
+            raise IOError('xrdcp of {} failed with exit code {}'.format(self.url, self._proc.returncode))
+        return data
+
+    def close(self):
+        self._file.close()
+        if self._proc and self._proc.poll() is None:
+            self._proc.kill()
+            self._proc.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
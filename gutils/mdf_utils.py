@@ -0,0 +1,112 @@
+"""
+Utilities for MDF (and RAW) files, which are a plain sequence of records.
+
+Each record starts with the generic MDF header, whose first three 32-bit words
+all hold the size of the record in bytes (including the header). The functions
+here only read these headers (memory mapped), never the payload.
+"""
+import os
+import mmap
+import struct
+import contextlib
+
+_SIZES = struct.Struct('<3I')
+
+# Size of the generic part of the MDF header (sizes, checksum, compression, type, ...)
+MIN_HEADER_SIZE = 20
+
+
+class MDFError(ValueError):
+    pass
+
+
+def _check_sizes(sizes, offset):
+    if sizes[0] != sizes[1] or sizes[0] != sizes[2]:
+        raise MDFError('Inconsistent record sizes {} at offset {}'.format(sizes, offset))
+    if sizes[0] < MIN_HEADER_SIZE:
+        raise MDFError('Invalid record size {} at offset {}'.format(sizes[0], offset))
+    return sizes[0]
+
+
+def scan(path, strict=True):
+    """Return the list of the offsets of the records in an MDF file.
+       If strict, raise MDFError for an inconsistent or truncated record,
+       otherwise stop at the last good record.
+    """
+    offsets = []
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return offsets
+        with contextlib.closing(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) as m:
+            if hasattr(m, 'madvise'):  # python >= 3.8
+                m.madvise(mmap.MADV_RANDOM)  # only headers are read, avoid readahead of payloads
+            pos = 0
+            while pos < size:
+                try:
+                    if pos + _SIZES.size > size:
+                        raise MDFError('Truncated header at offset {}'.format(pos))
+                    record_size = _check_sizes(_SIZES.unpack_from(m, pos), pos)
+                    if pos + record_size > size:
+                        raise MDFError('Truncated record at offset {}'.format(pos))
+                except MDFError:
+                    if strict:
+                        raise
+                    break
+                offsets.append(pos)
+                pos += record_size
+    return offsets
+
+
+def count_events(path):
+    """Return the number of events (records) in an MDF file."""
+    return len(scan(path))
+
+
+def truncate(path):
+    """Cut an MDF file after its last complete record, return the number of bytes removed."""
+    offsets = scan(path, strict=False)
+    size = os.path.getsize(path)
+    end = 0
+    if offsets:
+        with open(path, 'rb') as f:
+            f.seek(offsets[-1])
+            end = offsets[-1] + _SIZES.unpack(f.read(_SIZES.size))[0]
+    if end < size:
+        with open(path, 'r+b') as f:
+            f.truncate(end)
+    return size - end
+
+
+class MDFCounter(object):
+    """Count the records of MDF data fed in consecutive chunks (e.g. while streaming)."""
+
+    def __init__(self):
+        self.nevents = 0
+        self.offset = 0
+        self._skip = 0
+        self._header = b''
+
+    def feed(self, data):
+        pos, n = 0, len(data)
+        while pos < n:
+            if self._skip:
+                step = min(self._skip, n - pos)
+                self._skip -= step
+                pos += step
+                continue
+            part = data[pos:pos + _SIZES.size - len(self._header)]
+            self._header += part
+            pos += len(part)
+            if len(self._header) == _SIZES.size:
+                record_size = _check_sizes(_SIZES.unpack(self._header), self.offset)
+                self.nevents += 1
+                self.offset += record_size
+                self._skip = record_size - _SIZES.size
+                self._header = b''
+
+    def close(self):
+        """Return the number of events, raise MDFError if the last record is incomplete."""
+        if self._skip or self._header:
+            raise MDFError('Truncated last record (expected to end at offset {})'.format(self.offset))
+        return self.nevents
@@ -1,41 +1,333 @@
 import os
+import time
+import queue
+import errno
 import shutil
+import tempfile
+import threading
+from collections import defaultdict
+from concurrent.futures import wait, FIRST_COMPLETED
 from urllib.parse import urlparse
 import GangaCore
 
 logger = GangaCore.Utility.logging.getLogger('gutils.merge')
 
 from .utils import subjobs, outputfiles
-from .download import download_temp, get_access_urls
-from .root_utils import get_tree_entries, ROOT_PREFIX
+from .output_index import output_entries
+from .download import (get_access_replicas, resolve_metadata, probe, DownloadEngine, StreamReader,
+                       DEFAULT_WORKERS, _download_path)
+from .root_utils import get_tree_entries, count_tree_entries, ROOT_PREFIX
+from .mdf_utils import count_events, MDFCounter, MDFError
+from .profiling import profiled, span
+from .specs import ContextExecutor
 
 
 def _getrootprefix_patch(rootsys=None):
     return 0, ' '.join(ROOT_PREFIX) + ' '
 
 
-def _merge_root(inputs, output):
+# Hierarchical merging of ROOT files: number of inputs per hadd and concurrent hadds
+MERGE_FANIN = 100
+MERGE_WORKERS = 4
+
+# Buffer size for copying MDF files when kernel-side copies are not available
+COPY_BUFFER_SIZE = 16 * 1024 * 1024
+
+# Streaming of remote MDF files: concurrent inputs, chunk size and buffered chunks per input
+STREAM_PREFETCH = 4
+STREAM_CHUNK_SIZE = 8 * 1024 * 1024
+STREAM_MAX_CHUNKS = 4
+
+
+@profiled()
+def _hadd(inputs, output, args=''):
+    rootMerger = GangaCore.GPI.RootMerger(args=args)
+    rootMerger._impl.mergefiles(inputs, output)
+
+
+def _hadd_replicas(inputs, output, args=''):
+    """
+    _hadd of inputs given as lists of replicas, from the first replica of each.
+    If hadd fails, the inputs whose replica cannot be read (see probe) are
+    merged again from their next replica.
+    """
+    current = [0] * len(inputs)
+    while True:
+        try:
+            return _hadd([replicas[i] for replicas, i in zip(inputs, current)], output, args=args)
+        except Exception:
+            with ContextExecutor(max_workers=DEFAULT_WORKERS) as pool:
+                probed = list(pool.map(lambda url: probe(url, size=1), [r[i] for r, i in zip(inputs, current)]))
+            dead = [k for k, seconds in enumerate(probed) if seconds is None]
+            if not dead or any(current[k] + 1 == len(inputs[k]) for k in dead):
+                raise
+            for k in dead:
+                current[k] += 1
+                logger.warning('Could not read {}, trying replica {}'.format(inputs[k][current[k] - 1],
+                                                                             inputs[k][current[k]]))
+
+
+def _count_entries(inputs, versions=None):
+    """
+    Return the entries per tree of inputs given as lists of replicas (see
+    get_tree_entries), the inputs whose replica cannot be read are counted on
+    their next replica.
+    """
+    entries = defaultdict(int)
+    todo = inputs
+    while todo:
+        per_file, errors = count_tree_entries([replicas[0] for replicas in todo], versions=versions)
+        retry = []
+        for replicas in todo:
+            if replicas[0] in per_file:
+                if not per_file[replicas[0]]:
+                    raise ValueError('No TTree objects found in ' + replicas[0])
+                for name, n in per_file[replicas[0]].items():
+                    entries[name] += n
+            elif len(replicas) > 1:
+                retry.append(replicas[1:])
+            else:
+                raise IOError("Can't find/open file: " + errors[replicas[0]])
+        todo = retry
+    return dict(entries)
+
+
+@profiled()
+def _merge_root(inputs, output, fanin=MERGE_FANIN, workers=MERGE_WORKERS, versions=None):
+    """
+    Merge ROOT files with hadd. If there are more than fanin inputs, groups of
+    fanin inputs are first merged concurrently (up to workers at a time) into
+    intermediate files, recursively, and the intermediate files are merged last.
+    Inputs can also be lists of URLs of replicas, which fail over to the next
+    ones (see _hadd_replicas). versions identify the remote inputs when counting
+    entries (see get_tree_entries).
+    """
     config = GangaCore.GPI.config
     GangaCore.Utility.root.getrootprefix = _getrootprefix_patch
+    inputs = [[x] if isinstance(x, str) else list(x) for x in inputs]
 
-    # rootMerger = RootMerger(args='-f6')
-    # -O gives the best reading performance:
-    rootMerger = GangaCore.GPI.RootMerger(args='-O')
-    rootMerger._impl.mergefiles(inputs, output)
+    # count the input entries while merging
+    counting_pool = ContextExecutor(max_workers=1)
+    counting = counting_pool.submit(_count_entries, inputs, versions)
+
+    tempdir = None
+    merge_inputs = inputs
+    try:
+        while fanin and len(merge_inputs) > fanin:
+            if tempdir is None:
+                tempdir = tempfile.mkdtemp(prefix='.merge-', dir=os.path.dirname(os.path.abspath(output)))
+            groups = [merge_inputs[i:i + fanin] for i in range(0, len(merge_inputs), fanin)]
+            level = [os.path.join(tempdir, 'merge-{}-{}.root'.format(len(merge_inputs), i))
+                     for i in range(len(groups))]
+            logger.info('Merging {} files in {} groups'.format(len(merge_inputs), len(groups)))
+            with ContextExecutor(max_workers=workers) as pool:
+                list(pool.map(_hadd_replicas, groups, level))
+            if merge_inputs is not inputs:
+                for fn, in merge_inputs:
+                    os.remove(fn)
+            merge_inputs = [[fn] for fn in level]
+
+        # rootMerger = RootMerger(args='-f6')
+        # -O gives the best reading performance:
+        _hadd_replicas(merge_inputs, output, args='-O')
+    finally:
+        if tempdir:
+            shutil.rmtree(tempdir)
+        counting_pool.shutdown(wait=False)
 
-    n_in, n_out = get_tree_entries(inputs), get_tree_entries(output)
+    n_in, n_out = counting.result(), get_tree_entries(output)
     if n_in != n_out:
         logger.error("Got {} input entries but merged file contains {}!"
                      .format(n_in, n_out))
 
 
-def _merge_mdf(inputs, output):
-    if any(x.startswith('root://') for x in inputs):
-        raise NotImplementedError('Direct merging of MDF files not implemented.')
-    with open(output, 'wb') as fout:
-        for inp in inputs:
-            with open(inp, 'rb') as fin:
-                shutil.copyfileobj(fin, fout)
+def _copy_range(fdin, fdout, size, offset):
+    """
+    Copy size bytes from the start of fdin to fdout at offset, in the kernel if
+    possible (copy_file_range, then sendfile), otherwise through a large buffer.
+    """
+    copied = 0
+    if hasattr(os, 'copy_file_range'):  # python >= 3.8
+        try:
+            while copied < size:
+                n = os.copy_file_range(fdin, fdout, size - copied, copied, offset + copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EPERM):
+                raise
+    if copied < size and hasattr(os, 'sendfile'):
+        os.lseek(fdout, offset + copied, os.SEEK_SET)
+        try:
+            while copied < size:
+                n = os.sendfile(fdout, fdin, copied, size - copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError as e:
+            if e.errno not in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    if copied < size:
+        os.lseek(fdin, copied, os.SEEK_SET)
+        os.lseek(fdout, offset + copied, os.SEEK_SET)
+        while copied < size:
+            buf = os.read(fdin, min(COPY_BUFFER_SIZE, size - copied))
+            if not buf:
+                break
+            copied += os.write(fdout, buf)
+    if copied != size:
+        raise IOError('Copied {} bytes instead of {}'.format(copied, size))
+
+
+def _concatenate(inputs, output, append=False):
+    """Concatenate local files into output (preallocated to the final size), return the bytes copied."""
+    sizes = [os.path.getsize(x) for x in inputs]
+    total = sum(sizes)
+    fdout = os.open(output, os.O_WRONLY | os.O_CREAT | (0 if append else os.O_TRUNC), 0o666)
+    try:
+        offset = os.fstat(fdout).st_size
+        if total and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fdout, offset, total)
+            except OSError:
+                pass  # e.g. not supported by the filesystem
+        for inp, size in zip(inputs, sizes):
+            fdin = os.open(inp, os.O_RDONLY)
+            try:
+                _copy_range(fdin, fdout, size, offset)
+            finally:
+                os.close(fdin)
+            offset += size
+    finally:
+        os.close(fdout)
+    return total
+
+
+def _stream_concatenate(inputs, output, append=False, prefetch=STREAM_PREFETCH,
+                        chunk_size=STREAM_CHUNK_SIZE, max_chunks=STREAM_MAX_CHUNKS):
+    """
+    Concatenate (remote) inputs into output, return the bytes written and the
+    number of events (MDF records) counted in the streamed data. Each input is
+    a URL or a list of URLs of replicas, which are tried in turn: if a replica
+    fails mid-stream, the next one resumes after the bytes already read. Up to
+    prefetch inputs are streamed concurrently, while the output is written
+    strictly in input order: input i is started once input i - prefetch + 1
+    is being written. At most max_chunks chunks of chunk_size bytes are
+    buffered per input being streamed, so at most prefetch * max_chunks in all.
+    """
+    stop = threading.Event()
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def stream(urls, q):
+        done = 0
+        for i, url in enumerate(urls):
+            try:
+                with StreamReader(url) as reader:
+                    skip = done
+                    while skip:  # resume where the previous replica failed
+                        data = reader.read(min(skip, chunk_size))
+                        if not data:
+                            raise IOError('{} is shorter than the other replicas'.format(url))
+                        skip -= len(data)
+                    while not stop.is_set():
+                        chunk = reader.read(chunk_size)
+                        if not chunk:
+                            break
+                        put(q, chunk)
+                        done += len(chunk)
+                put(q, None)
+                return
+            except Exception as e:
+                if i + 1 == len(urls):
+                    put(q, e)
+                else:
+                    logger.warning('Could not read {} ({}), trying replica {}'.format(url, e, urls[i + 1]))
+
+    inputs = [[x] if isinstance(x, str) else list(x) for x in inputs]
+    nbytes, nevents = 0, 0
+    queues = [queue.Queue(maxsize=max_chunks) for _ in inputs]
+    with ContextExecutor(max_workers=prefetch) as pool:
+        try:
+            with open(output, 'ab' if append else 'wb') as fout:
+                started = 0
+                for i, (urls, q) in enumerate(zip(inputs, queues)):
+                    # stream the inputs i to i + prefetch - 1, the ones before are written already
+                    while started < min(len(inputs), i + prefetch):
+                        pool.submit(stream, inputs[started], queues[started])
+                        started += 1
+                    url = urls[0]
+                    counter = MDFCounter()
+                    for chunk in iter(q.get, None):
+                        if isinstance(chunk, Exception):
+                            raise IOError('Could not read {}: {}'.format(url, chunk))
+                        fout.write(chunk)
+                        nbytes += len(chunk)
+                        if counter is not None:
+                            try:
+                                counter.feed(chunk)
+                            except MDFError as e:
+                                logger.error('Invalid MDF data in {}: {}'.format(url, e))
+                                counter = None
+                    if counter is not None:
+                        try:
+                            nevents += counter.close()
+                        except MDFError as e:
+                            logger.error('Invalid MDF data in {}: {}'.format(url, e))
+        finally:
+            stop.set()
+    return nbytes, nevents
+
+
+@profiled()
+def _count_events(path):
+    """Return the number of events of a local MDF file, None (and log an error) if invalid."""
+    try:
+        return count_events(path)
+    except MDFError as e:
+        logger.error('Invalid MDF file {}: {}'.format(path, e))
+        return None
+
+
+def _check_events(path, n_in, n_before=0):
+    """Count the events of the MDF file path, log an error unless n_before + n_in."""
+    n_out = _count_events(path)
+    if n_before is None or n_out is None or n_out - n_before != n_in:
+        logger.error("Got {} input events but merged file contains {}!"
+                     .format(n_in, None if n_out is None else n_out - (n_before or 0)))
+
+
+def _merge_mdf(inputs, output, append=False, validate=True):
+    """
+    Concatenate MDF inputs into output (or append them to it) and return the
+    number of input events. With validate, the events of output are counted
+    and compared, otherwise this is left to the caller (see _check_events).
+    """
+    start = time.time()
+    n_before = _count_events(output) if validate and append and os.path.isfile(output) else 0
+    if any(not isinstance(x, str) or '://' in x for x in inputs):
+        with span('merge.mdf_stream', files=len(inputs)) as s:
+            nbytes, n_in = _stream_concatenate(inputs, output, append=append)
+            s.set(bytes=nbytes)
+    else:
+        n_in = sum(_count_events(x) or 0 for x in inputs)
+        with span('merge.mdf_concatenate', files=len(inputs)) as s:
+            nbytes = _concatenate(inputs, output, append=append)
+            s.set(bytes=nbytes)
+    elapsed = time.time() - start
+    logger.info('Merged {} files ({:.1f} MB) in {:.1f} s ({:.1f} MB/s)'.format(
+        len(inputs), nbytes / 1e6, elapsed, nbytes / 1e6 / elapsed if elapsed else 0.0))
+
+    if validate:
+        _check_events(output, n_in, n_before)
+    return n_in
 
 
 def _extension(x):
@@ -43,14 +335,19 @@ def _extension(x):
     return os.path.splitext(res.path if res.scheme else x)[1]
 
 
-def _merge(inputs, output):
+def _merge(inputs, output, **kwargs):
+    """
+    Merge inputs into output. Keyword arguments are passed to _merge_root.
+    Inputs can also be lists of URLs of replicas, from the fastest (see
+    _stream_concatenate and _merge_root).
+    """
     ext = _extension(output)
-    bad_ext = [x for x in inputs if _extension(x) != ext]
+    bad_ext = [x for x in inputs if _extension(x if isinstance(x, str) else x[0]) != ext]
     if bad_ext:
         raise ValueError("Incompatible extensions of inputs ({}) and output "
                          "({}).".format(bad_ext, ext))
     if ext == '.root':
-        _merge_root(inputs, output)
+        _merge_root(inputs, output, **kwargs)
     elif ext == '.mdf' or ext == '.raw':
         _merge_mdf(inputs, output)
     else:
@@ -77,19 +374,168 @@ def _merged_path(jobs, name, path, overwrite=False, partial=False):
     return path
 
 
-def download_merge(jobs, name, path, parallel=True, keep_temp=False, overwrite=False, partial=False):
+def _pipelined_download_merge(files, tempdir, output, workers, batch_size, scratch_budget, keep_temp,
+                              **kwargs):
+    """
+    Download files ([(job, file), ...]) to tempdir and merge them into output
+    in batches while the remaining files are being downloaded. ROOT batches are
+    merged into intermediate files which are combined at the end, MDF batches
+    are appended to output (their events are counted per batch and compared
+    to the events of output once, at the end). Downloaded files are deleted
+    once merged.
+
+    At most (about) scratch_budget bytes are used in tempdir: downloaded files
+    not merged yet (twice for ROOT, as a batch needs room for its merged copy),
+    intermediate files and the downloads in flight (estimated from the average
+    size of the files downloaded so far). When the intermediates take half of
+    the budget, they are merged into a part of output, next to it (outside
+    tempdir). The parts and the last intermediates are merged into output at
+    the end, so that each file is merged a bounded number of times. At least
+    one file is downloaded at a time, whatever the budget.
+    Keyword arguments are passed to _merge.
+    """
+    ext = _extension(output)
+    todo = iter(files)
+    exhausted = False
+    in_flight = set()
+    ready, ready_bytes = [], 0
+    intermediates, intermediate_bytes = [], 0
+    downloaded_bytes, ndownloaded = 0, 0
+    nmerged, nevents = 0, 0
+    directory, basename = os.path.split(os.path.abspath(output))
+    parts = []  # merges of intermediates, next to output
+
+    def scratch_bytes():
+        expected = downloaded_bytes / ndownloaded if ndownloaded else 0
+        return (ready_bytes * (2 if ext == '.root' else 1) + intermediate_bytes +
+                len(in_flight) * expected)
+
+    def can_download():
+        if not scratch_budget or not (in_flight or ready or intermediates):
+            return True
+        if not ndownloaded:
+            return False  # one download at a time until a file size is known
+        return scratch_bytes() + downloaded_bytes / ndownloaded <= scratch_budget
+
+    def merge_batch():
+        nonlocal ready_bytes, intermediate_bytes, nevents
+        batch = list(ready)
+        del ready[:]
+        if ext == '.root':
+            intermediate = os.path.join(tempdir, 'merged-{}-{}{}'.format(nmerged, len(intermediates), ext))
+            _merge(batch, intermediate, **kwargs)
+            intermediates.append(intermediate)
+            intermediate_bytes += os.path.getsize(intermediate)
+        else:
+            nevents += _merge_mdf(batch, output, append=bool(nmerged), validate=False)
+        if not keep_temp:
+            for fn in batch:
+                os.remove(fn)
+        ready_bytes = 0
+        logger.info('Merged {} files ({} so far)'.format(len(batch), nmerged + len(batch)))
+        return len(batch)
+
+    def fold():
+        """Merge the intermediates into a new part of output, freeing tempdir."""
+        nonlocal intermediate_bytes
+        part = os.path.join(directory, '.tmp-{}-{}'.format(len(parts), basename))
+        parts.append(part)
+        if len(intermediates) == 1:
+            shutil.move(intermediates[0], part)
+        else:
+            logger.info('Merging {} intermediate files into {}'.format(len(intermediates), part))
+            _merge(intermediates, part, **kwargs)
+            for fn in intermediates:
+                os.remove(fn)
+        del intermediates[:]
+        intermediate_bytes = 0
+
+    try:
+        with DownloadEngine(workers=workers) as engine:
+            while True:
+                # keep the download queue full, within the scratch budget
+                while not exhausted and len(in_flight) < 2 * workers and can_download():
+                    try:
+                        job, file = next(todo)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    in_flight.add(engine.submit(file, _download_path(job, file, tempdir), job.fqid))
+                if not in_flight and not ready:
+                    if exhausted or not intermediates:
+                        break
+                    fold()  # the intermediates leave no room for a download
+                    continue
+                if in_flight:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        result = future.result()
+                        if result.ok:
+                            ready.append(result.path)
+                            ready_bytes += result.bytes
+                            downloaded_bytes += result.bytes
+                            ndownloaded += 1
+                        else:
+                            logger.warning('File {!r} could not be downloaded: {}'.format(result.source, result.error))
+                if ready and (len(ready) >= batch_size or not can_download() or (exhausted and not in_flight)):
+                    nmerged += merge_batch()
+                    if scratch_budget and intermediates and intermediate_bytes >= scratch_budget / 2:
+                        fold()
+
+        if not nmerged:
+            raise RuntimeError('No files found for given job(s). Check the name pattern.')
+        inputs = parts + intermediates
+        if ext != '.root':
+            _check_events(output, nevents)
+        elif len(inputs) == 1:
+            shutil.move(inputs[0], output)
+        else:
+            logger.info('Merging {} intermediate files into {}'.format(len(inputs), output))
+            _merge(inputs, output, **kwargs)
+            for fn in intermediates:
+                os.remove(fn)
+    finally:
+        for fn in parts:
+            if os.path.isfile(fn):
+                os.remove(fn)
+
+
+def download_merge(jobs, name, path, parallel=True, keep_temp=False, overwrite=False, partial=False,
+                   workers=DEFAULT_WORKERS, batch_size=50, scratch_budget=None,
+                   fanin=MERGE_FANIN, merge_workers=MERGE_WORKERS):
+    """
+    Download the output files of jobs and merge them into path, merging while
+    downloading (see _pipelined_download_merge).
+    """
     path = _merged_path(jobs, name, path, overwrite=overwrite, partial=partial)
-    with download_temp(jobs, name, parallel=parallel, keep_temp=keep_temp) as filenames:
-        _merge(filenames, path)
+    files = outputfiles(jobs, name, one_per_job=True)
+    if not files:
+        raise RuntimeError('No files found for given job(s). Check the name pattern.')
+    tempdir = tempfile.mkdtemp(prefix='download_merge-{}-'.format(name))
+    try:
+        _pipelined_download_merge(files, tempdir, path, workers if parallel else 1,
+                                  batch_size, scratch_budget, keep_temp,
+                                  fanin=fanin, workers=merge_workers)
+    finally:
+        if not keep_temp:
+            shutil.rmtree(tempdir)
     return path
 
 
-def direct_merge(jobs, name, path, **kwargs):
+def direct_merge(jobs, name, path, fanin=MERGE_FANIN, merge_workers=MERGE_WORKERS, **kwargs):
     path = _merged_path(jobs, name, path, **kwargs)
-    files = outputfiles(jobs, name, one_per_job=True)
+    # the access URLs only need the indexed locations, not the file objects
+    files = output_entries(jobs, name, one_per_job=True)
 
     if not files:
         raise RuntimeError('No files found for given job(s). Check the name pattern.')
-    urls = get_access_urls(files)
-    _merge(urls, path)
+    # replicas from the fastest to the slowest storage element, merges fail over to the next ones
+    urls = get_access_replicas(files)
+    versions = None
+    if _extension(path) == '.root':
+        # the catalogue size and checksum identify the remote files whose entries were counted before
+        metadata = resolve_metadata(e.location for e in files if e.type == 'DiracFile')
+        versions = dict((url, metadata[e.location]) for e, replicas in zip(files, urls)
+                        if e.type == 'DiracFile' and e.location in metadata for url in replicas)
+    _merge(urls, path, fanin=fanin, workers=merge_workers, versions=versions)
     return path
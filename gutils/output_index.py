@@ -0,0 +1,234 @@
+"""
+Persistent index of the output files of (sub)jobs, stored in the gangadir.
+
+Finding the output files of big masters means loading every subjob's output
+files and checking that each represents a physical file (see is_existing_file),
+which takes minutes for tens of thousands of subjobs. The index keeps, per
+subjob, its version (status and submission counter, see job_version) and one
+entry per output file. The output files of a subjob are only looked at again
+when its version differs from the indexed one (e.g. after a resubmission, even
+if it ends in the same status). Whether local files exist is checked again
+(from their indexed path) on every lookup.
+"""
+import os
+import re
+import sqlite3
+import fnmatch
+import logging
+import threading
+from collections import namedtuple
+
+import GangaDirac
+import GangaCore
+from GangaCore.Utility.Config import getConfig
+from GangaCore.Utility.files import expandfilename
+from .utils import ganga_type, subjobs, is_existing_file
+from .profiling import profiled
+
+logger = GangaCore.Utility.logging.getLogger('gutils.output_index')
+
+# An output file of a subjob. pos is the position in job.outputfiles and
+# location the LFN (DiracFile), the EOS path (MassStorageFile) or the local path (LocalFile).
+OutputEntry = namedtuple('OutputEntry', 'fqid status type name pos location size exists')
+
+
+def _file_type(f):
+    file_type = ganga_type(f)
+    if issubclass(file_type, GangaDirac.Lib.Files.DiracFile.DiracFile):
+        return 'DiracFile'
+    elif issubclass(file_type, GangaCore.GPIDev.Lib.File.MassStorageFile):
+        return 'MassStorageFile'
+    elif issubclass(file_type, GangaCore.GPIDev.Lib.File.LocalFile):
+        return 'LocalFile'
+    return file_type.__name__
+
+
+def job_version(job):
+    """Return the (status, submission counter) of a (sub)job, which changes when it is resubmitted."""
+    return job.status, getattr(job.info, 'submit_counter', None)
+
+
+def entry_file(entry):
+    """Return a new Ganga file object for an OutputEntry (not attached to a job)."""
+    if entry.type == 'DiracFile':
+        return GangaCore.GPI.DiracFile(namePattern=entry.name, lfn=entry.location or '')
+    elif entry.type == 'MassStorageFile':
+        return GangaCore.GPI.MassStorageFile(namePattern=entry.name,
+                                             locations=[entry.location] if entry.location else [])
+    elif entry.type == 'LocalFile':
+        return GangaCore.GPI.LocalFile(namePattern=entry.name, localDir=os.path.dirname(entry.location))
+    raise NotImplementedError('Do not know how to make a {} from the index'.format(entry.type))
+
+
+def make_entry(job, f, pos=None, exists=None):
+    """Return the OutputEntry of the output file f of job (checking if it exists unless given)."""
+    if exists is None:
+        exists = is_existing_file(f, job)
+    file_type = _file_type(f)
+    location, size = None, None
+    if file_type == 'DiracFile':
+        location = f.lfn or None
+    elif file_type == 'MassStorageFile':
+        location = f.location()[0] if exists else None
+    elif file_type == 'LocalFile':
+        location = os.path.join(job.outputdir, f.namePattern)
+        size = os.path.getsize(location) if exists else None
+    return OutputEntry(job.fqid, job.status, file_type, f.namePattern, pos, location, size, bool(exists))
+
+
+def _recheck(entry):
+    """Return entry, updated if it is a local file which was (re)moved or created since indexed."""
+    if entry.type != 'LocalFile' or not entry.location:
+        return entry
+    exists = os.path.isfile(entry.location)
+    if exists == entry.exists:
+        return entry
+    return entry._replace(exists=exists, size=os.path.getsize(entry.location) if exists else None)
+
+
+class OutputIndex(object):
+    """SQLite backed index of the output files of subjobs, see the module docstring."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS jobs (fqid TEXT PRIMARY KEY, status TEXT, submits INTEGER)')
+            if 'submits' not in [row[1] for row in self._conn.execute('PRAGMA table_info(jobs)')]:
+                self._conn.execute('ALTER TABLE jobs ADD COLUMN submits INTEGER')  # indexed by older versions
+            self._conn.execute('CREATE TABLE IF NOT EXISTS files (fqid TEXT, status TEXT, type TEXT, name TEXT, '
+                               'pos INTEGER, location TEXT, size INTEGER, exists_ INTEGER)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS files_fqid ON files (fqid)')
+        self._memory = {}  # {fqid: (version, [OutputEntry, ...])} of the subjobs loaded so far
+
+    def _load(self, fqids):
+        """Load the indexed subjobs in memory (in one query), if not loaded yet."""
+        missing = [fqid for fqid in fqids if fqid not in self._memory]
+        if not missing:
+            return
+        with self._lock, self._conn:
+            self._conn.execute('CREATE TEMP TABLE IF NOT EXISTS wanted (fqid TEXT PRIMARY KEY)')
+            self._conn.execute('DELETE FROM wanted')
+            self._conn.executemany('INSERT OR IGNORE INTO wanted VALUES (?)', ((fqid,) for fqid in missing))
+            rows = self._conn.execute('SELECT jobs.fqid, jobs.status, jobs.submits, files.* FROM jobs '
+                                      'JOIN wanted USING (fqid) LEFT JOIN files USING (fqid) '
+                                      'ORDER BY files.pos').fetchall()
+            loaded = {}
+            for row in rows:
+                files = loaded.setdefault(row[0], ((row[1], row[2]), []))[1]
+                if row[3] is not None:
+                    files.append(OutputEntry(*row[3:-1], exists=bool(row[-1])))
+            for fqid, value in loaded.items():
+                self._memory.setdefault(fqid, value)  # not replacing what was stored meanwhile
+
+    def indexed(self, fqids):
+        """Return {fqid: (version, [OutputEntry, ...])} of the indexed subjobs."""
+        fqids = list(fqids)
+        self._load(fqids)
+        return dict((fqid, self._memory[fqid]) for fqid in fqids if fqid in self._memory)
+
+    def store(self, entries):
+        """Replace the entries of the (sub)jobs given as {fqid: (version, [OutputEntry, ...])}."""
+        with self._lock, self._conn:
+            fqids = [(fqid,) for fqid in entries]
+            self._conn.executemany('DELETE FROM files WHERE fqid = ?', fqids)
+            self._conn.executemany('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?)',
+                                   [(fqid,) + tuple(version) for fqid, (version, _) in entries.items()])
+            self._conn.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                   [tuple(e) for _, files in entries.values() for e in files])
+            self._memory.update(entries)
+
+    def forget(self, fqids):
+        """Remove (sub)jobs from the index, e.g. when they are removed. Masters also remove their subjobs."""
+        with self._lock, self._conn:
+            for fqid in fqids:
+                fqid = str(fqid)
+                for table in ['jobs', 'files']:
+                    self._conn.execute('DELETE FROM {} WHERE fqid = ? OR fqid LIKE ?'.format(table),
+                                       [fqid, fqid + '.%'])
+                for key in [k for k in self._memory if k == fqid or k.startswith(fqid + '.')]:
+                    del self._memory[key]
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM jobs')
+            self._conn.execute('DELETE FROM files')
+        self._memory.clear()
+
+    def refresh(self, jobs):
+        """Index the (sub)jobs which changed since they were last indexed (see above), return their number."""
+        return self._refresh(list(subjobs(jobs)))
+
+    @profiled('output_index.refresh')
+    def _refresh(self, jobs):
+        indexed = self.indexed(j.fqid for j in jobs)
+        changed = {}
+        for job in jobs:
+            version = job_version(job)
+            if tuple(indexed.get(job.fqid, ((),))[0]) != version:
+                changed[job.fqid] = (version, [make_entry(job, f, pos) for pos, f in enumerate(job.outputfiles)])
+        if changed:
+            logger.debug('Indexing output files of {} (sub)jobs'.format(len(changed)))
+            self.store(changed)
+        return len(changed)
+
+    def entries(self, fqids, pattern='*'):
+        """Return {fqid: [OutputEntry, ...]} of the output files matching pattern (as job.outputfiles.get)."""
+        fqids = list(fqids)
+        self._load(fqids)
+        match = re.compile(fnmatch.translate(pattern)).match
+        return dict((fqid, [_recheck(e) for e in self._memory[fqid][1] if match(e.name)]
+                     if fqid in self._memory else []) for fqid in fqids)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """Return the default output index, stored in the gangadir."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            gangadir = expandfilename(getConfig('Configuration')['gangadir'])
+            _index = OutputIndex(os.path.join(gangadir, 'output_index.sqlite'))
+    return _index
+
+
+def output_entries(jobs, pattern, one_per_job=False, ignore_missing=True):
+    """
+    Return a flat list of the (existing) OutputEntry of the output files
+    matching the pattern for the given jobs, using (and refreshing) the index.
+    See gutils.utils.outputfiles.
+    """
+    return _output_entries(list(subjobs(jobs)), pattern, one_per_job, ignore_missing)
+
+
+def _output_entries(jobs, pattern, one_per_job, ignore_missing):
+    """output_entries of a flat list of (sub)jobs."""
+    index = get_index()
+    index._refresh(jobs)
+    found = index.entries([j.fqid for j in jobs], pattern)
+    entries = []
+    for job in jobs:
+        job_entries = found[job.fqid]
+        if one_per_job:
+            if len(job_entries) == 0:
+                raise RuntimeError('File "{}" not found for job {}'.format(pattern, job.fqid))
+            elif len(job_entries) > 1:
+                raise RuntimeError('Too many files matching pattern "{}" for job {}'.format(pattern, job.fqid))
+        for entry in job_entries:
+            if not entry.exists:
+                msg = 'File {} from job {} ({}) does not represent an existing physical file!'.format(
+                    entry.name, job.fqid, job.status)
+                if not ignore_missing:
+                    raise RuntimeError(msg + '\nAre all (sub)jobs completed?')
+                else:
+                    level = logging.INFO if job.status == 'completed' else logging.WARNING
+                    logger.log(level, msg + ' Will ignore it!')
+            else:
+                if job.status != 'completed':
+                    logger.warning('File {} from job {} exists but job is {}!'.format(entry.name, job.fqid, job.status))
+                entries.append(entry)
+    return entries
@@ -0,0 +1,162 @@
+"""
+Lightweight profiling of the hot paths of gutils (registry walks, URL
+resolution, downloads, merging, validation, bookkeeping calls).
+
+Code is instrumented with spans:
+
+    with span('hadd', files=len(inputs)) as s:
+        ...
+        s.set(bytes=nbytes)
+
+or with the @profiled decorator. Nothing is recorded unless profiling is
+enabled (enable()), a disabled span costs a function call and a flag check.
+The recorded spans can be written as a Chrome trace (chrome://tracing,
+https://ui.perfetto.dev) with write_trace() and summarised per name (wall
+time, calls, bytes) with summary(). This module must not depend on Ganga.
+"""
+import os
+import sys
+import json
+import atexit
+import time
+import threading
+import functools
+from collections import OrderedDict
+
+_enabled = False
+_lock = threading.Lock()
+_events = []
+_start = time.time()
+
+
+def enable():
+    """Start recording spans (clears the previously recorded ones)."""
+    global _enabled, _start
+    with _lock:
+        del _events[:]
+        _start = time.time()
+        _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def enabled():
+    return _enabled
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.begin = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        end = time.time()
+        if type is not None:
+            self.args['error'] = type.__name__
+        with _lock:
+            _events.append((self.name, self.begin, end, threading.current_thread().ident, self.args))
+        return False
+
+    def set(self, **args):
+        """Add arguments to the span, e.g. bytes moved (summed in the summary) or counts."""
+        self.args.update(args)
+
+
+def span(name, **args):
+    """Return a context manager timing the enclosed block as a span named name."""
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+def profiled(name=None):
+    """Decorator recording each call of a function as a span (named after the function by default)."""
+    def decorator(function):
+        span_name = name or function.__module__.split('.')[-1] + '.' + function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _Span(span_name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def trace():
+    """Return the recorded spans in the Chrome trace event format."""
+    pid = os.getpid()
+    with _lock:
+        events = list(_events)
+    return {
+        'traceEvents': [{'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                         'ts': (begin - _start) * 1e6, 'dur': (end - begin) * 1e6, 'args': args}
+                        for name, begin, end, tid, args in events],
+        'displayTimeUnit': 'ms',
+    }
+
+
+def write_trace(path):
+    with open(path, 'w') as f:
+        json.dump(trace(), f)
+
+
+def summary():
+    """Return {name: {"calls": n, "wall": s, "bytes": n}} of the recorded spans.
+       wall is the time covered by at least one span of that name (concurrent
+       spans are not counted twice).
+    """
+    with _lock:
+        events = sorted(_events, key=lambda e: e[1])
+    stats = OrderedDict()
+    covered = {}  # {name: end of the last interval}
+    for name, begin, end, _, args in events:
+        s = stats.setdefault(name, {'calls': 0, 'wall': 0.0, 'bytes': 0})
+        s['calls'] += 1
+        s['bytes'] += args.get('bytes', 0)
+        last = covered.get(name, begin)
+        if end > last:
+            s['wall'] += end - max(begin, last)
+            covered[name] = end
+    return stats
+
+
+def format_summary(stats=None):
+    """Return the summary as a table."""
+    stats = summary() if stats is None else stats
+    lines = ['{:<32} {:>8} {:>10} {:>12}'.format('stage', 'calls', 'wall [s]', 'MB')]
+    for name, s in sorted(stats.items(), key=lambda x: -x[1]['wall']):
+        lines.append('{:<32} {:>8} {:>10.2f} {:>12.1f}'.format(name, s['calls'], s['wall'], s['bytes'] / 1e6))
+    return '\n'.join(lines)
+
+
+def profile_to(path):
+    """Enable profiling and, at exit, write the trace to path and print the summary (for scripts)."""
+    def finish():
+        disable()
+        write_trace(path)
+        sys.stderr.write(format_summary() + '\nProfile written to {}\n'.format(path))
+    enable()
+    atexit.register(finish)
@@ -1,9 +1,26 @@
+import os
+import sys
 import json
-import subprocess
+import atexit
+import threading
+from collections import defaultdict, OrderedDict
+
+try:
+    from .worker import WorkerSession, WorkerError, serve
+    from .profiling import profiled
+except ImportError:  # run as the helper script
+    from worker import WorkerSession, WorkerError, serve
+    from profiling import profiled
 
 # FIXME lb-run ROOT does not seem to work these days
 ROOT_PREFIX = ['lb-run', 'Gaudi/latest']
 
+# Number of files opened in parallel when counting entries
+DEFAULT_PROCESSES = 8
+
+# Number of files whose entries are cached, the least recently used are evicted above that
+ENTRIES_CACHE_SIZE = 100000
+
 def _get_trees(x, dir_name=""):
     """Recursively get trees from x.
        x can be a TFile or a TDirectoryFile
@@ -23,48 +40,214 @@ def _get_trees(x, dir_name=""):
     return trees
 
 
-def _get_tree_entries(files, ignore_empty=False, ignore_missing=False):
+def _file_tree_entries(f):
+    """Return (f, {"tree_name": tree_entries}, error) for a single file."""
+    from ROOT import TFile
+    try:
+        file0 = TFile.Open(f)
+        if not file0 or file0.IsZombie():
+            return f, None, "Can't find/open file: " + f
+        try:
+            return f, dict((name, tree.GetEntries()) for name, tree in _get_trees(file0)), None
+        finally:
+            file0.Close("R")
+    except Exception as e:
+        return f, None, '{}: {}'.format(f, e)
+
+
+def _map_processes(function, files, processes):
+    """
+    Return [function(f) for f in files] (as (f, result, error)) computed by a
+    pool of processes. If a worker crashes (e.g. ROOT segfaults), the files not
+    done are retried in a process each, a file crashing again gets an error.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+    results, crashed = [], []
+    with ProcessPoolExecutor(max_workers=min(processes, len(files))) as pool:
+        for f, future in [(f, pool.submit(function, f)) for f in files]:
+            try:
+                results.append(future.result())
+            except BrokenProcessPool:
+                crashed.append(f)
+    for f in crashed:
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            try:
+                results.append(pool.submit(function, f).result())
+            except BrokenProcessPool:
+                results.append((f, None, '{}: the process reading it crashed'.format(f)))
+    return results
+
+
+def _count_tree_entries(files, processes=1):
+    """Get number of entries of all trees, per file, opening the files in parallel.
+       Returns a dictionary: {"file": [{"tree_name": tree_entries} or None, error or None]}
+    """
+    if processes > 1 and len(files) > 1:
+        results = _map_processes(_file_tree_entries, files, processes)
+    else:
+        results = [_file_tree_entries(f) for f in files]
+    return dict((f, [entries, error]) for f, entries, error in results)
+
+
+def _list_trees(f):
+    """Return the sorted names of the trees in a file."""
+    from ROOT import TFile
+    file0 = TFile.Open(f)
+    if not file0 or file0.IsZombie():
+        raise IOError("Can't find/open file: " + f)
+    try:
+        return sorted(name for name, tree in _get_trees(file0))
+    finally:
+        file0.Close("R")
+
+
+# Requests served by the ROOT helper, {"method": method, "params": {...}}
+_METHODS = {
+    'list_trees': _list_trees,
+    'count_tree_entries': _count_tree_entries,
+}
+
+
+def _handle(request):
+    try:
+        return {'ok': True, 'result': _METHODS[request['method']](**request['params'])}
+    except Exception as e:
+        return {'ok': False, 'error': '{}: {}'.format(type(e).__name__, e)}
+
+
+class RootHelper(WorkerSession):
+    """
+    Client of a long-lived python process with ROOT loaded (in ROOT_PREFIX),
+    which serves JSON requests (see _METHODS) over a pipe. The helper is
+    started with the first request and restarted if it crashes.
+    """
+
+    def __init__(self, command=None, timeout=3600):
+        super(RootHelper, self).__init__(
+            command or ROOT_PREFIX + ['python', os.path.abspath(__file__)], timeout=timeout)
+
+    def dumps(self, obj):
+        return json.dumps(obj)
+
+    def loads(self, s):
+        return json.loads(s)
+
+    def call(self, method, **params):
+        response = self.request({'method': method, 'params': params})
+        if not response['ok']:
+            raise WorkerError('ROOT helper {} failed: {}'.format(method, response['error']))
+        return response['result']
+
+
+_helper = None
+_helper_lock = threading.Lock()
+
+
+def get_helper():
+    """Return the (shared) ROOT helper."""
+    global _helper
+    with _helper_lock:
+        if _helper is None:
+            _helper = RootHelper()
+            atexit.register(_helper.close)
+    return _helper
+
+
+def list_trees(f):
+    """Return the sorted names of the trees (including directories) in a file."""
+    return get_helper().call('list_trees', f=f)
+
+
+# LRU cache of the entries per file, {key: {"tree_name": tree_entries}}, see _cache_key
+_entries_cache = OrderedDict()
+_entries_lock = threading.Lock()
+
+
+def _cache_key(f, version=None):
+    """
+    Local files are identified by path, size and modification time, remote files
+    by URL and version in the catalogue (e.g. (size, checksum)). Remote files
+    without a version are not cached (None).
+    """
+    if '://' not in f and os.path.isfile(f):
+        st = os.stat(f)
+        return (os.path.abspath(f), st.st_size, st.st_mtime)
+    if version is None:
+        return None
+    return (f,) + tuple(version)
+
+
+@profiled()
+def count_tree_entries(files, processes=DEFAULT_PROCESSES, versions=None):
+    """Get number of entries of all trees, per file.
+       Files counted before (and not modified since) are taken from a cache,
+       versions ({"url": (size, checksum)}) identify the remote files.
+       Returns ({"file": {"tree_name": tree_entries}}, {"file": error})
+    """
+    versions = versions or {}
+    keys = dict((f, _cache_key(f, versions.get(f))) for f in files)
+    found = {}
+    with _entries_lock:
+        for f in files:
+            if keys[f] in _entries_cache:
+                _entries_cache.move_to_end(keys[f])
+                found[f] = _entries_cache[keys[f]]
+    todo = [f for f in files if f not in found]
+    errors = {}
+    if todo:
+        results = get_helper().call('count_tree_entries', files=todo, processes=processes)
+        with _entries_lock:
+            for f, (entries, error) in results.items():
+                if error:
+                    errors[f] = error
+                    continue
+                found[f] = entries
+                if keys[f] is not None:
+                    _entries_cache[keys[f]] = entries
+                    _entries_cache.move_to_end(keys[f])
+            while len(_entries_cache) > ENTRIES_CACHE_SIZE:
+                _entries_cache.popitem(last=False)
+    return dict((f, found[f]) for f in files if f in found), errors
+
+
+@profiled()
+def get_tree_entries(files, ignore_empty=False, ignore_missing=False, processes=DEFAULT_PROCESSES,
+                     versions=None):
     """Get number of entries of all trees in files
        Returns a dictionary: {"tree_name":tree_entries}
        tree_name includes the directory name(s), if applicable
+       versions identify remote files in the cache, see count_tree_entries
     """
-    from ROOT import TFile
-    from collections import defaultdict
-    if not hasattr(files, "__iter__"):  # allow single filename to be passed
+    if isinstance(files, str):  # allow single filename to be passed
         files = [files]
+    per_file, errors = count_tree_entries(files, processes, versions)
+    if errors:
+        if not ignore_missing:
+            raise IOError("Can't find/open {} file(s):\n".format(len(errors)) + '\n'.join(errors.values()))
+        for error in errors.values():
+            print("Warning: " + error)
+
     entries = defaultdict(int)
     for f in files:
-        file0 = TFile.Open(f)
-        if not file0:
-            if ignore_missing:
-                print("Warning: Can't find/open file: "+f)
-                continue
-            raise IOError("Can't find/open file: "+f)
-
-        trees = _get_trees(file0)
-        if not trees:
+        if f not in per_file:
+            continue
+        if not per_file[f]:
             if ignore_empty:
                 print('Warning: No TTree objects found in '+f)
                 continue
             raise ValueError('No TTree objects found in '+f)
-
-        for name, tree in trees:
-            entries[name] += tree.GetEntries()
-        file0.Close("R")
+        for name, n in per_file[f].items():
+            entries[name] += n
     return dict(entries)
 
 
-def get_tree_entries(files, ignore_empty=False, ignore_missing=False):
-    import os
-
-    cmd = '_get_tree_entries({!r}, {!r}, {!r})'.format(files, ignore_empty, ignore_missing)
-    env = os.environ.copy()
-    del env['TERM']  # fix for https://bugs.python.org/issue19884
-    out = subprocess.check_output(ROOT_PREFIX + ['python', __file__, cmd], env=env)
-    return json.loads(out)
+def validate_merge(inputs, output, processes=DEFAULT_PROCESSES):
+    """Return (ok, input entries, output entries) comparing the trees of inputs and a merged output."""
+    n_in = get_tree_entries(inputs, processes=processes)
+    n_out = get_tree_entries(output, processes=processes)
+    return n_in == n_out, n_in, n_out
 
 
 if __name__ == '__main__':
-    import sys
-    cmd = sys.argv[1]
-    print(json.dumps(eval(cmd)))
+    serve(_handle, sys.stdin, sys.stdout, json.dumps, json.loads)
@@ -0,0 +1,122 @@
+"""
+Concurrent processing of the job specs given to the command line tools
+(gmerge, gdownload), one spec per output.
+
+Specs are processed by up to `parallel` threads. Log messages emitted while
+processing a spec (also from the worker threads started through
+ContextExecutor) are prefixed with "[spec]". The shared resources (access
+URL cache, ROOT helper, bookkeeping sessions, output index) are module
+level singletons and are reused by all specs.
+"""
+import time
+import logging
+import threading
+import concurrent.futures
+from collections import namedtuple
+
+import GangaCore
+
+logger = GangaCore.Utility.logging.getLogger('gutils.specs')
+
+# Outcome of a spec: result is what the processing function returned, error the message of its exception
+SpecResult = namedtuple('SpecResult', 'spec ok seconds result error')
+
+_context = threading.local()
+
+
+def current_spec():
+    """Return the spec processed by the current thread (None outside of run_specs)."""
+    return getattr(_context, 'spec', None)
+
+
+class spec_context(object):
+    """Attribute what is done (and logged) in the enclosed block to spec."""
+
+    def __init__(self, spec):
+        self.spec = spec
+
+    def __enter__(self):
+        self.previous = current_spec()
+        _context.spec = self.spec
+
+    def __exit__(self, type, value, traceback):
+        _context.spec = self.previous
+        return False
+
+
+def _with_spec(spec, fn):
+    def wrapper(*args, **kwargs):
+        with spec_context(spec):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+class ContextExecutor(concurrent.futures.ThreadPoolExecutor):
+    """ThreadPoolExecutor whose tasks are attributed to the spec of the thread submitting them."""
+
+    def submit(self, fn, *args, **kwargs):
+        spec = current_spec()
+        if spec is not None:
+            fn = _with_spec(spec, fn)
+        return super(ContextExecutor, self).submit(fn, *args, **kwargs)
+
+
+_factory_lock = threading.Lock()
+_factory_installed = False
+
+
+def _install_record_factory():
+    """Prefix the log messages emitted within a spec_context with the spec (once)."""
+    global _factory_installed
+    with _factory_lock:
+        if _factory_installed:
+            return
+        factory = logging.getLogRecordFactory()
+
+        def spec_record_factory(*args, **kwargs):
+            record = factory(*args, **kwargs)
+            spec = current_spec()
+            if spec is not None:
+                record.msg = '[{}] {}'.format(spec, record.msg)
+            return record
+
+        logging.setLogRecordFactory(spec_record_factory)
+        _factory_installed = True
+
+
+def run_specs(specs, process, parallel=1):
+    """
+    Call process(spec) for each spec, with up to parallel specs at a time, and
+    return the list of SpecResult (in the order of specs). An exception fails
+    its spec only, the others are processed anyway.
+    """
+    _install_record_factory()
+
+    def run(spec):
+        start = time.time()
+        with spec_context(spec):
+            try:
+                result = process(spec)
+            except Exception as e:
+                logger.error('Failed: {}'.format(e))
+                logger.debug('Failure details', exc_info=True)
+                return SpecResult(spec, False, time.time() - start, None, str(e) or type(e).__name__)
+        return SpecResult(spec, True, time.time() - start, result, None)
+
+    if parallel <= 1 or len(specs) <= 1:
+        return [run(spec) for spec in specs]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as pool:
+        return list(pool.map(run, specs))
+
+
+def format_results(results):
+    """Return the per spec summary of run_specs as a table."""
+    width = max([len('spec')] + [len(r.spec) for r in results])
+    lines = ['{:<{w}}  {:<6} {:>9}  {}'.format('spec', 'status', 'time [s]', 'details', w=width)]
+    for r in results:
+        details = r.error if not r.ok else ('' if r.result is None else str(r.result))
+        lines.append('{:<{w}}  {:<6} {:>9.1f}  {}'.format(r.spec, 'OK' if r.ok else 'FAILED', r.seconds, details,
+                                                           w=width))
+    failed = sum(not r.ok for r in results)
+    lines.append('{} specs, {} succeeded, {} failed'.format(len(results), len(results) - failed, failed))
+    return '\n'.join(lines)
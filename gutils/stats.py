@@ -0,0 +1,143 @@
+"""
+Statistics of (master) jobs, computed in a single pass over their subjobs:
+status histogram, runtime percentiles, completions over time, failures per
+site and an estimate of the time to completion.
+"""
+import json
+import math
+import time
+import datetime
+from collections import Counter, OrderedDict
+
+import GangaCore
+from .utils import subjobs, master_id
+
+logger = GangaCore.Utility.logging.getLogger('gutils.stats')
+
+STATUSES = ['new', 'submitting', 'submitted', 'running', 'failed', 'completing', 'completed', 'killed']
+PERCENTILES = [50, 90, 99]
+
+# Width of the bins of completions over time (s)
+DEFAULT_BIN_SIZE = 3600
+
+
+def percentile(values, p):
+    """Return the p-th percentile (nearest rank) of sorted values."""
+    if not values:
+        return None
+    rank = int(math.ceil(p * len(values) / 100.0))  # p * n first, e.g. 90 / 100.0 * 10 > 9
+    return values[min(len(values), max(1, rank)) - 1]
+
+
+def _timestamp(t):
+    return time.mktime(t.timetuple()) if isinstance(t, datetime.datetime) else None
+
+
+def _site(job):
+    """Return the site (computing element) where a job ran, 'unknown' if not known."""
+    return getattr(job.backend, 'actualCE', None) or 'unknown'
+
+
+class _Accumulator(object):
+    """Statistics of a set of subjobs, filled one subjob at a time."""
+
+    def __init__(self):
+        self.statuses = Counter()
+        self.runtimes = []
+        self.completions = []  # timestamps of the completions
+        self.failed_sites = Counter()
+
+    def add(self, job):
+        self.statuses[job.status] += 1
+        if job.status == 'completed':
+            self.runtimes.append(job.time.runtime().total_seconds())
+            final = _timestamp(job.time.final())
+            if final is not None:
+                self.completions.append(final)
+        elif job.status == 'failed':
+            self.failed_sites[_site(job)] += 1
+
+    def update(self, other):
+        self.statuses.update(other.statuses)
+        self.runtimes += other.runtimes
+        self.completions += other.completions
+        self.failed_sites.update(other.failed_sites)
+
+    def report(self, bin_size=DEFAULT_BIN_SIZE, now=None):
+        now = now or time.time()
+        runtimes = sorted(self.runtimes)
+        completions = sorted(self.completions)
+        total = sum(self.statuses.values())
+        remaining = total - self.statuses['completed']
+
+        throughput = OrderedDict()
+        for t in completions:
+            start = datetime.datetime.fromtimestamp(t - t % bin_size).isoformat()
+            throughput[start] = throughput.get(start, 0) + 1
+
+        # completion rate since the first completion, the ETA assumes it stays the same
+        eta = None
+        if remaining == 0:
+            eta = 0.0
+        elif completions and now > completions[0]:
+            eta = remaining / (len(completions) / (now - completions[0]))
+
+        return OrderedDict([
+            ('subjobs', total),
+            ('statuses', OrderedDict((s, self.statuses[s]) for s in STATUSES + sorted(set(self.statuses) - set(STATUSES))
+                                     if self.statuses[s])),
+            ('runtime', OrderedDict(
+                [('count', len(runtimes)),
+                 ('mean', sum(runtimes) / len(runtimes) if runtimes else None)] +
+                [('p{}'.format(p), percentile(runtimes, p)) for p in PERCENTILES] +
+                [('max', runtimes[-1] if runtimes else None)])),
+            ('completed_per_bin', throughput),
+            ('bin_size', bin_size),
+            ('failed_per_site', OrderedDict(self.failed_sites.most_common())),
+            ('eta_seconds', eta),
+        ])
+
+
+def job_stats(jobs, bin_size=DEFAULT_BIN_SIZE):
+    """
+    Return the statistics of the given (master) jobs, per master and in total,
+    looking at each subjob only once:
+
+        {"masters": {master_id: stats}, "total": stats}
+
+    where stats is a dictionary (see _Accumulator.report) ready for json.dumps.
+    """
+    masters = OrderedDict()
+    for job in subjobs(jobs):
+        mid = master_id(job)
+        if mid not in masters:
+            masters[mid] = _Accumulator()
+        masters[mid].add(job)
+
+    total = _Accumulator()
+    for acc in masters.values():
+        total.update(acc)
+    now = time.time()
+    return OrderedDict([
+        ('masters', OrderedDict((str(mid), acc.report(bin_size, now)) for mid, acc in masters.items())),
+        ('total', total.report(bin_size, now)),
+    ])
+
+
+def job_stats_json(jobs, bin_size=DEFAULT_BIN_SIZE, **kwargs):
+    """Return the statistics of job_stats as a JSON string (kwargs are passed to json.dumps)."""
+    return json.dumps(job_stats(jobs, bin_size), **kwargs)
+
+
+def format_stats(stats):
+    """Return a short human readable summary of one entry of job_stats."""
+    lines = ['{}: {}'.format(s, n) for s, n in stats['statuses'].items()]
+    rt = stats['runtime']
+    if rt['count']:
+        lines.append('runtime: mean {:.0f} s, median {:.0f} s, p90 {:.0f} s, max {:.0f} s'.format(
+            rt['mean'], rt['p50'], rt['p90'], rt['max']))
+    if stats['failed_per_site']:
+        lines.append('failed per site: ' + ', '.join('{} {}'.format(s, n) for s, n in stats['failed_per_site'].items()))
+    if stats['eta_seconds'] is not None:
+        lines.append('ETA: {}'.format(datetime.timedelta(seconds=int(stats['eta_seconds']))))
+    return '\n'.join(lines)
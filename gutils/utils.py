@@ -1,13 +1,23 @@
 import os
 import re
+import json
+import time
+import queue
 import functools
 import logging
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import GangaDirac
 import GangaCore
 from GangaCore.GPIDev.Base.Proxy import GPIProxyObject
 from GangaCore.GPIDev.Lib.Job.Job import Job
 from GangaCore.GPIDev.Adapters.IGangaFile import IGangaFile
+from GangaCore.Utility.Config import getConfig
+from GangaCore.Utility.files import expandfilename
+from .bk_utils import BKSession, BKSessionError, DATA_MANAGER
+from .profiling import profiled
 logger = GangaCore.Utility.logging.getLogger('gutils.utils')
 
 
@@ -53,8 +63,20 @@ def is_existing_file(file, job=None):
     return ok
 
 
-def outputfiles(jobs, pattern, one_per_job=False, ignore_missing=True):
-    """Return a flat list of outputfiles matching the pattern for the given jobs."""
+@profiled()
+def outputfiles(jobs, pattern, one_per_job=False, ignore_missing=True, use_index=True):
+    """Return a flat list of outputfiles matching the pattern for the given jobs.
+       With use_index, the files are made from the output index (see
+       gutils.output_index) without looking at job.outputfiles, which are only
+       checked again for the subjobs which changed since they were indexed.
+    """
+    if use_index:
+        from .output_index import _output_entries, entry_file  # the index depends on this module
+        jobs = list(subjobs(jobs))
+        by_fqid = dict((job.fqid, job) for job in jobs)
+        return [(by_fqid[e.fqid], entry_file(e))
+                for e in _output_entries(jobs, pattern, one_per_job, ignore_missing)]
+
     files = []
     for job in subjobs(jobs):
         job_files = job.outputfiles.get(pattern)
@@ -80,32 +102,74 @@ def outputfiles(jobs, pattern, one_per_job=False, ignore_missing=True):
     return files
 
 
-def smart_jobs_select(specs):
+_SPEC = re.compile(r"^(?P<remove>-)?((?P<master>\d+)|(?P<subjob>\d+\.\d+)|(?P<range1>\d+):(?P<range2>\d+))$")
+
+
+def _master_fqids(master, status=None):
+    """Return the fqids of the subjobs (or of the master itself if it has none) with one of the statuses."""
+    n = len(master.subjobs)
+    if not n:
+        return [master.fqid] if status is None or master.status in status else []
+    if status is None:
+        # subjob ids are 0..n-1, no need to load the subjobs
+        return ['{}.{}'.format(master.id, i) for i in range(n)]
+    ids = set()
+    for stat in status:
+        ids.update(j.id for j in master.subjobs.select(status=stat))
+    return ['{}.{}'.format(master.id, i) for i in sorted(ids)]
+
+
+def _spec_fqids(spec, status=None, name=None):
+    """Return (remove, fqids) for a single job specifier (see smart_jobs_select)."""
+    m = _SPEC.match(spec)
+    if not m:
+        raise ValueError("Unsupported spec '{}'".format(spec))
+    if m.group('master'):
+        masters = [GangaCore.GPI.jobs(m.group('master'))]
+        masters = [j for j in masters if name is None or j.name == name]
+    elif m.group('subjob'):
+        job = GangaCore.GPI.jobs(m.group('subjob'))
+        ok = (status is None or job.status in status) and (name is None or job.name == name)
+        return bool(m.group('remove')), [job.fqid] if ok else []
+    elif m.group('range1'):
+        attrs = {'name': name} if name is not None else {}
+        masters = GangaCore.GPI.jobs.select(int(m.group('range1')), int(m.group('range2')), **attrs)
+    else:
+        assert False
+    fqids = []
+    for master in masters:
+        fqids += _master_fqids(master, status)
+    return bool(m.group('remove')), fqids
+
+
+@profiled()
+def smart_jobs_select(specs, status=None, name=None, resolve=True):
     """Return list of (sub)jobs from a list of string job specifiers.
 
     Examples:
         smart_jobs_select(['100', '-100.1', '105:110', '-108'])
         smart_jobs_select(['100.0', '100.1', '100.10'])
+        smart_jobs_select(['105:110'], status='completed')
+
+    Only (sub)jobs with the given status(es) and name are selected, the filters
+    are passed to jobs.select and subjobs.select. The selection works on fqids
+    and the job objects are only looked up at the end (with resolve=False the
+    fqids are returned instead).
     """
-    jobs = []
+    if isinstance(status, str):
+        status = [status]
+    selected = OrderedDict()  # used as an ordered set of fqids
     for spec in specs:
-        m = re.match(r"^(?P<remove>-)?((?P<master>\d+)|(?P<subjob>\d+\.\d+)|(?P<range1>\d+):(?P<range2>\d+))$", spec)
-        if not m:
-            raise ValueError("Unsupported spec '{}'".format(spec))
-        if m.group('master'):
-            sjobs = list(subjobs(GangaCore.GPI.jobs(m.group('master'))))
-        elif m.group('subjob'):
-            sjobs = [GangaCore.GPI.jobs(m.group('subjob'))]
-        elif m.group('range1'):
-            sjobs = list(subjobs(GangaCore.GPI.jobs.select(int(m.group('range1')), int(m.group('range2')))))
-        else:
-            assert False
-        if not m.group('remove'):
-            jobs += [j for j in sjobs if j not in jobs]  # add only unique
+        remove, fqids = _spec_fqids(spec, status, name)
+        if not remove:
+            selected.update((fqid, None) for fqid in fqids)  # add only unique
         else:
-            jobs = [j for j in jobs if j not in sjobs]  # keep only non-removed
+            for fqid in fqids:  # keep only non-removed
+                selected.pop(fqid, None)
 
-    return jobs
+    if not resolve:
+        return list(selected)
+    return [GangaCore.GPI.jobs(fqid) for fqid in selected]
 
 
 def master_id(job):
@@ -113,30 +177,276 @@ def master_id(job):
     return job.master.id if job.master else job.id
 
 
-def recheck(jobs, only_failed=True):
-    """Re-check (only failed) subjobs"""
+# Bulk operations on (sub)jobs: concurrent operations, operations per second, retries and backoff (s)
+BULK_WORKERS = 8
+BULK_RATE = 10.0
+BULK_RETRIES = 2
+BULK_BACKOFF = 5.0
+
+# Result of a bulk operation on a (sub)job, message says what was (or would be) done or the error
+BulkResult = namedtuple('BulkResult', 'fqid ok message tries')
+
+# Errors retried by bulk operations, as they may be transient: DIRAC errors (matched by class
+# name, including base classes, not to import the DIRAC modules) and I/O errors (e.g. network)
+TRANSIENT_ERRORS = ('GangaDiracError', 'DiracError')
+
+
+def _is_transient(e):
+    return isinstance(e, EnvironmentError) or any(c.__name__ in TRANSIENT_ERRORS for c in type(e).__mro__)
+
+
+def _status_changed(jobs):
+    """Return a function describing which of jobs changed status since now (None if none did)."""
+    before = [(job, job.status) for job in jobs]
+
+    def changed():
+        return ', '.join('{} is {}'.format(job.fqid, job.status) for job, status in before
+                         if job.status != status) or None
+    return changed
+
+
+class RateLimiter(object):
+    """Let at most rate calls to wait() through per second, across threads (no limit if rate is 0)."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def _run_bulk(tasks, workers=BULK_WORKERS, rate=BULK_RATE, retries=BULK_RETRIES, backoff=BULK_BACKOFF):
+    """
+    Run tasks, a list of (fqids, message, function, changed), concurrently and
+    return the list of BulkResult (one per fqid). Functions failing with a
+    transient error (see TRANSIENT_ERRORS) are retried with an exponential
+    backoff, unless changed (if not None) tells that the jobs changed status,
+    e.g. a resubmission which partly succeeded.
+    """
+    limiter = RateLimiter(rate)
+
+    def run(task):
+        fqids, message, function, changed = task
+        for i in range(retries + 1):
+            limiter.wait()
+            try:
+                function()
+                return [BulkResult(fqid, True, message, i + 1) for fqid in fqids]
+            except Exception as e:
+                error = '{}: {}'.format(type(e).__name__, e)
+                if not _is_transient(e):
+                    return [BulkResult(fqid, False, error, i + 1) for fqid in fqids]
+                status = changed() if changed else None
+                if status:
+                    error += ' (not retried, {})'.format(status)
+                    return [BulkResult(fqid, False, error, i + 1) for fqid in fqids]
+                if i < retries:
+                    logger.warning('{} failed for {} ({}), will retry'.format(message, ', '.join(fqids), error))
+                    time.sleep(backoff * 2 ** i)
+        return [BulkResult(fqid, False, error, retries + 1) for fqid in fqids]
+
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for task_results in pool.map(run, tasks):
+            results += task_results
+    return results
+
+
+def _dry_run(tasks):
+    results = []
+    for fqids, message, _, _ in tasks:
+        logger.info('Would do {}: {}'.format(message, ', '.join(fqids)))
+        results += [BulkResult(fqid, True, 'would do ' + message, 0) for fqid in fqids]
+    return results
+
+
+def _log_summary(results, what):
+    failed = [r for r in results if not r.ok]
+    logger.info('{}: {} (sub)jobs done, {} failed'.format(what, len(results) - len(failed), len(failed)))
+    for r in failed:
+        logger.error('{} failed for job {} after {} tries: {}'.format(what, r.fqid, r.tries, r.message))
+
+
+def _by_master(jobs):
+    """Return [(master or None, [subjobs])] keeping the order of jobs."""
+    groups = OrderedDict()
+    for job in jobs:
+        groups.setdefault(master_id(job), (job.master, []))[1].append(job)
+    return list(groups.values())
+
+
+@profiled()
+def recheck(jobs, only_failed=True, workers=BULK_WORKERS, rate=BULK_RATE, retries=BULK_RETRIES, dry_run=False):
+    """Re-check (only failed) subjobs concurrently, return the list of BulkResult."""
     # TODO this way of rerunning checkers may not work in the future
-    for job in subjobs(jobs):
-        if job.status == 'failed' or (not only_failed and job.status == 'completed'):
-            logger.info('Re-checking job {}'.format(job.fqid))
+    def check(job):
+        def function():
             if job.status == 'completed': job.force_status('failed')
             job.force_status('completed')
+        return function
 
+    tasks = [([job.fqid], 'recheck', check(job), None) for job in subjobs(jobs)
+             if job.status == 'failed' or (not only_failed and job.status == 'completed')]
+    if dry_run:
+        return _dry_run(tasks)
+    results = _run_bulk(tasks, workers, rate, retries)
+    _log_summary(results, 'Recheck')
+    return results
 
-def resubmit(jobs, only_failed=True):
-    """Resubmit (only failed) subjobs"""
-    for job in subjobs(jobs):
-        if not only_failed or job.status == 'failed':
-            job.resubmit()
 
+@profiled()
+def resubmit(jobs, only_failed=True, workers=BULK_WORKERS, rate=BULK_RATE, retries=BULK_RETRIES, dry_run=False):
+    """
+    Resubmit (only failed) subjobs concurrently, return the list of BulkResult.
+    When all the failed (or killed) subjobs of a master are resubmitted, they are
+    resubmitted through the master, in a single (bulk) backend operation.
+    """
+    tasks = []
+    for master, group in _by_master(j for j in subjobs(jobs) if not only_failed or j.status == 'failed'):
+        if master is not None and master.status == 'failed':
+            resubmittable = set(j.fqid for stat in ['failed', 'killed'] for j in master.subjobs.select(status=stat))
+            if resubmittable == set(j.fqid for j in group):
+                tasks.append(([j.fqid for j in group], 'resubmit through master {}'.format(master.id),
+                              master.resubmit, _status_changed(group)))
+                continue
+        tasks += [([j.fqid], 'resubmit', j.resubmit, _status_changed([j])) for j in group]
+    if dry_run:
+        return _dry_run(tasks)
+    results = _run_bulk(tasks, workers, rate, retries)
+    _log_summary(results, 'Resubmit')
+    return results
+
+
+# Removal of output data: LFNs per storage call, concurrent calls and timeout of a call (s)
+REMOVE_CHUNK_SIZE = 500
+REMOVE_WORKERS = 4
+REMOVE_TIMEOUT = 1800
+
+
+class RemovalProgress(object):
+    """
+    Record of the LFNs already deleted by remove() (one JSON list per line),
+    such that an interrupted removal can be resumed.
+    """
 
-def remove(jobs):
-    """Remove jobs and their data."""
+    def __init__(self, path):
+        self.path = path
+        self.deleted = set()
+        self._lock = threading.Lock()
+        if os.path.isfile(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        self.deleted.update(json.loads(line))
+                    except ValueError:
+                        pass  # truncated last line of an interrupted removal
+
+    def record(self, lfns):
+        with self._lock:
+            self.deleted.update(lfns)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(sorted(lfns)) + '\n')
+
+    def close(self):
+        """Forget the progress (when everything is removed)."""
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+@profiled()
+def remove_lfns(lfns, chunk_size=REMOVE_CHUNK_SIZE, workers=REMOVE_WORKERS, done=None):
+    """
+    Delete LFNs (all replicas) in chunks of chunk_size, with up to workers
+    concurrent storage calls (each in its own DIRAC helper process). LFNs which
+    no longer exist count as deleted. done(lfns) is called after each chunk.
+    Returns (deleted, {lfn: reason}).
+    """
+    lfns = list(lfns)
+    sessions = queue.Queue()
+    for _ in range(min(workers, (len(lfns) + chunk_size - 1) // chunk_size)):
+        sessions.put(BKSession(client=DATA_MANAGER, timeout=REMOVE_TIMEOUT))
+
+    def remove_chunk(chunk):
+        session = sessions.get()
+        try:
+            result = session.call('removeFile({!r})'.format(chunk))
+        except BKSessionError as e:
+            return [], dict((lfn, str(e)) for lfn in chunk)
+        finally:
+            sessions.put(session)
+        deleted = list(result['Successful'])
+        failed = {}
+        for lfn, reason in result['Failed'].items():
+            if 'no such file' in str(reason).lower():
+                deleted.append(lfn)
+            else:
+                failed[lfn] = str(reason)
+        if done and deleted:
+            done(deleted)
+        logger.info('Deleted {} files ({} failed)'.format(len(deleted), len(failed)))
+        return deleted, failed
+
+    deleted, failed = [], {}
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            chunks = [lfns[i:i + chunk_size] for i in range(0, len(lfns), chunk_size)]
+            for chunk_deleted, chunk_failed in pool.map(remove_chunk, chunks):
+                deleted += chunk_deleted
+                failed.update(chunk_failed)
+    finally:
+        while not sessions.empty():
+            sessions.get().close()
+    return deleted, failed
+
+
+def remove(jobs, chunk_size=REMOVE_CHUNK_SIZE, workers=REMOVE_WORKERS, progress=None):
+    """
+    Remove jobs and their data. The output LFNs of all jobs are gathered first
+    (from the output index) and deleted in batched, concurrent storage calls
+    (see remove_lfns). A job is only removed once all its output data is
+    deleted. The progress is recorded in a file (by default in the gangadir)
+    such that an interrupted removal can be resumed. Returns {lfn: reason}
+    of the LFNs which could not be deleted.
+    """
+    from .output_index import get_index
+    jobs = list(jobs)
     for job in jobs:
         if job.master:
             raise ValueError('remove cannot take subjobs')
-        job.backend.removeOutputData()
+    if progress is None:
+        progress = os.path.join(expandfilename(getConfig('Configuration')['gangadir']), 'remove_progress.jsonl')
+    progress = RemovalProgress(progress)
+
+    index = get_index()
+    job_lfns = OrderedDict()
+    for job in jobs:
+        sjobs = list(subjobs(job))
+        index.refresh(sjobs)
+        entries = index.entries([j.fqid for j in sjobs])
+        job_lfns[job.id] = set(e.location for es in entries.values() for e in es
+                               if e.type == 'DiracFile' and e.location)
+    todo = sorted(set().union(*job_lfns.values()) - progress.deleted)
+    logger.info('Deleting {} output files of {} jobs'.format(len(todo), len(jobs)))
+    _, failed = remove_lfns(todo, chunk_size, workers, done=progress.record)
+
+    for job in jobs:
+        left = job_lfns[job.id] - progress.deleted
+        if left:
+            logger.error('Will not remove job {}, {} of its output files could not be deleted'.format(job.id, len(left)))
+            continue
+        fqid = job.fqid
         job.remove()
+        index.forget([fqid])
+    if not failed:
+        progress.close()
+    return failed
 
 
 def runtimes(jobs):
@@ -145,11 +455,10 @@ def runtimes(jobs):
 
 
 def status(j):
-    """Return an overview of how many subjobs are in what status"""
-    for stat in ["new","submitting","submitted","running","failed","completing","completed"]:
-        l = len(j.subjobs.select(status=stat))
-        if l > 0:
-            print(stat+":", l)
+    """Return an overview of how many subjobs are in what status (see gutils.stats for more)"""
+    from .stats import job_stats  # the statistics depend on this module
+    for stat, n in job_stats(j)['total']['statuses'].items():
+        print(stat+":", n)
 
 
 def memoize(obj):
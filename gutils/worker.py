@@ -0,0 +1,163 @@
+"""
+Long-lived helper processes serving requests over their stdin/stdout.
+
+The helper reads one request per line and writes one response per line,
+prefixed with MARKER (anything else the helper prints is ignored). Each
+request carries an id, so that several threads can have requests in flight.
+The helper serves them one at a time, and writes the id (prefixed with
+STARTED) when it picks a request up: the timeout of a request runs from then,
+not while it is queued behind others.
+Used for the bookkeeping (bk_utils) and the ROOT (root_utils) helpers. This
+module must not depend on Ganga, as it is also imported by the helpers.
+"""
+import os
+import time
+import itertools
+import threading
+import subprocess
+from concurrent.futures import Future, TimeoutError
+
+MARKER = '@GUTILS@ '
+STARTED = '@GUTILS-STARTED@ '
+
+
+class WorkerError(RuntimeError):
+    pass
+
+
+def serve(handle, fin, fout, dumps, loads):
+    """Serve requests "[id, request]" read from fin until EOF, replying "[id, handle(request)]"."""
+    for line in fin:
+        request_id, request = loads(line)
+        fout.write(STARTED + dumps(request_id) + '\n')
+        fout.flush()
+        fout.write(MARKER + dumps([request_id, handle(request)]) + '\n')
+        fout.flush()
+
+
+class WorkerSession(object):
+    """
+    Client of a helper process started with command. The helper is (re)started
+    on demand, e.g. after a timeout or a crash. Subclasses define how requests
+    and responses are serialised (dumps/loads).
+    """
+    error = WorkerError
+
+    def __init__(self, command, timeout=120):
+        self.command = command
+        self.timeout = timeout
+        self._proc = None
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._pending = {}  # {request id: (process, future, event set when picked up or done)}
+        self._active = {}  # {process: time of its last pick up or response}
+
+    def dumps(self, obj):
+        raise NotImplementedError
+
+    def loads(self, s):
+        raise NotImplementedError
+
+    def _start(self):
+        env = os.environ.copy()
+        env.pop('TERM', None)  # fix for https://bugs.python.org/issue19884
+        self._proc = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                      universal_newlines=True, bufsize=1, env=env)
+        self._active[self._proc] = time.time()
+        reader = threading.Thread(target=self._read, args=(self._proc,))
+        reader.daemon = True
+        reader.start()
+
+    def _read(self, proc):
+        for line in proc.stdout:
+            if line.startswith(STARTED):
+                with self._lock:
+                    self._active[proc] = time.time()
+                    _, _, picked = self._pending.get(self.loads(line[len(STARTED):]), (None, None, None))
+                if picked:
+                    picked.set()
+            elif line.startswith(MARKER):
+                request_id, response = self.loads(line[len(MARKER):])
+                with self._lock:
+                    self._active[proc] = time.time()
+                    _, future, picked = self._pending.pop(request_id, (None, None, None))
+                if future:
+                    future.set_result(response)
+                    picked.set()
+        # the helper exited, fail its requests still in flight
+        with self._lock:
+            self._active.pop(proc, None)
+            died = [(k, f, e) for k, (p, f, e) in self._pending.items() if p is proc]
+            for k, _, _ in died:
+                del self._pending[k]
+        for _, future, picked in died:
+            future.set_exception(self.error('Helper process exited ({})'.format(proc.poll())))
+            picked.set()
+
+    def _submit(self, request):
+        """
+        Send a request, return (the helper it went to, the future of its response,
+        the event set when the helper picks it up).
+        """
+        future, picked = Future(), threading.Event()
+        with self._lock:
+            if self._proc is None or self._proc.poll() is not None:
+                try:
+                    self._start()
+                except OSError as e:
+                    raise self.error('Cannot start helper process {}: {}'.format(self.command, e))
+            proc = self._proc
+            request_id = next(self._ids)
+            self._pending[request_id] = (proc, future, picked)
+            try:
+                proc.stdin.write(self.dumps([request_id, request]) + '\n')
+                proc.stdin.flush()
+            except IOError as e:
+                del self._pending[request_id]
+                future.set_exception(self.error('Cannot write to helper process: {}'.format(e)))
+                picked.set()
+        return proc, future, picked
+
+    def _wait(self, proc, future, picked, timeout):
+        """
+        Return the response of a request, within timeout from when the helper
+        picked it up. While queued, it only times out if the helper did not
+        pick up or answer any request for timeout.
+        """
+        while not picked.wait(timeout):
+            with self._lock:
+                idle = time.time() - self._active.get(proc, 0)
+            if idle >= timeout:
+                raise TimeoutError()
+        return future.result(timeout)
+
+    def restart(self, proc=None):
+        """
+        Stop the helper, a new one is started with the next request. If proc is
+        given, it is only stopped if it is still the current helper, so that the
+        helper started after it (e.g. by another thread) is not killed.
+        """
+        with self._lock:
+            if proc is None:
+                proc = self._proc
+            elif proc is not self._proc:
+                return
+            self._proc = None
+        if proc and proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+    close = restart
+
+    def request(self, request, timeout=None, tries=3):
+        """
+        Send a request and return the response, restarting its helper on timeouts
+        (see _wait) or crashes.
+        """
+        for i in range(tries):
+            proc, future, picked = self._submit(request)
+            try:
+                return self._wait(proc, future, picked, timeout or self.timeout)
+            except (TimeoutError, WorkerError):
+                self.restart(proc)
+        raise self.error('Request timed out or failed {} times! Increase timeout.'.format(tries))
@@ -1,9 +1,12 @@
 import os
+import sys
 import argparse
 import tempfile
 import GangaCore
+from gutils.profiling import profile_to
+from gutils.specs import run_specs, format_results
 from gutils.utils import smart_jobs_select
-from gutils.download import download
+from gutils.download import download, verify, DEFAULT_WORKERS
 
 logger = GangaCore.Utility.logging.getLogger('gdownload')
 
@@ -12,13 +15,22 @@ parser = argparse.ArgumentParser(description='Download outputfiles')
 parser.add_argument('jobs', nargs='+', help='Job IDs')
 parser.add_argument('--name', '-n', required=True, help='Name of job output file in job.outputfiles')
 parser.add_argument('--output', '-o', default=tempfile.gettempdir(), help='Where to put the downloaded files? Defaults to $TMPDIR')
-parser.add_argument('--overwrite', action='store_true', help='Overwrite existing output file')
+parser.add_argument('--overwrite', action='store_true', help='Download again files that are already downloaded and verified')
+parser.add_argument('--jobs', '-j', type=int, default=DEFAULT_WORKERS, dest='workers', help='Number of concurrent downloads (default: %(default)s)')
+parser.add_argument('--stream', action='store_true', help='Stream DIRAC files from their fastest replica (checksummed while written), falling back to DIRAC')
+parser.add_argument('--verify-only', action='store_true', help='Only check previously downloaded files against the manifest, do not download')
+parser.add_argument('--parallel', type=int, default=1, metavar='N', help='Number of job arguments processed concurrently (default: %(default)s)')
+parser.add_argument('--profile', metavar='TRACE', help='Profile and write a trace (JSON, for chrome://tracing) to TRACE, print a summary at the end')
 args = parser.parse_args()
 
+if args.profile:
+    profile_to(args.profile)
+
 if not os.path.isdir(args.output):
     parser.error('Output (--output) must be an existing directory!')
 
-for specs in args.jobs:
+
+def download_spec(specs):
     jobs = smart_jobs_select(specs.split(','))
 
     unique_names = list(set(j.name for j in jobs))
@@ -27,12 +39,34 @@ for specs in args.jobs:
     # if only one job is given, download in a directory named after the job
     if len(unique_names) == 1:
         path = os.path.join(args.output, unique_names[0])
-        os.mkdir(path)
+        if not args.verify_only:
+            os.makedirs(path, exist_ok=True)  # specs with the same job name may run in parallel
         logger.info('Downloading files for job(s) {} named {}'.format(specs, unique_names[0]))
     else:
         path = args.output
         logger.warning('Downloading jobs with multiple names ({}).'.format(unique_names))
 
-    download(jobs, args.name, path)
+    if args.verify_only:
+        status = verify(jobs, args.name, path)
+        for problem in ['missing', 'corrupt']:
+            for fn in status[problem]:
+                logger.warning('File {} is {}'.format(fn, problem))
+        summary = '{} verified, {} missing, {} corrupt files in {}'.format(
+            len(status['ok']), len(status['missing']), len(status['corrupt']), path)
+        logger.info(summary)
+        if status['missing'] or status['corrupt']:
+            raise RuntimeError(summary)
+        return summary
+
+    downloaded = download(jobs, args.name, path, workers=args.workers, overwrite=args.overwrite,
+                          stream=args.stream)
 
     logger.info('Your downloads are at {}'.format(path))
+    return '{} files in {}'.format(len(downloaded), path)
+
+
+results = run_specs(args.jobs, download_spec, parallel=args.parallel)
+if len(results) > 1:
+    logger.info('Summary:\n' + format_results(results))
+if not all(r.ok for r in results):
+    sys.exit(1)
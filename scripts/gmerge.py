@@ -1,9 +1,13 @@
 import os
+import sys
 import argparse
 import tempfile
 from gutils.utils import master_id, smart_jobs_select
-from gutils.merge import direct_merge, download_merge
+from gutils.merge import direct_merge, download_merge, MERGE_FANIN, MERGE_WORKERS
+from gutils.download import DEFAULT_WORKERS
 import GangaCore
+from gutils.profiling import profile_to
+from gutils.specs import run_specs, format_results
 
 logger = GangaCore.Utility.logging.getLogger('gmerge')
 
@@ -14,12 +18,22 @@ parser.add_argument('--output', '-o', default=tempfile.gettempdir(), help='Where
 parser.add_argument('--overwrite', action='store_true', help='Overwrite existing output file')
 parser.add_argument('--ignore-incomplete', action='store_true', help='Ignore non-completed jobs')
 parser.add_argument('--download', action='store_true', help='Download files and merge locally')
+parser.add_argument('--jobs', '-j', type=int, default=DEFAULT_WORKERS, dest='workers', help='Number of concurrent downloads with --download (default: %(default)s)')
+parser.add_argument('--scratch-budget', type=float, default=None, help='With --download, maximum scratch disk space (in GB) for downloaded and partially merged files (larger partial merges are kept next to the output)')
+parser.add_argument('--fanin', type=int, default=MERGE_FANIN, help='Maximum number of ROOT files per hadd, more are merged hierarchically (default: %(default)s, 0 for a flat merge)')
+parser.add_argument('--merge-workers', type=int, default=MERGE_WORKERS, help='Number of concurrent hadd processes in hierarchical merges (default: %(default)s)')
+parser.add_argument('--parallel', type=int, default=1, metavar='N', help='Number of job arguments (outputs) processed concurrently (default: %(default)s)')
+parser.add_argument('--profile', metavar='TRACE', help='Profile and write a trace (JSON, for chrome://tracing) to TRACE, print a summary at the end')
 args = parser.parse_args()
 
+if args.profile:
+    profile_to(args.profile)
+
 if not os.path.isdir(args.output):
     parser.error('Output (--output) must be an existing directory!')
 
-for specs in args.jobs:
+
+def merge(specs):
     jobs = smart_jobs_select(specs.split(','))
 
     unique_names = list(set(j.name for j in jobs))
@@ -38,12 +52,22 @@ for specs in args.jobs:
             jobs = [j for j in jobs if j.status == 'completed']
             logger.warning('Ignoring incomplete jobs! Output filename will be suffixed with "partial".')
         else:
-            logger.error('There are incomplete jobs! Will not do merging!')
-            break
+            raise RuntimeError('There are incomplete jobs! Will not do merging!')
 
     if not args.download:
-        direct_merge(jobs, args.name, args.output, overwrite=args.overwrite, partial=partial)
+        return direct_merge(jobs, args.name, args.output, overwrite=args.overwrite, partial=partial,
+                            fanin=args.fanin, merge_workers=args.merge_workers)
     else:
-        download_merge(jobs, args.name, args.output, overwrite=args.overwrite, partial=partial, keep_temp=False)
+        return download_merge(jobs, args.name, args.output, overwrite=args.overwrite, partial=partial, keep_temp=False, workers=args.workers,
+                              scratch_budget=args.scratch_budget * 1e9 if args.scratch_budget else None,
+                              fanin=args.fanin, merge_workers=args.merge_workers)
+
 
-logger.info('Your merged files are at {}'.format(args.output))
+results = run_specs(args.jobs, merge, parallel=args.parallel)
+if len(results) > 1:
+    logger.info('Summary:\n' + format_results(results))
+merged = [r.result for r in results if r.ok]
+if merged:
+    logger.info('Your merged files are at:\n' + '\n'.join(merged))
+if not all(r.ok for r in results):
+    sys.exit(1)
@@ -0,0 +1,29 @@
+import sys
+import argparse
+import GangaCore
+from gutils.utils import smart_jobs_select
+from gutils.stats import job_stats, format_stats, DEFAULT_BIN_SIZE
+
+logger = GangaCore.Utility.logging.getLogger('gstats')
+
+
+parser = argparse.ArgumentParser(description='Statistics of (sub)jobs')
+parser.add_argument('jobs', nargs='+', help='Job IDs')
+parser.add_argument('--json', action='store_true', help='Print the statistics as JSON (e.g. for monitoring)')
+parser.add_argument('--bin-size', type=int, default=DEFAULT_BIN_SIZE, help='Width (in seconds) of the bins of completed jobs over time (default: %(default)s)')
+args = parser.parse_args()
+
+jobs = smart_jobs_select(args.jobs)
+stats = job_stats(jobs, bin_size=args.bin_size)
+
+if args.json:
+    import json
+    json.dump(stats, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+else:
+    for mid, master_stats in stats['masters'].items():
+        print('Job {}:'.format(mid))
+        print('    ' + format_stats(master_stats).replace('\n', '\n    '))
+    if len(stats['masters']) > 1:
+        print('Total:')
+        print('    ' + format_stats(stats['total']).replace('\n', '\n    '))
@@ -0,0 +1,14 @@
+import os
+import sys
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+try:
+    import GangaCore  # noqa: F401
+except ImportError:  # outside of Ganga, use the stand-ins of the benchmarks
+    sys.path.insert(0, os.path.join(ROOT_DIR, 'benchmarks'))
+    import fakes
+    fakes.install(tempfile.mkdtemp(prefix='gutils-tests-'))
@@ -0,0 +1,17 @@
+import datetime
+
+from gutils.bk_utils import _dumps, _loads
+
+
+class DiracObject(object):
+    def __repr__(self):
+        return '<DiracObject at 0x1234>'
+
+
+def test_results_round_trip():
+    start = datetime.datetime(2018, 5, 4, 12, 30, 1, 25)
+    result = {200000: {'Fill': 7000, 'Start': start, 'Streams': set(), 'Types': frozenset(['RAW'])},
+              (1, 2): [None, True, 1.5], 'object': DiracObject()}
+    assert _loads(_dumps([True, result])) == [True, {
+        200000: {'Fill': 7000, 'Start': start, 'Streams': [], 'Types': ['RAW']},
+        (1, 2): [None, True, 1.5], 'object': '<DiracObject at 0x1234>'}]
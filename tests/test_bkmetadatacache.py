@@ -0,0 +1,28 @@
+import time
+
+from GangaLHCbExt import BKMetadataCache
+
+
+def test_eviction(tmp_path, monkeypatch):
+    monkeypatch.setattr(BKMetadataCache, 'EVICT_INTERVAL', 3)
+    cache = BKMetadataCache.BKMetadataCache(str(tmp_path / 'bk.sqlite'), maxEntries=5)
+    lfns = ['/lhcb/test/{}'.format(i) for i in range(10)]
+    for lfn in lfns:
+        cache.store({lfn: {'RunNumber': 1}})
+        time.sleep(0.002)
+    assert cache.stats()['entries'] == 6  # evicted at the 9th store, one stored since
+    cache.evictIfStored()
+    assert sorted(cache.lookup(lfns)) == lfns[5:]
+
+    cache.expiry = 1e-9
+    cache.evict()
+    assert cache.stats()['entries'] == 0
+
+
+def test_eviction_of_a_batch(tmp_path, monkeypatch):
+    cache = BKMetadataCache.BKMetadataCache(str(tmp_path / 'bk.sqlite'), maxEntries=5)
+    monkeypatch.setattr(BKMetadataCache.time, 'time', lambda: 1000.0)  # one creation time for all
+    lfns = ['/lhcb/test/{}'.format(i) for i in range(8)]
+    cache.store(dict((lfn, {'RunNumber': 1}) for lfn in lfns))
+    cache.evict()
+    assert cache.stats()['entries'] == 5  # not the whole batch
@@ -0,0 +1,15 @@
+from GangaLHCbExt.DiracRunSplitter import _splitEvenly
+
+
+def test_split_evenly_after_heavy_file():
+    weights = [50000, 1000, 8000, 1000] + [1000] * 40
+    chunks = _splitEvenly(weights, lambda w: w, 10, 100)
+    assert chunks[0] == [50000]
+    # the light files are not split one per chunk after the heavy file
+    assert [sum(c) for c in chunks[1:]] == [10000] * 5
+    assert sum(len(c) for c in chunks) == len(weights)
+
+
+def test_split_evenly_max_files():
+    chunks = _splitEvenly([1] * 10, lambda w: w, 2, 3)
+    assert [len(c) for c in chunks] == [3, 2, 3, 2]
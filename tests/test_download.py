@@ -0,0 +1,86 @@
+import os
+import sys
+import threading
+
+import fakes
+from gutils import download
+
+
+def test_rank_replicas_does_not_wait_for_other_probes(monkeypatch):
+    release = threading.Event()
+    probed = []
+
+    def probe(url):
+        probed.append(url)
+        if 'slow' in url:
+            release.wait(10)
+        return 1.0 if 'slow' in url else 0.1
+
+    monkeypatch.setattr(download, 'probe', probe)
+    monkeypatch.setattr(download, '_se_probes', {})
+    fast = {'/lfn/1': ['root://fast/1']}
+    slow = {'/lfn/2': ['root://slow/2', 'root://fast/2']}
+    assert download.rank_replicas(fast) == fast
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(download.rank_replicas(slow))) for _ in range(2)]
+    for t in threads:
+        t.start()
+    # the fast storage element was probed, ranking its replicas must not wait for the slow probe
+    assert download.rank_replicas(fast) == fast
+    assert not results
+    release.set()
+    for t in threads:
+        t.join()
+    assert results == [{'/lfn/2': ['root://fast/2', 'root://slow/2']}] * 2
+    assert probed == ['root://fast/1', 'root://slow/2']
+
+
+def test_rank_replicas_probes_again_after_ttl(monkeypatch):
+    probed = []
+    monkeypatch.setattr(download, 'probe', lambda url: probed.append(url) or 0.1)
+    monkeypatch.setattr(download, '_se_probes', {})
+    replicas = {'/lfn/1': ['root://se/1']}
+    download.rank_replicas(replicas)
+    download.rank_replicas(replicas)
+    assert len(probed) == 1
+    monkeypatch.setattr(download, 'PROBE_TTL', -1)
+    download.rank_replicas(replicas)
+    assert len(probed) == 2
+
+
+def _stored_files(first_id, n, size):
+    """Return [(job, file)] of n subjobs, whose files of size bytes are in the fake storage."""
+    registry = fakes.make_registry(1, n, failed=0, first_id=first_id)
+    files = []
+    for job in list(registry.jobs.values())[0].subjobs:
+        path = fakes.storage_path(job.outputfiles[1].lfn)
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        files.append((job, job.outputfiles[1]))
+    return files
+
+
+def test_stream_falls_back_to_dirac(tmpdir):
+    (job, file), = _stored_files(3000, 1, 1000)
+    path = str(tmpdir.join('job.root'))
+    manifest = download.Manifest(str(tmpdir))
+    with download.DownloadEngine(workers=1, backoff=0, manifest=manifest) as engine:
+        future = engine.submit(file, path, job.fqid, urls=['root://dead.fake//lhcb/missing.root'],
+                               expected=(1000, None))
+    result = future.result()
+    assert result.ok and result.attempts == 1 and result.bytes == 1000
+    assert manifest.verify(path) == 'ok'
+
+
+def test_download_files_checks_bulk_metadata(tmpdir, monkeypatch):
+    files = _stored_files(3001, 3, 100)
+    utilities = sys.modules['GangaDirac.Lib.Utilities.DiracUtilities']
+    calls = []
+    execute = utilities.execute
+    monkeypatch.setattr(utilities, 'execute', lambda command: calls.append(command) or execute(command))
+    downloaded = download.download_files(files, str(tmpdir), workers=2)
+    assert len(downloaded) == 3 and len(calls) == 1
+    manifest = download.Manifest(str(tmpdir))
+    assert all(manifest.verify(fn) == 'ok' for fn in downloaded)
@@ -0,0 +1,25 @@
+from GangaLHCbExt.LHCbBookkeepingChecker import _MasterMetadata
+
+
+class Job(object):
+    def __init__(self, id, status='running', subjobs=()):
+        self.id = id
+        self.status = status
+        self.subjobs = list(subjobs)
+
+
+def test_master_done_with_failed_subjobs():
+    master = Job(1, subjobs=[Job(0), Job(1, 'failed'), Job(2), Job(3, 'killed')])
+    metadata = _MasterMetadata.get(master)
+
+    master.subjobs[0].status = 'completing'
+    metadata.checked(master.subjobs[0], 10.0, 11.0)
+    assert list(metadata.pending) == [2, 3]  # stops at the first subjob still to be checked
+    assert _MasterMetadata.get(master) is metadata
+
+    master.subjobs[2].status = 'completing'
+    metadata.checked(master.subjobs[2], 12.0, 15.0)
+    assert not metadata.pending
+    assert (metadata.nchecked, metadata.nunchecked) == (2, 2)
+    assert metadata.lastCheck - metadata.firstCheck == 5.0  # wall time, not the sum of the checks
+    assert master.id not in _MasterMetadata._instances
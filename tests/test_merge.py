@@ -0,0 +1,157 @@
+import os
+import json
+import threading
+import time
+
+import pytest
+
+import fakes
+import generators
+from gutils.merge import _pipelined_download_merge
+
+ENTRIES = 1000
+
+
+def _scratch_size(directory):
+    size = 0
+    for root, _, names in os.walk(directory):
+        for name in names:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+@pytest.mark.parametrize('budget', [None, 5000, 2500])
+def test_download_merge_scratch_budget(tmp_path, budget):
+    registry = fakes.make_registry(1, 20, failed=0, first_id=2000 + (budget or 0))
+    jobs = list(registry.jobs.values())[0].subjobs
+    for job in jobs:
+        path = fakes.storage_path(job.outputfiles[1].lfn)
+        os.makedirs(os.path.dirname(path))
+        trees = dict(('Tuple{}/DecayTree'.format(i), 1) for i in range(20))
+        trees['DecayTree'] = ENTRIES
+        generators.make_root_file(path, trees)
+    files = [(job, job.outputfiles[1]) for job in jobs]
+    tempdir = tmp_path / 'scratch'
+    tempdir.mkdir()
+    output = str(tmp_path / 'merged.root')
+
+    peak = [0]
+    stop = threading.Event()
+
+    def sample():
+        while not stop.is_set():
+            peak[0] = max(peak[0], _scratch_size(str(tempdir)))
+            stop.wait(0.001)
+
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    fakes.set_latency(0.01)
+    try:
+        _pipelined_download_merge(files, str(tempdir), output, 4, 8, budget, False, fanin=0)
+    finally:
+        stop.set()
+        sampler.join()
+        fakes.set_latency(0.0)
+
+    with open(output) as f:
+        assert json.load(f)['DecayTree'] == ENTRIES * len(files)
+    if budget:
+        file_size = os.path.getsize(fakes.storage_path(files[0][1].lfn))
+        assert peak[0] <= budget + file_size  # the estimate of a download may be off by one file
+
+
+def test_stream_concatenate_window(tmp_path, monkeypatch):
+    from gutils import merge
+    opened = []
+
+    class Reader(object):
+        def __init__(self, url):
+            self.url = url
+            self.data = url.encode()
+            opened.append(url)
+
+        def read(self, size):
+            if self.url == 'slow':
+                time.sleep(0.3)  # the other streams must wait for the consumer
+                windows.append(len(opened))
+            data, self.data = self.data, b''
+            return data
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+    windows = []
+    monkeypatch.setattr(merge, 'StreamReader', Reader)
+    inputs = ['slow'] + ['input-{}'.format(i) for i in range(20)]
+    output = str(tmp_path / 'out.mdf')
+    nbytes, _ = merge._stream_concatenate(inputs, output, prefetch=4, max_chunks=4)
+    with open(output, 'rb') as f:
+        assert f.read() == ''.join(inputs).encode()
+    assert nbytes == len(''.join(inputs))
+    assert windows[0] <= 4  # only the prefetch window was started while the first input was slow
+
+
+def _stored_jobs(first_id, n, name, make):
+    registry = fakes.make_registry(1, n, failed=0, first_id=first_id, name=name)
+    jobs = list(registry.jobs.values())[0].subjobs
+    for i, job in enumerate(jobs):
+        path = fakes.storage_path(job.outputfiles[1].lfn)
+        os.makedirs(os.path.dirname(path))
+        make(path, i)
+    return [(job, job.outputfiles[1]) for job in jobs]
+
+
+def test_download_merge_mdf_counts_output_once(tmp_path, monkeypatch):
+    from gutils import merge
+    files = _stored_jobs(2100, 12, 'job.mdf', lambda path, i: generators.make_mdf_file(path, 5, 1000, seed=i))
+    output = str(tmp_path / 'merged.mdf')
+    counted = []
+    count_events = merge._count_events
+    monkeypatch.setattr(merge, '_count_events', lambda path: counted.append(path) or count_events(path))
+    errors = []
+    monkeypatch.setattr(merge.logger, 'error', errors.append)
+    (tmp_path / 'scratch').mkdir()
+    _pipelined_download_merge(files, str(tmp_path / 'scratch'), output, 2, 3, None, False)
+    assert merge.count_events(output) == 5 * len(files)
+    assert counted.count(output) == 1 and not errors
+
+
+def test_download_merge_folds_output_once(tmp_path, monkeypatch):
+    from gutils import merge
+    files = _stored_jobs(2200, 20, 'job.root', lambda path, i: generators.make_root_file(path, {'DecayTree': ENTRIES}))
+    output = str(tmp_path / 'merged.root')
+    merged = []
+    _merge = merge._merge
+    monkeypatch.setattr(merge, '_merge',
+                        lambda inputs, out, **kwargs: merged.append(list(inputs)) or _merge(inputs, out, **kwargs))
+    (tmp_path / 'scratch').mkdir()
+    budget = 4 * os.path.getsize(fakes.storage_path(files[0][1].lfn))
+    _pipelined_download_merge(files, str(tmp_path / 'scratch'), output, 2, 2, budget, False, fanin=0)
+    with open(output) as f:
+        assert json.load(f)['DecayTree'] == ENTRIES * len(files)
+    inputs = [fn for batch in merged for fn in batch]
+    assert any(os.path.basename(fn).startswith('.tmp-') for fn in inputs)  # the intermediates were folded
+    assert output not in inputs and len(inputs) == len(set(inputs))  # each file is merged once
+    assert not [fn for fn in os.listdir(str(tmp_path)) if fn.startswith('.tmp-')]
+
+
+@pytest.mark.parametrize('fanin', [0, 3])
+def test_merge_root_fails_over_to_next_replica(tmp_path, monkeypatch, fanin):
+    from gutils import merge
+    files = _stored_jobs(2300 + fanin, 6, 'job.root', lambda path, i: generators.make_root_file(path, {'DecayTree': ENTRIES}))
+    dead = 'root://dead.fake//lhcb/missing/{}.root'
+    inputs = [[dead.format(i), 'root://se.fake/' + file.lfn] if i % 2 else ['root://se.fake/' + file.lfn]
+              for i, (job, file) in enumerate(files)]
+    errors = []
+    monkeypatch.setattr(merge.logger, 'error', errors.append)
+    output = str(tmp_path / 'merged.root')
+    merge._merge(inputs, output, fanin=fanin)
+    with open(output) as f:
+        assert json.load(f)['DecayTree'] == ENTRIES * len(files)
+    assert not errors  # the entries were counted on the replicas merged
@@ -0,0 +1,60 @@
+import os
+
+import fakes
+from gutils.output_index import OutputIndex
+from gutils.utils import outputfiles
+from gutils import output_index
+
+
+class Untouchable(fakes.FileList):
+    def __getitem__(self, i):
+        raise AssertionError('job.outputfiles was used')
+
+    def __iter__(self):
+        raise AssertionError('job.outputfiles was used')
+
+
+def _index(tmp_path, monkeypatch):
+    index = OutputIndex(str(tmp_path / 'index.sqlite'))
+    monkeypatch.setattr(output_index, '_index', index)
+    return index
+
+
+def test_outputfiles_from_index(tmp_path, monkeypatch):
+    _index(tmp_path, monkeypatch)
+    registry = fakes.make_registry(1, 10, failed=0.3, first_id=4000)
+    jobs = list(registry.jobs.values())[0].subjobs
+    expected = [(job.fqid, job.outputfiles[1].lfn) for job in jobs if job.status == 'completed']
+    assert [(j.fqid, f.lfn) for j, f in outputfiles(jobs, 'job.root')] == expected
+    for job in jobs:
+        job.outputfiles = Untouchable(job.outputfiles)
+    assert [(j.fqid, f.lfn) for j, f in outputfiles(jobs, 'job.root')] == expected
+
+
+def test_resubmitted_subjob_is_indexed_again(tmp_path, monkeypatch):
+    index = _index(tmp_path, monkeypatch)
+    registry = fakes.make_registry(1, 2, failed=0, first_id=4001)
+    job = list(registry.jobs.values())[0].subjobs[0]
+    assert index.refresh([job]) == 1
+    assert index.refresh([job]) == 0
+    job.resubmit()
+    job.outputfiles[1].lfn = '/lhcb/user/b/bench/resubmitted.root'
+    job.status = 'completed'  # back in the indexed status
+    assert index.refresh([job]) == 1
+    assert [f.lfn for _, f in outputfiles([job], 'job.root')] == ['/lhcb/user/b/bench/resubmitted.root']
+    # the index is reopened with the same version
+    index = _index(tmp_path, monkeypatch)
+    assert index.refresh([job]) == 0
+
+
+def test_local_files_are_rechecked(tmp_path, monkeypatch):
+    _index(tmp_path, monkeypatch)
+    registry = fakes.make_registry(1, 1, file_type='LocalFile', failed=0, first_id=4002)
+    job = list(registry.jobs.values())[0].subjobs[0]
+    job.outputdir = str(tmp_path / 'output')
+    assert outputfiles([job], 'job.root') == []
+    os.makedirs(job.outputdir)
+    with open(os.path.join(job.outputdir, 'job.root'), 'w') as f:
+        f.write('data')
+    (_, f), = outputfiles([job], 'job.root')
+    assert f.localDir == job.outputdir
@@ -0,0 +1,148 @@
+import os
+import sys
+import threading
+
+import pytest
+
+import gutils
+from gutils.root_utils import RootHelper
+from gutils.worker import WorkerError
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(gutils.__file__)))
+
+# A helper serving {"method": "sleep", "params": {"seconds": s}} (one request at a time, as the ROOT helper)
+SLEEP_HELPER = '''
+import sys, json, time
+sys.path.insert(0, {root!r})
+from gutils.worker import serve
+
+def handle(request):
+    time.sleep(request['params']['seconds'])
+    return {{'ok': True, 'result': request['params']['seconds']}}
+
+serve(handle, sys.stdin, sys.stdout, json.dumps, json.loads)
+'''
+
+
+class CountingHelper(RootHelper):
+    def __init__(self, *args, **kwargs):
+        super(CountingHelper, self).__init__(*args, **kwargs)
+        self.started = 0
+
+    def _start(self):
+        self.started += 1
+        super(CountingHelper, self)._start()
+
+
+@pytest.fixture
+def helper(tmp_path):
+    script = tmp_path / 'helper.py'
+    script.write_text(SLEEP_HELPER.format(root=ROOT_DIR))
+    helper = CountingHelper(command=[sys.executable, str(script)], timeout=10)
+    yield helper
+    helper.close()
+
+
+def test_call(helper):
+    assert helper.call('sleep', seconds=0) == 0
+    assert helper.call('sleep', seconds=0) == 0
+    assert helper.started == 1
+
+
+def test_timeout_does_not_kill_replacement(helper):
+    helper.call('sleep', seconds=0)
+    results, errors = [], []
+
+    def slow():
+        try:
+            helper.request({'method': 'sleep', 'params': {'seconds': 30}}, timeout=0.5, tries=1)
+        except WorkerError as e:
+            errors.append(e)
+
+    def fast():
+        results.append(helper.call('sleep', seconds=0))
+
+    threads = [threading.Thread(target=slow)]
+    threads[0].start()
+    threads[0].join(0.1)  # the fast requests wait behind the slow one
+    threads += [threading.Thread(target=fast) for _ in range(8)]
+    for t in threads[1:]:
+        t.start()
+    for t in threads:
+        t.join(30)
+
+    assert len(errors) == 1
+    assert results == [0] * 8
+    assert helper.started == 2  # only the helper of the slow request was restarted
+
+
+def test_queued_requests_do_not_time_out(helper):
+    helper.call('sleep', seconds=0)
+    results, errors = [], []
+
+    def queued():
+        try:
+            results.append(helper.request({'method': 'sleep', 'params': {'seconds': 0.3}}, timeout=1, tries=1))
+        except WorkerError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=queued) for _ in range(6)]  # served one after the other in 1.8 s
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(30)
+
+    assert not errors and len(results) == 6
+    assert helper.started == 1
+
+
+def test_stale_restart_is_ignored(helper):
+    helper.call('sleep', seconds=0)
+    old = helper._proc
+    helper.restart(old)
+    helper.call('sleep', seconds=0)
+    new = helper._proc
+    helper.restart(old)
+    assert helper._proc is new and new.poll() is None
+    assert helper.call('sleep', seconds=0) == 0
+    assert helper.started == 2
+
+
+class EntriesHelper(object):
+    def __init__(self):
+        self.counted = []
+
+    def call(self, method, files, processes):
+        self.counted += files
+        return dict((f, [{'DecayTree': len(f)}, None]) for f in files)
+
+
+def test_remote_entries_cached_by_version(monkeypatch):
+    from gutils import root_utils
+    helper = EntriesHelper()
+    monkeypatch.setattr(root_utils, 'get_helper', lambda: helper)
+    monkeypatch.setattr(root_utils, 'ENTRIES_CACHE_SIZE', 2)
+    monkeypatch.setattr(root_utils, '_entries_cache', root_utils.OrderedDict())
+    url = 'root://eos.example//lhcb/user/a/b.root'
+    for version in [(10, 'aa'), (10, 'aa'), (12, 'bb'), None, None]:
+        root_utils.count_tree_entries([url], versions={url: version} if version else None)
+    assert len(helper.counted) == 4  # rewritten file and unknown versions are counted again
+
+    root_utils.count_tree_entries(['root://x//1.root', 'root://x//2.root'],
+                                  versions={'root://x//1.root': (1, 'a'), 'root://x//2.root': (2, 'b')})
+    assert len(root_utils._entries_cache) == 2  # the least recently used was evicted
+    assert (url, 12, 'bb') not in root_utils._entries_cache
+
+
+def _crash(f):
+    if f == 'bad':
+        os._exit(1)
+    return f, {'DecayTree': 1}, None
+
+
+def test_crashed_worker_fails_its_file_only():
+    from gutils.root_utils import _map_processes
+    results = dict((f, (entries, error)) for f, entries, error in
+                   _map_processes(_crash, ['a', 'bad', 'b', 'c'], 2))
+    assert results['bad'][0] is None and 'crashed' in results['bad'][1]
+    assert all(results[f] == ({'DecayTree': 1}, None) for f in 'abc')
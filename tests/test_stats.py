@@ -0,0 +1,18 @@
+import pytest
+
+from gutils.stats import percentile
+
+
+@pytest.mark.parametrize('values, p, expected', [
+    ([1, 2, 3, 4, 5], 50, 3),
+    ([1, 2, 3, 4], 50, 2),
+    ([1, 2, 3, 4, 5], 0, 1),
+    ([1, 2, 3, 4, 5], 100, 5),
+    ([1, 2, 3, 4, 5], 90, 5),
+    (list(range(1, 11)), 90, 9),
+    (list(range(1, 101)), 99, 99),
+    ([7], 50, 7),
+    ([], 50, None),
+])
+def test_percentile_nearest_rank(values, p, expected):
+    assert percentile(values, p) == expected
@@ -0,0 +1,52 @@
+import socket
+
+from gutils import utils
+
+
+class Job(object):
+    def __init__(self, fqid, status, errors, submitted_on_error=False):
+        self.fqid = fqid
+        self.status = status
+        self.errors = list(errors)
+        self.submitted_on_error = submitted_on_error
+        self.calls = 0
+
+    def resubmit(self):
+        self.calls += 1
+        if self.errors:
+            if self.submitted_on_error:
+                self.status = 'submitted'
+            raise self.errors.pop(0)
+        self.status = 'submitted'
+
+
+def run(job, retries=2):
+    tasks = [([job.fqid], 'resubmit', job.resubmit, utils._status_changed([job]))]
+    result, = utils._run_bulk(tasks, workers=1, rate=1000.0, retries=retries, backoff=0)
+    return result
+
+
+def test_transient_error_is_retried():
+    job = Job('1.0', 'failed', [socket.timeout('timed out')])
+    result = run(job)
+    assert result.ok and result.tries == 2 and job.calls == 2
+
+
+def test_permanent_error_is_not_retried():
+    job = Job('1.1', 'failed', [ValueError('bad state')] * 3)
+    result = run(job)
+    assert not result.ok and result.tries == 1 and job.calls == 1
+
+
+def test_partial_resubmit_is_not_retried():
+    job = Job('1.2', 'failed', [IOError('connection reset')], submitted_on_error=True)
+    result = run(job)
+    assert not result.ok and job.calls == 1
+    assert '1.2 is submitted' in result.message
+
+
+def test_dirac_error_by_class_name():
+    GangaDiracError = type('GangaDiracError', (Exception,), {})
+    DiracSubError = type('DiracSubError', (GangaDiracError,), {})
+    assert utils._is_transient(DiracSubError('DIRAC timeout'))
+    assert not utils._is_transient(KeyError('backend'))